@@ -4,28 +4,28 @@ from decimal import Decimal, InvalidOperation
 from functools import wraps
 from flask import (
     Blueprint, render_template, request, session, redirect, url_for,
-    current_app, g, abort, flash
+    current_app, abort, flash, jsonify
 )
-from werkzeug.security import generate_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import TextIOWrapper
+
+from database import get_db, close_db
+from importer import import_transactions
+from reconcile import checkpoint_stats, drifted_accounts, reconcile
+from ledger import adjust_balance, delete_transaction, set_balance
+from shards import get_ledger_db
+from snapshots import append_only, ledger_balance
+from passwords import get_hasher
+from sessions import revoke_sessions, update_sessions
+from response_cache import get_response_cache
+from user_cache import invalidate_users
 
 admin_bp = Blueprint('admin', __name__, template_folder='templates', static_folder='static')
 
 
-def get_db():
-    db = getattr(g, '_admin_db', None)
-    if db is None:
-        db = sqlite3.connect(current_app.config['DB_PATH'])
-        db.row_factory = sqlite3.Row
-        g._admin_db = db
-    return db
-
-
 @admin_bp.teardown_app_request
-def close_db(exception):
-    db = getattr(g, '_admin_db', None)
-    if db is not None:
-        db.close()
+def release_db(exception):
+    close_db(exception)
 
 
 def to_cents(amount_str: str) -> int:
@@ -87,12 +87,65 @@ def admin_logout():
     return redirect(url_for('admin.admin_login'))
 
 
+ADMIN_PAGE_SIZE = 50
+
+
 @admin_bp.route('/admin/')
 @require_admin
 def admin_index():
     db = get_db()
-    rows = db.execute("SELECT id, username, first_name, last_name, balance_cents, created_at FROM users ORDER BY id DESC").fetchall()
-    return render_template('admin/dashboard.html', users=rows)
+    sql = "SELECT id, username, first_name, last_name, balance_cents, created_at FROM users WHERE 1 = 1"
+    params = []
+    filters = {}
+
+    prefix = (request.args.get('username') or '').strip()
+    if prefix:
+        # A range on the unique username index instead of LIKE 'prefix%'.
+        sql += " AND username >= ? AND username < ?"
+        params.extend([prefix, prefix + '\U0010ffff'])
+        filters['username'] = prefix
+    for arg, op in (('balance_min', '>='), ('balance_max', '<=')):
+        value = (request.args.get(arg) or '').strip()
+        if not value:
+            continue
+        try:
+            cents = to_cents(value)
+        except ValueError:
+            flash('Некорректная сумма в фильтре', 'error')
+            continue
+        sql += f" AND balance_cents {op} ?"
+        params.append(cents)
+        filters[arg] = value
+    for arg, op in (('created_from', '>='), ('created_to', '<')):
+        value = (request.args.get(arg) or '').strip()
+        if not value:
+            continue
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            flash('Некорректная дата в фильтре', 'error')
+            continue
+        if arg == 'created_to':
+            day += timedelta(days=1)
+        sql += f" AND created_at {op} ?"
+        params.append(day.date().isoformat())
+        filters[arg] = value
+
+    before = request.args.get('before', type=int)
+    if before:
+        sql += " AND id < ?"
+        params.append(before)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(ADMIN_PAGE_SIZE + 1)
+
+    rows = db.execute(sql, params).fetchall()
+    next_before = None
+    if len(rows) > ADMIN_PAGE_SIZE:
+        rows = rows[:ADMIN_PAGE_SIZE]
+        next_before = rows[-1]['id']
+    stats = db.execute("SELECT users_count, total_balance_cents FROM user_stats WHERE id = 1").fetchone()
+    return render_template('admin/dashboard.html', users=rows, stats=stats,
+                           filters=filters, next_before=next_before)
 
 
 @admin_bp.route('/admin/user/<int:user_id>', methods=['GET', 'POST'])
@@ -104,6 +157,9 @@ def admin_user_edit(user_id):
         abort(404)
 
     if request.method == 'GET':
+        if append_only(current_app):
+            # The form posts the balance back; start from the ledger, not the compactor's copy.
+            user = dict(user, balance_cents=ledger_balance(db, user_id))
         return render_template('admin/user.html', user=user)
 
     username = (request.form.get('username') or '').strip()
@@ -124,21 +180,41 @@ def admin_user_edit(user_id):
     db.execute("UPDATE users SET first_name=?, last_name=?, patronymic=?, birth_date=? WHERE id=?",
                (first_name, last_name, patronymic, birth_date, user_id))
 
+    new_balance = None
     if balance:
         try:
-            cents = to_cents(balance)
-            db.execute('UPDATE users SET balance_cents=? WHERE id=?', (cents, user_id))
+            new_balance = to_cents(balance)
         except ValueError:
             flash('Некорректная сумма баланса', 'error')
 
     if new_password:
-        db.execute('UPDATE users SET password_hash=? WHERE id=?', (generate_password_hash(new_password), user_id))
+        db.execute('UPDATE users SET password_hash=? WHERE id=?', (get_hasher(current_app).hash(new_password), user_id))
 
     db.commit()
+    invalidate_users(user_id)
+    renamed = username and username != user['username']
+    if new_password:
+        # Whoever knew the old password is logged out.
+        revoke_sessions(user_id)
+    elif renamed:
+        update_sessions(user_id, username=username)
+    if renamed:
+        # The name also appears in other users' transactions and invoices.
+        get_response_cache(current_app).bump_all()
+    if new_balance is not None:
+        # Through the ledger, so a sharded balance is updated where it lives.
+        set_balance(user_id, new_balance)
     flash('Пользователь обновлен', 'success')
     return redirect(url_for('admin.admin_user_edit', user_id=user_id))
 
 
+@admin_bp.route('/admin/user/<int:user_id>/sessions/revoke', methods=['POST'])
+@require_admin
+def admin_revoke_sessions(user_id):
+    flash(f'Завершено сеансов: {revoke_sessions(user_id)}', 'success')
+    return redirect(url_for('admin.admin_user_edit', user_id=user_id))
+
+
 @admin_bp.route('/admin/user/<int:user_id>/transactions', methods=['GET', 'POST'])
 @require_admin
 def admin_user_transactions(user_id):
@@ -157,46 +233,82 @@ def admin_user_transactions(user_id):
             flash('Некорректная сумма', 'error')
             return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
 
-        if ttype == 'credit':
-            new_balance = user['balance_cents'] + cents
-            db.execute('UPDATE users SET balance_cents=? WHERE id=?', (new_balance, user_id))
-            db.execute("INSERT INTO transactions (user_id, type, amount_cents, description, created_at) VALUES (?, 'credit', ?, ?, ?)",
-                       (user_id, cents, description, datetime.utcnow().isoformat()))
-        elif ttype == 'debit':
-            if user['balance_cents'] < cents:
-                flash('Недостаточно средств для списания', 'error')
-                return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
-            new_balance = user['balance_cents'] - cents
-            db.execute('UPDATE users SET balance_cents=? WHERE id=?', (new_balance, user_id))
-            db.execute("INSERT INTO transactions (user_id, type, amount_cents, description, created_at) VALUES (?, 'debit', ?, ?, ?)",
-                       (user_id, cents, description, datetime.utcnow().isoformat()))
-        else:
+        if ttype not in ('credit', 'debit'):
             flash('Неизвестный тип транзакции', 'error')
             return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
+        try:
+            adjust_balance(user_id, ttype, cents, description)
+        except ValueError:
+            flash('Недостаточно средств для списания', 'error')
+            return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
 
-        db.commit()
         flash('Транзакция создана', 'success')
         return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
 
-    rows = db.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC", (user_id,)).fetchall()
-    return render_template('admin/transactions.html', user=user, transactions=rows)
+    sql = "SELECT * FROM transactions WHERE user_id = ?"
+    params = [user_id]
+    before_ts = request.args.get('before_ts')
+    before_id = request.args.get('before_id', type=int)
+    if before_ts and before_id:
+        sql += " AND (created_at, id) < (?, ?)"
+        params.extend([before_ts, before_id])
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(ADMIN_PAGE_SIZE + 1)
+    rows = get_ledger_db(user_id).execute(sql, params).fetchall()
+    next_page = None
+    if len(rows) > ADMIN_PAGE_SIZE:
+        rows = rows[:ADMIN_PAGE_SIZE]
+        next_page = {'before_ts': rows[-1]['created_at'], 'before_id': rows[-1]['id']}
+    return render_template('admin/transactions.html', user=user, transactions=rows, next_page=next_page)
+
+
+@admin_bp.route('/admin/user/<int:user_id>/transactions/import', methods=['POST'])
+@require_admin
+def admin_import_transactions(user_id):
+    user = get_db().execute('SELECT username FROM users WHERE id = ?', (user_id,)).fetchone()
+    if not user:
+        abort(404)
+    upload = request.files.get('file')
+    if not upload:
+        flash('Выберите CSV-файл', 'error')
+        return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
+    try:
+        report = import_transactions(TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''),
+                                     owner=user['username'], create_users=bool(request.form.get('create_users')),
+                                     dry_run=bool(request.form.get('dry_run')))
+    except (ValueError, UnicodeDecodeError) as e:
+        flash(f'Импорт не выполнен: {e}', 'error')
+        return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
+
+    summary = report.as_dict()
+    flash(f"Строк: {summary['rows']}, загружено: {summary['imported']}, отклонено: {summary['rejected']}, "
+          f"новых пользователей: {summary['users_created']}", 'success')
+    for err in summary['errors'][:10]:
+        flash(f"Строка {err['line']}: {err['error']}", 'error')
+    return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
 
 
 @admin_bp.route('/admin/user/<int:user_id>/transactions/<int:tx_id>/delete', methods=['POST'])
 @require_admin
 def admin_delete_transaction(user_id, tx_id):
-    db = get_db()
-    tx = db.execute('SELECT * FROM transactions WHERE id=? AND user_id=?', (tx_id, user_id)).fetchone()
-    if not tx:
+    try:
+        balance = delete_transaction(user_id, tx_id)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
+    if balance is None:
         abort(404)
-
-    if tx['type'] == 'credit':
-        new_balance = db.execute('SELECT balance_cents FROM users WHERE id=?', (user_id,)).fetchone()['balance_cents'] - tx['amount_cents']
+    if append_only(current_app):
+        flash('Операция сторнирована', 'success')
     else:
-        new_balance = db.execute('SELECT balance_cents FROM users WHERE id=?', (user_id,)).fetchone()['balance_cents'] + tx['amount_cents']
-
-    db.execute('UPDATE users SET balance_cents=? WHERE id=?', (new_balance, user_id))
-    db.execute('DELETE FROM transactions WHERE id=?', (tx_id,))
-    db.commit()
-    flash('Транзакция удалена и баланс откорректирован', 'success')
+        flash('Транзакция удалена и баланс откорректирован', 'success')
     return redirect(url_for('admin.admin_user_transactions', user_id=user_id))
+
+
+@admin_bp.route('/admin/reconciliation', methods=['GET', 'POST'])
+@require_admin
+def admin_reconciliation():
+    """Drifted accounts as of their last check; POST runs an incremental check first."""
+    run = reconcile() if request.method == 'POST' else None
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    return jsonify(ok=True, run=run, checkpoints=checkpoint_stats(), drifted=drifted_accounts(limit=limit))
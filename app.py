@@ -2,26 +2,87 @@ import os
 import sqlite3
 import re
 import csv
+import base64
+import json
+import threading
+import click
 from flask import (
     Flask, request, session, jsonify,
-    render_template, send_file, Blueprint, g, redirect, url_for, abort, Response
+    render_template, Blueprint, redirect, url_for, abort, Response
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from io import BytesIO, StringIO
-import qrcode
-from datetime import datetime
+from io import StringIO
+from datetime import datetime, timedelta
 from decimal import Decimal, InvalidOperation
 
+from database import get_db, close_db, migrate, rebuild_summaries, schema_version
+from search import fts_available, match_expression
+from ledger import LedgerBusy, now_iso, pay_invoice, recover_transfers, transfer_funds, transfer_batch
+from importer import IMPORT_CHUNK_SIZE, import_transactions
+from reconcile import RANGE_SIZE, accept_drift, drifted_accounts, reconcile
+from shards import close_ledger_dbs, get_ledger_db, get_ledger_pool, get_shards, prepare_shards
+from snapshots import append_only, balance_at, ledger_balance, prepare_ledger_mode
+from passwords import HasherBusy, get_hasher
+from sessions import ServerSessionInterface, get_session_store, revoke_sessions
+from user_cache import get_user_cache, invalidate_users
+from qr_cache import get_qr_cache, MIMETYPES as QR_MIMETYPES
+from response_cache import conditional
+from metrics import init_metrics
+from idempotency import KeyMismatch, KeyRecorded, from_request as idempotent_request, prune as prune_idempotency_keys
+from events import SSE_HEADERS, SSE_KEEPALIVE, SSE_PROLOGUE, format_sse, get_event_hub
+
 # -------------------------
 # App & Config
 # -------------------------
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev_secret_change_me')
+# Also the cap asgi.py enforces while reading a body, including admin CSV uploads;
+# larger files go through `flask import-transactions`.
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['DEBUG_LOGIN_BY_ID'] = True
 DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.sqlite3')
 
 app.config['DB_PATH'] = DB_PATH
+app.config['SQLITE_PRAGMAS'] = {}
+app.config['SQLITE_CACHED_STATEMENTS'] = 256
+app.config['SQLITE_POOL_SIZE'] = 16
+app.config['LEDGER_GROUP_COMMIT'] = True
+app.config['LEDGER_MAX_BATCH'] = 256
+# Split balances and history over this many SQLite files (1 = single file).
+app.config['LEDGER_SHARDS'] = int(os.environ.get('LIBANK_LEDGER_SHARDS', 1))
+app.config['LEDGER_MIRROR_INTERVAL'] = 0.05
+app.config['LEDGER_RECOVERY_DELAY'] = 5
+# Never update or delete ledger rows; derive balances from snapshots + tail.
+app.config['LEDGER_APPEND_ONLY'] = os.environ.get('LIBANK_LEDGER_APPEND_ONLY') == '1'
+app.config['LEDGER_COMPACT_INTERVAL'] = 5.0
+app.config['LEDGER_SNAPSHOT_TAIL'] = 64
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = 4
+app.config['PASSWORD_HASH_QUEUE'] = 32
+# 'server' keeps sessions in SQLite behind an LRU (revocable); 'cookie' is Flask's signed cookie.
+app.config['SESSION_BACKEND'] = os.environ.get('LIBANK_SESSION_BACKEND', 'server')
+app.config['SESSION_CACHE_TTL'] = 5.0
+app.config['SESSION_CACHE_SIZE'] = 10000
+app.config['USER_CACHE_TTL'] = 5.0
+app.config['USER_CACHE_SIZE'] = 10000
+app.config['QR_CACHE_BYTES'] = 8 * 1024 * 1024
+app.config['QR_CACHE_DIR'] = os.environ.get('QR_CACHE_DIR')
+app.config['QR_CACHE_DIR_BYTES'] = 256 * 1024 * 1024
+# Per-request SQL timing, /metrics and the slow-request sampler are opt-in.
+app.config['METRICS_ENABLED'] = os.environ.get('LIBANK_METRICS') == '1'
+app.config['METRICS_SLOW_REQUEST_MS'] = int(os.environ.get('LIBANK_SLOW_REQUEST_MS', 0)) or None
+app.config['METRICS_SAMPLE_INTERVAL'] = 0.005
+# /metrics and /metrics/slow need an admin session; this opens /metrics to scrapers.
+app.config['METRICS_PUBLIC'] = os.environ.get('LIBANK_METRICS_PUBLIC') == '1'
+# Requests (and so SQLite connections) in flight when served through asgi.py.
+app.config['ASGI_WORKERS'] = 32
+app.config['ASGI_BODY_SPOOL'] = 1024 * 1024
+app.config['EVENTS_KEEPALIVE'] = 15
+app.config['EVENTS_HISTORY'] = 1024
+app.config['IDEMPOTENCY_CACHE_SIZE'] = 10000
+# Serialized /api/me, transaction and invoice bodies, revalidated with ETags.
+app.config['RESPONSE_CACHE_TTL'] = 10.0
+app.config['RESPONSE_CACHE_SIZE'] = 10000
 
 api = Blueprint('api', __name__, url_prefix='/api')
 web = Blueprint('web', __name__)
@@ -29,22 +90,8 @@ web = Blueprint('web', __name__)
 # -------------------------
 # DB Helpers
 # -------------------------
-def get_db():
-    db = getattr(g, '_db', None)
-    if db is None:
-        db = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-        g._db = db
-    return db
-
-@app.teardown_appcontext
-def close_db(exception):
-    db = getattr(g, '_db', None)
-    if db is not None:
-        db.close()
-
-def now_iso():
-    return datetime.utcnow().isoformat()
+app.teardown_appcontext(close_ledger_dbs)
+app.teardown_appcontext(close_db)
 
 def to_cents(amount_str: str) -> int:
     try:
@@ -59,63 +106,120 @@ def to_cents(amount_str: str) -> int:
 
 def init_db():
     db = get_db()
-    db.executescript("""
-    CREATE TABLE IF NOT EXISTS users (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      username TEXT UNIQUE NOT NULL,
-      password_hash TEXT NOT NULL,
-      first_name TEXT,
-      last_name TEXT,
-      patronymic TEXT,
-      birth_date TEXT,
-      balance_cents INTEGER NOT NULL DEFAULT 0,
-      created_at TEXT NOT NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS transactions (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      user_id INTEGER NOT NULL,
-      type TEXT CHECK(type IN ('debit','credit')) NOT NULL,
-      amount_cents INTEGER NOT NULL,
-      description TEXT,
-      counterparty_id INTEGER,
-      invoice_id INTEGER,
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS invoices (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      creator_id INTEGER NOT NULL,
-      amount_cents INTEGER NOT NULL,
-      description TEXT,
-      status TEXT CHECK(status IN ('pending','paid','cancelled')) NOT NULL DEFAULT 'pending',
-      created_at TEXT NOT NULL,
-      paid_by INTEGER,
-      paid_at TEXT,
-      FOREIGN KEY(creator_id) REFERENCES users(id)
-    );
-
-    CREATE INDEX IF NOT EXISTS idx_trans_user ON transactions(user_id);
-    CREATE INDEX IF NOT EXISTS idx_inv_status ON invoices(status);
-    """)
+    migrate(db)
     count = db.execute("SELECT COUNT(*) AS c FROM users").fetchone()['c']
     if count == 0:
+        hasher = get_hasher(app)
         users = [
-            ('alice', generate_password_hash('Pass1234'), 'Алиса', 'Иванова', None, '1990-05-15', 500000, now_iso()),
-            ('bob', generate_password_hash('Qwerty987'), 'Борис', 'Петров', 'Сергеевич', '1988-11-20', 250000, now_iso()),
+            ('alice', hasher.hash('Pass1234'), 'Алиса', 'Иванова', None, '1990-05-15', 500000, now_iso()),
+            ('bob', hasher.hash('Qwerty987'), 'Борис', 'Петров', 'Сергеевич', '1988-11-20', 250000, now_iso()),
         ]
         db.executemany(
             "INSERT INTO users (username, password_hash, first_name, last_name, patronymic, birth_date, balance_cents, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
             users
         )
         db.commit()
+    prepare_shards(app)
+    prepare_ledger_mode(app)
+    recover_transfers()
+
+_schema_lock = threading.Lock()
+_schema_ready = False
 
 @app.before_request
 def ensure_db():
-    if not os.path.exists(DB_PATH):
-        open(DB_PATH, 'a').close()
+    # Schema setup runs once per process; afterwards this is a flag check.
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            init_db()
+            _schema_ready = True
+
+if app.config['SESSION_BACKEND'] == 'server':
+    app.session_interface = ServerSessionInterface(prepare=ensure_db)
+
+@app.cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """Recompute the per-day and per-counterparty summary tables."""
+    ensure_db()
+    shards = get_shards(app)
+    if shards is None:
+        rebuild_summaries(get_db())
+    else:
+        shards.run_on_each(rebuild_summaries)
+    print("Сводные таблицы пересчитаны")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Apply pending schema migrations and seed demo users."""
     init_db()
+    print(f"Схема БД: версия {schema_version(get_db())}")
+
+@app.cli.command('prune-idempotency-keys')
+@click.option('--hours', default=24, show_default=True, help='Keep keys younger than this.')
+def prune_idempotency_keys_command(hours):
+    """Forget stored Idempotency-Key responses older than --hours."""
+    ensure_db()
+    before = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+    # Sharded keys are stored with the payer's ledger; the main DB keeps any from before the split.
+    removed = prune_idempotency_keys(get_db(), before)
+    shards = get_shards(app)
+    if shards is not None:
+        removed += sum(shards.run_on_each(lambda db: prune_idempotency_keys(db, before)))
+    print(f"Удалено ключей: {removed}")
+
+@app.cli.command('prune-sessions')
+def prune_sessions_command():
+    """Delete expired server-side sessions (also done in passing on login)."""
+    ensure_db()
+    print(f"Удалено сеансов: {get_session_store(app).prune(get_db())}")
+
+@app.cli.command('import-transactions')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'owner', help='Owner of rows without a Владелец column.')
+@click.option('--create-users', is_flag=True, help='Create missing owners and counterparties (no password).')
+@click.option('--offline', is_flag=True, help='Drop ledger indexes and triggers while loading; stop the app first.')
+@click.option('--dry-run', is_flag=True, help='Validate only.')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='Rows per transaction.')
+def import_transactions_command(path, owner, create_users, offline, dry_run, chunk_size):
+    """Bulk-load a CSV in the /api/transactions/export layout."""
+    ensure_db()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        try:
+            report = import_transactions(f, owner=owner, create_users=create_users, offline=offline,
+                                         dry_run=dry_run, chunk_size=chunk_size)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    print(json.dumps(report.as_dict(), ensure_ascii=False, indent=2))
+
+@app.cli.command('reconcile')
+@click.option('--workers', default=4, show_default=True, help='User-id ranges checked in parallel.')
+@click.option('--range-size', default=RANGE_SIZE, show_default=True, help='User ids per range.')
+@click.option('--accept', 'accept', multiple=True, type=int, help='Accept the current balance of this user id.')
+def reconcile_command(workers, range_size, accept):
+    """Check balances against the ledger since the last checkpoint and list drifted accounts."""
+    ensure_db()
+    if accept:
+        print(f"Принято счетов: {accept_drift(accept)}")
+        return
+    report = reconcile(workers=workers, range_size=range_size)
+    report["drifted_accounts"] = drifted_accounts(limit=20)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+@app.cli.command('compact-ledger')
+def compact_ledger_command():
+    """Take balance snapshots now instead of waiting for the compactor (LEDGER_APPEND_ONLY)."""
+    ensure_db()
+    if not append_only(app):
+        raise click.ClickException("LEDGER_APPEND_ONLY выключен")
+    print(f"Снимков балансов: {app.extensions['snapshot_compactor'].compact()}")
+
+@app.cli.command('recover-transfers')
+def recover_transfers_command():
+    """Finish cross-shard transfers interrupted by a crash (LEDGER_SHARDS > 1)."""
+    print(f"Завершено переводов: {recover_transfers()}")
 
 def require_login():
     uid = session.get('user_id')
@@ -123,13 +227,45 @@ def require_login():
         abort(401, description="Требуется вход")
     return uid
 
-def get_user_by_id(user_id):
-    db = get_db()
-    return db.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-
-def get_user_by_username(username):
-    db = get_db()
-    return db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+def login_user(user):
+    # The session carries what most requests need, so they skip the users table.
+    session['user_id'] = user["id"]
+    session['username'] = user["username"]
+
+def with_ledger_balance(user):
+    # With sharding on, users.balance_cents is a lagging mirror; the shard is authoritative.
+    # In append-only mode it is the compactor's copy; the ledger is.
+    if user is not None and append_only(app):
+        balance = ledger_balance(get_db(), user["id"])
+        return user if balance is None else dict(user, balance_cents=balance)
+    shards = get_shards(app)
+    if user is None or shards is None:
+        return user
+    balance = shards.balance(get_ledger_db(user["id"]), user["id"])
+    return user if balance is None else dict(user, balance_cents=balance)
+
+# Password checks pass fresh=True so they never see a cached hash.
+def get_user_by_id(user_id, fresh=False):
+    if fresh:
+        return get_db().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    return with_ledger_balance(get_user_cache(app).get_by_id(get_db(), user_id))
+
+def get_user_by_username(username, fresh=False):
+    if fresh:
+        return get_db().execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+    return with_ledger_balance(get_user_cache(app).get_by_username(get_db(), username))
+
+def encode_cursor(created_at, tx_id):
+    raw = f"{created_at}|{tx_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        created_at, tx_id = raw.rsplit('|', 1)
+        return created_at, int(tx_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Некорректный курсор")
 
 def is_password_strong(password):
     if len(password) < 8: return False, "Пароль должен быть не менее 8 символов"
@@ -184,42 +320,10 @@ def serialize_invoice(row, include_creator=False):
         "paid_at": row["paid_at"]
     }
     if include_creator:
-        db = get_db()
-        u = db.execute("SELECT username FROM users WHERE id = ?", (row["creator_id"],)).fetchone()
+        u = get_user_by_id(row["creator_id"])
         data["creator_username"] = u["username"] if u else None
     return data
 
-def transfer_funds(payer_id: int, recipient_id: int, amount_cents: int, description: str, invoice_id: int = None):
-    db = get_db()
-    db.execute("BEGIN IMMEDIATE")
-    try:
-        payer = db.execute("SELECT id, balance_cents FROM users WHERE id = ?", (payer_id,)).fetchone()
-        recipient = db.execute("SELECT id, balance_cents FROM users WHERE id = ?", (recipient_id,)).fetchone()
-        if not payer or not recipient:
-            raise ValueError("Пользователь не найден")
-
-        if payer["balance_cents"] < amount_cents:
-            raise ValueError("Недостаточно средств")
-
-        new_payer_balance = payer["balance_cents"] - amount_cents
-        new_recipient_balance = recipient["balance_cents"] + amount_cents
-        db.execute("UPDATE users SET balance_cents = ? WHERE id = ?", (new_payer_balance, payer_id))
-        db.execute("UPDATE users SET balance_cents = ? WHERE id = ?", (new_recipient_balance, recipient_id))
-
-        ts = now_iso()
-        db.execute("""
-            INSERT INTO transactions (user_id, type, amount_cents, description, counterparty_id, invoice_id, created_at)
-            VALUES (?, 'debit', ?, ?, ?, ?, ?)
-        """, (payer_id, amount_cents, description, recipient_id, invoice_id, ts))
-        db.execute("""
-            INSERT INTO transactions (user_id, type, amount_cents, description, counterparty_id, invoice_id, created_at)
-            VALUES (?, 'credit', ?, ?, ?, ?, ?)
-        """, (recipient_id, amount_cents, description, payer_id, invoice_id, ts))
-        db.commit()
-    except Exception as e:
-        db.execute("ROLLBACK")
-        raise e
-
 # -------------------------
 # WEB (Frontend pages)
 # -------------------------
@@ -279,14 +383,14 @@ def api_register():
         db.execute(
             """INSERT INTO users (username, password_hash, first_name, last_name, patronymic, birth_date, balance_cents, created_at)
                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-            (username, generate_password_hash(password), first_name, last_name, patronymic, birth_date, 10000, now_iso()) # Welcome bonus 100 RUB
+            (username, get_hasher(app).hash(password), first_name, last_name, patronymic, birth_date, 10000, now_iso()) # Welcome bonus 100 RUB
         )
         db.commit()
     except sqlite3.IntegrityError:
         return jsonify(ok=False, error="Пользователь с таким логином уже существует"), 409
 
     user = get_user_by_username(username)
-    session['user_id'] = user["id"]
+    login_user(user)
     return jsonify(ok=True, user=serialize_user(user))
 
 @api.route('/login', methods=['POST'])
@@ -296,10 +400,17 @@ def api_login():
     password = (data.get('password') or '').strip()
     if not username or not password:
         return jsonify(ok=False, error="Укажите логин и пароль"), 400
-    user = get_user_by_username(username)
-    if not user or not check_password_hash(user["password_hash"], password):
+    user = get_user_by_username(username, fresh=True)
+    hasher = get_hasher(app)
+    if not user or not hasher.verify(user["password_hash"], password):
         return jsonify(ok=False, error="Неверный логин или пароль"), 401
-    session['user_id'] = user["id"]
+    if hasher.needs_rehash(user["password_hash"]):
+        # The password is at hand only now: upgrade hashes made with old cost settings.
+        db = get_db()
+        db.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hasher.hash(password), user["id"]))
+        db.commit()
+        invalidate_users(user["id"])
+    login_user(user)
     return jsonify(ok=True, user=serialize_user(user))
 
 @api.route('/login_by_id', methods=['POST'])
@@ -314,7 +425,7 @@ def api_login_by_id():
     user = get_user_by_id(user_id)
     if not user:
         return jsonify(ok=False, error="Пользователь не найден"), 404
-    session['user_id'] = user["id"]
+    login_user(user)
     return jsonify(ok=True, user=serialize_user(user))
 
 @api.route('/logout', methods=['POST'])
@@ -323,11 +434,25 @@ def api_logout():
     return jsonify(ok=True)
 
 @api.route('/me', methods=['GET'])
+@conditional(require_login, lambda uid: [('user', uid)])
 def api_me():
     uid = require_login()
     user = get_user_by_id(uid)
     return jsonify(ok=True, user=serialize_user(user, full=True))
 
+@api.route('/me/balance', methods=['GET'])
+def api_balance_at():
+    uid = require_login()
+    at = request.args.get('at')
+    try:
+        at = datetime.fromisoformat(at).isoformat() if at else None
+    except ValueError:
+        return jsonify(ok=False, error="Некорректный формат даты"), 400
+    balance = get_user_by_id(uid)["balance_cents"]
+    if at is not None:
+        balance = balance_at(get_ledger_db(uid), uid, at, balance, snapshots=append_only(app))
+    return jsonify(ok=True, at=at, balance_cents=balance)
+
 @api.route('/me', methods=['PUT'])
 def api_update_me():
     uid = require_login()
@@ -350,6 +475,7 @@ def api_update_me():
         WHERE id = ?
     """, (first_name, last_name, patronymic, birth_date, uid))
     db.commit()
+    invalidate_users(uid)
     return jsonify(ok=True, message="Профиль обновлён")
 
 @api.route('/me/password', methods=['PUT'])
@@ -363,8 +489,8 @@ def api_change_password():
     if not all([current_password, new_password, new_password_confirm]):
         return jsonify(ok=False, error="Все поля обязательны"), 400
 
-    user = get_user_by_id(uid)
-    if not check_password_hash(user['password_hash'], current_password):
+    user = get_user_by_id(uid, fresh=True)
+    if not get_hasher(app).verify(user['password_hash'], current_password):
         return jsonify(ok=False, error="Текущий пароль неверен"), 403
 
     if new_password != new_password_confirm:
@@ -375,8 +501,11 @@ def api_change_password():
         return jsonify(ok=False, error=message), 400
 
     db = get_db()
-    db.execute("UPDATE users SET password_hash = ? WHERE id = ?", (generate_password_hash(new_password), uid))
+    db.execute("UPDATE users SET password_hash = ? WHERE id = ?", (get_hasher(app).hash(new_password), uid))
     db.commit()
+    invalidate_users(uid)
+    # Log out every other device; this one stays signed in.
+    revoke_sessions(uid, keep=session)
     return jsonify(ok=True, message="Пароль успешно изменён")
 
 @api.route('/transactions', methods=['GET'])
@@ -384,36 +513,129 @@ def api_transactions():
     uid = require_login()
     q = (request.args.get('q') or '').strip()
     ttype = (request.args.get('type') or '').strip()
-    limit = 50
-    offset = 0
-
-    db = get_db()
-    sql = """
-    SELECT t.*, u.username as counterparty_username
-    FROM transactions t
-    LEFT JOIN users u ON u.id = t.counterparty_id
-    WHERE t.user_id = ?
-    """
-    params = [uid]
-
+    before = (request.args.get('before') or '').strip()
+    by_relevance = request.args.get('order') == 'relevance'
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+    except ValueError:
+        return jsonify(ok=False, error="Некорректный limit"), 400
+
+    db = get_ledger_db(uid)
+    match = match_expression(uid, q) if q and fts_available(db) else None
+    by_relevance = by_relevance and match is not None
+    if by_relevance:
+        # Ranked search returns the best matches only; no cursor paging.
+        sql = """
+        SELECT t.*, u.username as counterparty_username
+        FROM transactions_fts f
+        JOIN transactions t ON t.id = f.rowid
+        LEFT JOIN users u ON u.id = t.counterparty_id
+        WHERE transactions_fts MATCH ? AND t.user_id = ?
+        """
+        params = [match, uid]
+        before = ''
+    else:
+        sql = """
+        SELECT t.*, u.username as counterparty_username
+        FROM transactions t
+        LEFT JOIN users u ON u.id = t.counterparty_id
+        WHERE t.user_id = ?
+        """
+        params = [uid]
+
+    if before:
+        try:
+            created_at, tx_id = decode_cursor(before)
+        except ValueError as e:
+            return jsonify(ok=False, error=str(e)), 400
+        sql += " AND (t.created_at, t.id) < (?, ?)"
+        params.extend([created_at, tx_id])
     if ttype in ('debit', 'credit'):
         sql += " AND t.type = ?"
         params.append(ttype)
-    if q:
+    if match is not None and not by_relevance:
+        sql += " AND t.id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)"
+        params.append(match)
+    elif q and match is None:
         sql += " AND (t.description LIKE ? OR u.username LIKE ?)"
         like = f"%{q}%"
         params.extend([like, like])
 
-    sql += " ORDER BY t.created_at DESC, t.id DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+    if by_relevance:
+        sql += " ORDER BY f.rank, t.id DESC LIMIT ?"
+        params.append(limit)
+    else:
+        # One extra row tells us whether another page exists.
+        sql += " ORDER BY t.created_at DESC, t.id DESC LIMIT ?"
+        params.append(limit + 1)
 
     rows = db.execute(sql, params).fetchall()
-    return jsonify(ok=True, items=[serialize_transaction(r) for r in rows])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return jsonify(ok=True, items=[serialize_transaction(r) for r in rows], next_cursor=next_cursor)
+
+@api.route('/transactions/summary', methods=['GET'])
+def api_transactions_summary():
+    uid = require_login()
+    try:
+        months = min(max(int(request.args.get('months', 12)), 1), 36)
+    except ValueError:
+        return jsonify(ok=False, error="Некорректный период"), 400
+    today = datetime.utcnow().date()
+    first_month = (today.year * 12 + today.month - 1) - (months - 1)
+    since = f"{first_month // 12:04d}-{first_month % 12 + 1:02d}-01"
+
+    db = get_ledger_db(uid)
+    days = db.execute("""
+        SELECT day, in_cents, out_cents, in_count, out_count
+        FROM daily_totals
+        WHERE user_id = ? AND day >= ?
+        ORDER BY day DESC
+    """, (uid, since)).fetchall()
+
+    # Walk back from the current balance: each day closes at what is left
+    # after undoing every later day's net flow.
+    balance = get_user_by_id(uid)["balance_cents"]
+    running = []
+    monthly = {}
+    for d in days:
+        running.append({"day": d["day"], "balance_cents": balance})
+        balance -= d["in_cents"] - d["out_cents"]
+        m = monthly.setdefault(d["day"][:7], {"month": d["day"][:7], "in_cents": 0, "out_cents": 0, "count": 0})
+        m["in_cents"] += d["in_cents"]
+        m["out_cents"] += d["out_cents"]
+        m["count"] += d["in_count"] + d["out_count"]
+    running.reverse()
+
+    top = db.execute("""
+        SELECT c.counterparty_id, u.username, c.in_cents, c.out_cents, c.tx_count
+        FROM counterparty_totals c
+        LEFT JOIN users u ON u.id = c.counterparty_id
+        WHERE c.user_id = ? AND c.tx_count > 0
+        ORDER BY c.in_cents + c.out_cents DESC
+        LIMIT 5
+    """, (uid,)).fetchall()
+
+    return jsonify(
+        ok=True,
+        monthly=sorted(monthly.values(), key=lambda m: m["month"]),
+        top_counterparties=[{
+            "counterparty_id": r["counterparty_id"],
+            "counterparty_username": r["username"],
+            "in_cents": r["in_cents"],
+            "out_cents": r["out_cents"],
+            "count": r["tx_count"],
+        } for r in top],
+        running_balance=running,
+    )
 
 @api.route('/transactions/<int:tx_id>', methods=['GET'])
+@conditional(require_login, lambda uid, tx_id: [('user', uid)])
 def api_transaction_details(tx_id):
     uid = require_login()
-    db = get_db()
+    db = get_ledger_db(uid)
     row = db.execute("""
         SELECT t.*, u.username as counterparty_username
         FROM transactions t
@@ -424,29 +646,98 @@ def api_transaction_details(tx_id):
         return jsonify(ok=False, error="Транзакция не найдена"), 404
     return jsonify(ok=True, transaction=serialize_transaction(row, full=True))
 
-@api.route('/transactions/export', methods=['GET'])
-def api_export_transactions():
-    uid = require_login()
-    db = get_db()
-    rows = db.execute("""
+EXPORT_CHUNK_SIZE = 1000
+
+def iter_export_rows(db, uid, date_from=None, date_to=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the user's transactions newest first, fetching one keyset page at a time."""
+    sql = """
         SELECT t.id, t.created_at, t.type, t.amount_cents, t.description, u.username as counterparty_username
         FROM transactions t
         LEFT JOIN users u ON u.id = t.counterparty_id
         WHERE t.user_id = ?
-        ORDER BY t.created_at DESC
-    """, (uid,)).fetchall()
+    """
+    params = [uid]
+    if date_from:
+        sql += " AND t.created_at >= ?"
+        params.append(date_from)
+    if date_to:
+        sql += " AND t.created_at < ?"
+        params.append(date_to)
+
+    cursor = None
+    while True:
+        page_sql = sql
+        page_params = list(params)
+        if cursor:
+            page_sql += " AND (t.created_at, t.id) < (?, ?)"
+            page_params.extend(cursor)
+        page_sql += " ORDER BY t.created_at DESC, t.id DESC LIMIT ?"
+        page_params.append(chunk_size)
+        rows = db.execute(page_sql, page_params).fetchall()
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        cursor = (rows[-1]['created_at'], rows[-1]['id'])
+
+def stream_export_rows(pool, uid, date_from=None, date_to=None):
+    # The body is read after the view returns and teardown has released the
+    # request's connections, so the stream checks out one of its own.
+    db = pool.acquire()
+    try:
+        yield from iter_export_rows(db, uid, date_from, date_to)
+    finally:
+        pool.release(db)
 
-    output = StringIO()
-    writer = csv.writer(output)
+def export_csv(rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
     writer.writerow(['ID', 'Дата', 'Тип', 'Сумма (коп.)', 'Описание', 'Контрагент'])
-    for row in rows:
+    for i, row in enumerate(rows, 1):
         writer.writerow([row['id'], row['created_at'], row['type'], row['amount_cents'], row['description'], row['counterparty_username']])
+        if i % EXPORT_CHUNK_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def export_jsonl(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(row), ensure_ascii=False))
+        if len(lines) == EXPORT_CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+}
 
-    output.seek(0)
+@api.route('/transactions/export', methods=['GET'])
+def api_export_transactions():
+    uid = require_login()
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify(ok=False, error="Неподдерживаемый формат"), 400
+    try:
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        if date_from:
+            date_from = datetime.strptime(date_from, '%Y-%m-%d').date().isoformat()
+        if date_to:
+            # Inclusive: everything before the start of the next day.
+            date_to = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).date().isoformat()
+    except ValueError:
+        return jsonify(ok=False, error="Некорректный формат даты"), 400
+
+    render, mimetype = EXPORT_FORMATS[fmt]
+    rows = stream_export_rows(get_ledger_pool(app, uid), uid, date_from, date_to)
     return Response(
-        output,
-        mimetype="text/csv",
-        headers={"Content-Disposition": f"attachment;filename=transactions_{datetime.now().strftime('%Y%m%d')}.csv"}
+        render(rows),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment;filename=transactions_{datetime.now().strftime('%Y%m%d')}.{fmt}"}
     )
 
 @api.route('/invoices', methods=['POST'])
@@ -467,13 +758,14 @@ def api_create_invoice():
     db.commit()
     invoice_id = cur.lastrowid
     payload = f"PAY:{invoice_id}"
-    qr_url = url_for('api.qr_png', invoice_id=invoice_id)
+    qr_url = url_for('api.qr_png', invoice_id=invoice_id, fmt='png')
     return jsonify(ok=True, invoice={
         "id": invoice_id, "amount_cents": amount_cents, "description": description,
         "status": "pending", "qr_url": qr_url, "payload": payload
     })
 
 @api.route('/invoices/<int:invoice_id>', methods=['GET'])
+@conditional(require_login, lambda uid, invoice_id: [('invoice', invoice_id)])
 def api_get_invoice(invoice_id):
     require_login()
     db = get_db()
@@ -482,36 +774,86 @@ def api_get_invoice(invoice_id):
         return jsonify(ok=False, error="Счёт не найден"), 404
     return jsonify(ok=True, invoice=serialize_invoice(inv, include_creator=True))
 
+@api.route('/events', methods=['GET'])
+def api_events():
+    # Under asgi.py this path is served natively on the event loop instead.
+    uid = require_login()
+    sub = get_event_hub(app).subscribe(uid, request.headers.get('Last-Event-ID', type=int))
+    keepalive = app.config.get('EVENTS_KEEPALIVE', 15)
+
+    def stream():
+        try:
+            yield SSE_PROLOGUE
+            while True:
+                events = sub.get(keepalive)
+                if not events:
+                    yield SSE_KEEPALIVE
+                for event in events:
+                    yield format_sse(event)
+        finally:
+            sub.close()
+
+    return Response(stream(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+def idempotent_replay(idem):
+    """The stored response for a repeated Idempotency-Key, or None if it is new."""
+    try:
+        stored = idem.lookup(get_ledger_db(idem.user_id))
+    except KeyMismatch:
+        return jsonify(ok=False, error="Idempotency-Key уже использован для другого запроса"), 422
+    if stored is None:
+        return None
+    status, body = stored
+    resp = jsonify(body)
+    resp.status_code = status
+    resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+def pay_response(balance):
+    return {"ok": True, "message": "Оплата успешна", "balance_cents": balance}
+
 @api.route('/pay', methods=['POST'])
 def api_pay_invoice():
     uid = require_login()
     data = request.get_json(force=True, silent=True) or {}
+    try:
+        idem = idempotent_request(uid, data, pay_response)
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    if idem is not None:
+        replay = idempotent_replay(idem)
+        if replay is not None:
+            return replay
     try:
         invoice_id = int(data.get('invoice_id'))
     except (TypeError, ValueError):
         return jsonify(ok=False, error="Некорректный номер счёта"), 400
 
-    db = get_db()
-    inv = db.execute("SELECT * FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
-    if not inv: return jsonify(ok=False, error="Счёт не найден"), 404
-    if inv["status"] != "pending": return jsonify(ok=False, error="Счёт уже оплачен или отменён"), 400
-    if inv["creator_id"] == uid: return jsonify(ok=False, error="Нельзя оплатить собственный счёт"), 400
-
-    description = inv["description"] or f"Оплата счёта #{invoice_id}"
     try:
-        transfer_funds(payer_id=uid, recipient_id=inv["creator_id"], amount_cents=inv["amount_cents"], description=description, invoice_id=invoice_id)
+        balance = pay_invoice(uid, invoice_id, idempotency=idem)
+    except KeyRecorded:
+        return idempotent_replay(idem)
     except ValueError as e:
         return jsonify(ok=False, error=str(e)), 400
+    if balance is None:
+        return jsonify(ok=False, error="Счёт не найден"), 404
+    return jsonify(pay_response(balance))
 
-    db.execute("UPDATE invoices SET status='paid', paid_by=?, paid_at=? WHERE id=?", (uid, now_iso(), invoice_id))
-    db.commit()
-    payer = get_user_by_id(uid)
-    return jsonify(ok=True, message="Оплата успешна", balance_cents=payer["balance_cents"])
+def transfer_response(balance):
+    return {"ok": True, "message": "Перевод успешен", "balance_cents": balance}
 
 @api.route('/transfer', methods=['POST'])
 def api_transfer():
     uid = require_login()
     data = request.get_json(force=True, silent=True) or {}
+    try:
+        idem = idempotent_request(uid, data, transfer_response)
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    if idem is not None:
+        replay = idempotent_replay(idem)
+        if replay is not None:
+            return replay
     recipient_username = (data.get('recipient_username') or '').strip()
     description = (data.get('description') or '').strip()
     try:
@@ -530,21 +872,102 @@ def api_transfer():
 
     final_description = description or f"Перевод пользователю @{recipient_username}"
     try:
-        transfer_funds(payer_id=uid, recipient_id=recipient['id'], amount_cents=amount_cents, description=final_description)
+        balance = transfer_funds(payer_id=uid, recipient_id=recipient['id'], amount_cents=amount_cents,
+                                 description=final_description, idempotency=idem)
+    except KeyRecorded:
+        return idempotent_replay(idem)
     except ValueError as e:
         return jsonify(ok=False, error=str(e)), 400
 
-    payer = get_user_by_id(uid)
-    return jsonify(ok=True, message="Перевод успешен", balance_cents=payer["balance_cents"])
+    return jsonify(transfer_response(balance))
 
-@api.route('/qr/<int:invoice_id>.png', methods=['GET'])
-def qr_png(invoice_id):
-    payload = f"PAY:{invoice_id}"
-    img = qrcode.make(payload)
-    buf = BytesIO()
-    img.save(buf, format='PNG')
-    buf.seek(0)
-    return send_file(buf, mimetype='image/png', download_name=f'invoice_{invoice_id}.png')
+BATCH_MAX_ITEMS = 1000
+
+@api.route('/transfers/batch', methods=['POST'])
+def api_transfer_batch():
+    uid = require_login()
+    data = request.get_json(force=True, silent=True) or {}
+    entries = data.get('transfers')
+    mode = data.get('mode', 'atomic')
+    if mode not in ('atomic', 'best_effort'):
+        return jsonify(ok=False, error="Некорректный режим"), 400
+    if not isinstance(entries, list) or not entries:
+        return jsonify(ok=False, error="Список переводов пуст"), 400
+    if len(entries) > BATCH_MAX_ITEMS:
+        return jsonify(ok=False, error=f"Не более {BATCH_MAX_ITEMS} переводов за раз"), 400
+
+    errors = [None] * len(entries)
+    parsed = [None] * len(entries)
+    usernames = set()
+    for i, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        recipient_username = (entry.get('recipient_username') or '').strip()
+        description = (entry.get('description') or '').strip()
+        try:
+            amount_cents = to_cents(entry.get('amount'))
+        except ValueError as e:
+            errors[i] = str(e)
+            continue
+        if not recipient_username:
+            errors[i] = "Укажите получателя"
+            continue
+        usernames.add(recipient_username)
+        parsed[i] = (recipient_username, amount_cents, description or f"Перевод пользователю @{recipient_username}")
+
+    ids = {}
+    if usernames:
+        marks = ','.join('?' * len(usernames))
+        rows = get_db().execute(f"SELECT id, username FROM users WHERE username IN ({marks})", list(usernames))
+        ids = {r["username"]: r["id"] for r in rows}
+
+    items, positions = [], []
+    for i, entry in enumerate(parsed):
+        if entry is None:
+            continue
+        recipient_username, amount_cents, description = entry
+        if recipient_username not in ids:
+            errors[i] = "Получатель не найден"
+        elif ids[recipient_username] == uid:
+            errors[i] = "Нельзя перевести средства самому себе"
+        else:
+            items.append((ids[recipient_username], amount_cents, description))
+            positions.append(i)
+
+    atomic = mode == 'atomic'
+    balance = None
+    if items and not (atomic and any(errors)):
+        try:
+            item_errors, balance = transfer_batch(uid, items, atomic=atomic)
+        except ValueError as e:
+            return jsonify(ok=False, error=str(e)), 400
+        for i, err in zip(positions, item_errors):
+            errors[i] = err
+
+    results = [{"ok": True} if err is None else {"ok": False, "error": err} for err in errors]
+    if atomic and any(errors):
+        return jsonify(ok=False, error="Пакет отклонён, ни один перевод не выполнен", results=results), 400
+    if balance is None:
+        balance = get_user_by_id(uid)["balance_cents"]
+    applied = sum(1 for err in errors if err is None)
+    return jsonify(ok=True, applied=applied, results=results, balance_cents=balance)
+
+@api.route('/qr/<int:invoice_id>.<fmt>', methods=['GET'])
+def qr_png(invoice_id, fmt):
+    # Public on purpose: the image only encodes PAY:<id>, and a CDN may cache it.
+    if fmt not in QR_MIMETYPES:
+        abort(404)
+    # Only real invoices get rendered (and stored), so ids cannot be used to fill the cache.
+    if get_db().execute("SELECT 1 FROM invoices WHERE id = ?", (invoice_id,)).fetchone() is None:
+        abort(404)
+    data, etag = get_qr_cache(app).get(f"PAY:{invoice_id}", fmt)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    headers["Content-Disposition"] = f"inline; filename=invoice_{invoice_id}.{fmt}"
+    return Response(data, mimetype=QR_MIMETYPES[fmt], headers=headers)
 
 app.register_blueprint(api)
 
@@ -554,6 +977,9 @@ try:
 except Exception:
     pass
 
+if app.config['METRICS_ENABLED']:
+    init_metrics(app)
+
 # -------------------------
 # Error handlers
 # -------------------------
@@ -563,6 +989,26 @@ def err_401(e):
         return jsonify(ok=False, error=getattr(e, 'description', "Unauthorized")), 401
     return redirect(url_for('web.index'))
 
+@app.errorhandler(HasherBusy)
+def err_hasher_busy(e):
+    headers = {"Retry-After": "1"}
+    if request.path.startswith('/api/'):
+        return jsonify(ok=False, error="Сервер перегружен, повторите попытку"), 503, headers
+    return "Сервер перегружен, повторите попытку", 503, headers
+
+@app.errorhandler(LedgerBusy)
+def err_ledger_busy(e):
+    headers = {"Retry-After": "1"}
+    if request.path.startswith('/api/'):
+        return jsonify(ok=False, error="База данных занята, повторите попытку"), 503, headers
+    return "База данных занята, повторите попытку", 503, headers
+
+@app.errorhandler(413)
+def err_413(e):
+    if request.path.startswith('/api/'):
+        return jsonify(ok=False, error="Слишком большой запрос"), 413
+    return "Слишком большой запрос", 413
+
 @app.errorhandler(404)
 def err_404(e):
     return jsonify(ok=False, error="Не найдено"), 404 if request.path.startswith('/api/') else ("Страница не найдена", 404)
@@ -576,5 +1022,5 @@ def err_400(e):
 # -------------------------
 if __name__ == '__main__':
     with app.app_context():
-        pass
+        init_db()
     app.run(debug=True)
\ No newline at end of file
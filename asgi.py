@@ -0,0 +1,239 @@
+"""ASGI entry point for LiBank.
+
+    uvicorn asgi:application --workers 1 --limit-concurrency 10000
+
+The event loop owns the sockets, so idle keep-alive connections and slow
+uploads cost no threads. Request bodies are read asynchronously, up to
+MAX_CONTENT_LENGTH, and spooled to disk past ASGI_BODY_SPOOL bytes; once a
+request is complete it is dispatched to the same Flask app, and therefore
+the same /api/* contracts, on a bounded executor that does all SQLite work.
+Password hashing already runs on its own pool (passwords.py), and QR images
+are rendered on the executor rather than the loop. /api/events is served
+natively on the loop, so idle listeners hold no thread at all.
+"""
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from flask import session
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from app import app
+from events import SSE_HEADERS, SSE_KEEPALIVE, SSE_PROLOGUE, format_sse, get_event_hub
+
+
+class ASGIApp:
+    """Serve a WSGI app over ASGI with at most ``workers`` requests in flight.
+
+    Each request runs start to finish on one executor thread, including the
+    response iterator, so Flask's context-locals and stream_with_context work
+    unchanged. Chunks are handed to the loop one at a time, which gives
+    streaming responses backpressure from the client.
+    """
+
+    def __init__(self, flask_app, workers=32):
+        self.app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asgi-db')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+        try:
+            body = await self._read_body(scope, receive, self.app.config.get('MAX_CONTENT_LENGTH'),
+                                         self.app.config.get('ASGI_BODY_SPOOL', 1024 * 1024))
+        except RequestEntityTooLarge:
+            return await self._too_large(scope, send)
+        if body is None:
+            return
+        try:
+            if scope['method'] == 'GET' and scope['path'] == '/api/events':
+                if await self._events(scope, body, receive, send):
+                    return
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self._handle, self._environ(scope, body), send, loop)
+        finally:
+            body.close()
+
+    async def run_sync(self, fn, *args):
+        """Run blocking (SQLite) work on the request executor from a coroutine."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Wait for in-flight requests off the loop, which still has to carry their responses.
+                await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _session_user(self, environ):
+        with self.app.request_context(environ):
+            return session.get('user_id')
+
+    async def _events(self, scope, body, receive, send):
+        """Same stream as app.api_events, without tying up an executor thread.
+
+        Returns False for an anonymous request so the Flask route can answer
+        with its usual 401.
+        """
+        environ = self._environ(scope, body)
+        uid = await self.run_sync(self._session_user, environ)
+        if not uid:
+            return False
+        last_id = environ.get('HTTP_LAST_EVENT_ID')
+        last_id = int(last_id) if last_id and last_id.isdigit() else None
+        keepalive = self.app.config.get('EVENTS_KEEPALIVE', 15)
+
+        sub = get_event_hub(self.app).subscribe(uid, last_id)
+        sub.bind_loop(asyncio.get_running_loop())
+        disconnected = asyncio.ensure_future(receive())
+        headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+        headers += [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in SSE_HEADERS.items()]
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': SSE_PROLOGUE.encode(), 'more_body': True})
+            while True:
+                sub.ready.clear()
+                events = sub.drain()
+                if events:
+                    chunk = ''.join(format_sse(event) for event in events)
+                    await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+                    continue
+                ready = asyncio.ensure_future(sub.ready.wait())
+                done, _ = await asyncio.wait({ready, disconnected}, timeout=keepalive,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if ready not in done:
+                    ready.cancel()
+                if disconnected in done:
+                    break
+                if not done:
+                    await send({'type': 'http.response.body', 'body': SSE_KEEPALIVE.encode(), 'more_body': True})
+        finally:
+            sub.close()
+            disconnected.cancel()
+        return True
+
+    @staticmethod
+    async def _read_body(scope, receive, limit, spool):
+        """The request body as a file positioned at 0, or None if the client left.
+
+        Raises RequestEntityTooLarge as soon as the declared or received
+        length passes ``limit``, without buffering the rest.
+        """
+        if limit is not None:
+            for name, value in scope.get('headers', []):
+                if name.lower() == b'content-length' and value.isdigit() and int(value) > limit:
+                    raise RequestEntityTooLarge()
+        body = SpooledTemporaryFile(max_size=spool)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    body.close()
+                    return None
+                body.write(message.get('body', b''))
+                if limit is not None and body.tell() > limit:
+                    raise RequestEntityTooLarge()
+                if not message.get('more_body', False):
+                    body.seek(0)
+                    return body
+        except BaseException:
+            body.close()
+            raise
+
+    @staticmethod
+    async def _too_large(scope, send):
+        # Answered from the loop: the unread rest of the body never reaches Flask.
+        if scope['path'].startswith('/api/'):
+            content_type = b'application/json'
+            payload = json.dumps({"ok": False, "error": "Слишком большой запрос"}, ensure_ascii=False).encode()
+        else:
+            content_type = b'text/plain; charset=utf-8'
+            payload = "Слишком большой запрос".encode()
+        await send({'type': 'http.response.start', 'status': 413,
+                    'headers': [(b'content-type', content_type), (b'connection', b'close'),
+                                (b'content-length', str(len(payload)).encode())]})
+        await send({'type': 'http.response.body', 'body': payload, 'more_body': False})
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        length = body.seek(0, 2)
+        body.seek(0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = name
+            else:
+                key = 'HTTP_' + name
+            if key == 'CONTENT_LENGTH':
+                continue
+            if key in environ:
+                value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+            environ[key] = value
+        return environ
+
+    def _handle(self, environ, send, loop):
+        response = {}
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return write
+
+        def ensure_started():
+            if not response.get('started'):
+                response['started'] = True
+                emit({'type': 'http.response.start', 'status': response['status'],
+                      'headers': response['headers']})
+
+        def write(chunk):
+            ensure_started()
+            emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        ensure_started()
+        emit({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+application = ASGIApp(app, workers=app.config.get('ASGI_WORKERS', 32))
@@ -0,0 +1,342 @@
+"""Load test for the LiBank API.
+
+Seeds a synthetic dataset into a temporary bank.sqlite3 and drives the app
+with concurrent workers, either in-process through Flask's test client or
+over HTTP against a local WSGI server. Prints a JSON report with latency
+percentiles, throughput, busy (503) responses, SQLite lock errors and the
+ledger's BEGIN IMMEDIATE wait per scenario.
+
+    python benchmark.py --users 1000 --transactions 100000 --requests 2000 --workers 8
+    python benchmark.py --driver http --scenarios transfer,pay --out bench.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.client import HTTPConnection
+
+from flask import got_request_exception
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from metrics import REGISTRY
+
+SCENARIOS = ('transfer', 'pay', 'transactions', 'export', 'qr')
+
+
+# -------------------------
+# Dataset
+# -------------------------
+def zipf_weights(n, s):
+    # A few accounts (merchants) take most of the traffic.
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def seed(app, users, transactions, invoices, skew, rng):
+    from app import init_db
+    from database import get_db
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        # One cheap hash for everyone: seeding should not be KDF-bound.
+        password_hash = generate_password_hash('Bench1234', 'pbkdf2:sha256:1000')
+        now = datetime.utcnow()
+        # The workload only touches what is seeded here: the demo users from
+        # init_db() have small balances and would turn into the hottest
+        # (lowest-id) accounts, failing pays with insufficient funds.
+        last_user, last_invoice = db.execute(
+            "SELECT (SELECT coalesce(MAX(id), 0) FROM users), (SELECT coalesce(MAX(id), 0) FROM invoices)").fetchone()
+        db.executemany(
+            "INSERT INTO users (username, password_hash, first_name, last_name, birth_date, balance_cents, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((f'user{i}', password_hash, 'Bench', f'User{i}', '1990-01-01', 10 ** 12,
+              (now - timedelta(days=rng.randint(0, 365))).isoformat()) for i in range(users))
+        )
+        usernames = dict(db.execute("SELECT id, username FROM users WHERE id > ? ORDER BY id", (last_user,)).fetchall())
+        ids = list(usernames)
+        weights = zipf_weights(len(ids), skew)
+
+        start = now - timedelta(days=365)
+        step = timedelta(days=365) / max(transactions, 1)
+        batch = []
+        for n in range(transactions // 2):
+            payer, recipient = rng.choices(ids, cum_weights=weights, k=2)
+            if payer == recipient:
+                recipient = ids[(ids.index(recipient) + 1) % len(ids)]
+            ts = (start + step * 2 * n).isoformat()
+            amount = rng.randint(100, 500000)
+            description = f"Payment #{n}"
+            batch.append((payer, 'debit', amount, description, recipient, None, ts))
+            batch.append((recipient, 'credit', amount, description, payer, None, ts))
+            if len(batch) >= 10000:
+                _insert_transactions(db, batch)
+                batch = []
+        _insert_transactions(db, batch)
+
+        db.executemany(
+            "INSERT INTO invoices (creator_id, amount_cents, description, status, created_at) VALUES (?, ?, ?, 'pending', ?)",
+            ((rng.choices(ids, cum_weights=weights)[0], rng.randint(100, 10000), 'Bench invoice', now.isoformat())
+             for _ in range(invoices))
+        )
+        db.commit()
+        invoice_rows = db.execute("SELECT id, creator_id FROM invoices WHERE id > ? AND status = 'pending'",
+                                  (last_invoice,)).fetchall()
+    return usernames, weights, [(r[0], r[1]) for r in invoice_rows]
+
+
+def _insert_transactions(db, rows):
+    db.executemany("""
+        INSERT INTO transactions (user_id, type, amount_cents, description, counterparty_id, invoice_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    db.commit()
+
+
+# -------------------------
+# Drivers
+# -------------------------
+class ClientDriver:
+    """In-process requests through Flask's test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        resp = self.client.open(path, method=method, json=body)
+        resp.get_data()
+        return resp.status_code
+
+
+class HTTPDriver:
+    """Real HTTP over a keep-alive connection to the local server."""
+
+    def __init__(self, port):
+        self.conn = HTTPConnection('127.0.0.1', port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        payload = json.dumps(body) if body is not None else None
+        self.conn.request(method, path, body=payload, headers=headers)
+        resp = self.conn.getresponse()
+        resp.read()
+        set_cookie = resp.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';', 1)[0]
+        return resp.status
+
+
+# -------------------------
+# Scenarios
+# -------------------------
+class Workload:
+    def __init__(self, usernames, weights, invoices, rng):
+        self.usernames = usernames
+        self.ids = list(usernames)
+        self.weights = weights
+        self._invoices = iter(invoices)
+        self.invoice_ids = [invoice_id for invoice_id, _ in invoices]
+        self._lock = threading.Lock()
+        self.rng = rng
+
+    def pick_user(self):
+        with self._lock:
+            return self.rng.choices(self.ids, cum_weights=self.weights)[0]
+
+    def next_invoice(self):
+        with self._lock:
+            return next(self._invoices, None)
+
+    def next_request(self, scenario, driver, state):
+        """Return the (method, path, body) to time next, or None when done.
+
+        Setup such as switching the logged-in payer happens here, untimed.
+        """
+        uid = state['uid']
+        if scenario == 'transfer':
+            recipient = self.pick_user()
+            if recipient == uid:
+                recipient = self.ids[0] if uid != self.ids[0] else self.ids[1]
+            return 'POST', '/api/transfer', {'recipient_username': self.usernames[recipient], 'amount': '0.01'}
+        if scenario == 'pay':
+            invoice = self.next_invoice()
+            if invoice is None:
+                return None
+            invoice_id, creator_id = invoice
+            if uid == creator_id:
+                state['uid'] = next(i for i in self.ids if i != creator_id)
+                driver.request('POST', '/api/login_by_id', {'user_id': state['uid']})
+            return 'POST', '/api/pay', {'invoice_id': invoice_id}
+        if scenario == 'transactions':
+            return 'GET', '/api/transactions?limit=50', None
+        if scenario == 'export':
+            return 'GET', '/api/transactions/export', None
+        if scenario == 'qr':
+            with self._lock:
+                invoice_id = self.rng.choice(self.invoice_ids)
+            return 'GET', f'/api/qr/{invoice_id}.png', None
+        raise ValueError(scenario)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    # Nearest-rank on an already sorted list.
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def histogram_summary(hist):
+    """Count, mean and the bucket bound under which 95% of the observations fall."""
+    if not hist.count:
+        return {"count": 0, "mean_ms": None, "p95_le_ms": None}
+    cumulative = 0
+    p95 = None
+    for bound, n in zip(hist.buckets, hist.counts):
+        cumulative += n
+        if cumulative >= 0.95 * hist.count:
+            p95 = round(bound * 1000, 3)
+            break
+    return {"count": hist.count, "mean_ms": round(hist.sum / hist.count * 1000, 3), "p95_le_ms": p95}
+
+
+def run_scenario(scenario, make_driver, workload, total, workers, lock_errors):
+
+    latencies = []
+    statuses = {}
+    remaining = iter(range(total))
+    guard = threading.Lock()
+    errors_before = lock_errors[0]
+    REGISTRY.reset()
+
+    def worker():
+        driver = make_driver()
+        state = {'uid': workload.pick_user()}
+        driver.request('POST', '/api/login_by_id', {'user_id': state['uid']})
+        local = []
+        while True:
+            with guard:
+                if next(remaining, None) is None:
+                    break
+            req = workload.next_request(scenario, driver, state)
+            if req is None:
+                break
+            t0 = time.perf_counter()
+            status = driver.request(*req)
+            local.append(time.perf_counter() - t0)
+            with guard:
+                statuses[status] = statuses.get(status, 0) + 1
+        with guard:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "requests": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        # LedgerBusy and HasherBusy are answered with 503 by their own errorhandlers.
+        "busy_responses": statuses.get(503, 0),
+        "sqlite_lock_errors": lock_errors[0] - errors_before,
+        "ledger_lock_wait": histogram_summary(REGISTRY.lock_wait),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent for account activity')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--driver', choices=('client', 'http'), default='client')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='dataset path (default: a temp bank.sqlite3)')
+    parser.add_argument('--out', help='write the JSON report here as well as stdout')
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='libank-bench-'), 'bank.sqlite3')
+    from app import app
+    app.config['DB_PATH'] = db_path
+
+    # Records ledger lock waits without LIBANK_METRICS' per-request hooks.
+    REGISTRY.enabled = True
+
+    rng = random.Random(args.seed)
+    t0 = time.perf_counter()
+    usernames, weights, invoices = seed(app, args.users, args.transactions,
+                                  args.requests if {'pay', 'qr'} & set(scenarios) else 0, args.skew, rng)
+    seed_s = time.perf_counter() - t0
+    workload = Workload(usernames, weights, invoices, rng)
+
+    lock_errors = [0]
+
+    def count_lock_errors(sender, exception, **extra):
+        if isinstance(exception, sqlite3.OperationalError) and 'locked' in str(exception):
+            lock_errors[0] += 1
+
+    got_request_exception.connect(count_lock_errors, app)
+
+    server = None
+    if args.driver == 'http':
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        make_driver = lambda: HTTPDriver(server.server_port)
+    else:
+        make_driver = lambda: ClientDriver(app)
+
+    report = {
+        "driver": args.driver,
+        "workers": args.workers,
+        "dataset": {"users": args.users, "transactions": args.transactions,
+                    "skew": args.skew, "seed_s": round(seed_s, 2), "db_path": db_path},
+        "sqlite_version": sqlite3.sqlite_version,
+        "scenarios": {},
+    }
+    try:
+        for scenario in scenarios:
+            report["scenarios"][scenario] = run_scenario(
+                scenario, make_driver, workload, args.requests, args.workers, lock_errors)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
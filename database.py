@@ -0,0 +1,551 @@
+import sqlite3
+import threading
+import weakref
+
+from flask import current_app, g
+
+from metrics import InstrumentedConnection
+
+# -------------------------
+# Connection pool
+# -------------------------
+# Connections are opened once with this PRAGMA profile and reused across
+# requests. Override per app with app.config['SQLITE_PRAGMAS'].
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+class TrackedConnection(sqlite3.Connection):
+    """Remembers the cursors it hands out so the pool can reset them.
+
+    sqlite3 does not reset cursors on rollback(), and a half-read cursor
+    keeps its statement, and so a WAL read snapshot, open: the next user of
+    the connection would fail its first write with SQLITE_BUSY_SNAPSHOT.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = weakref.WeakSet()
+
+    def cursor(self, *args, **kwargs):
+        cur = super().cursor(*args, **kwargs)
+        self._cursors.add(cur)
+        return cur
+
+    # The C implementations of these bypass cursor().
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def reset(self):
+        """Close every cursor still open and end any transaction."""
+        for cur in list(self._cursors):
+            cur.close()
+        self.rollback()
+
+
+_tracked_factories = {}
+
+
+def tracked(factory):
+    """``factory`` (a Connection subclass) with TrackedConnection mixed in."""
+    if issubclass(factory, TrackedConnection):
+        return factory
+    if factory is sqlite3.Connection:
+        return TrackedConnection
+    cls = _tracked_factories.get(factory)
+    if cls is None:
+        cls = _tracked_factories.setdefault(
+            factory, type('Tracked' + factory.__name__, (factory, TrackedConnection), {}))
+    return cls
+
+
+class ConnectionPool:
+    """Pool of pre-tuned connections. A request checks one out for its whole
+    lifetime, so a connection is only ever used by one thread at a time.
+    Connections come back reset (no open cursors or transaction); one that
+    cannot be reset is closed instead of pooled."""
+
+    def __init__(self, path, pragmas=None, cached_statements=256, max_idle=16,
+                 factory=sqlite3.Connection, attach=None):
+        self.path = path
+        self.factory = tracked(factory)
+        # {schema name: path} attached to every connection, e.g. a shard's directory.
+        self.attach = dict(attach or {})
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.cached_statements = cached_statements
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, factory=self.factory,
+                             cached_statements=self.cached_statements)
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            db.execute(f"PRAGMA {name} = {value}")
+        for name, path in self.attach.items():
+            db.execute("ATTACH DATABASE ? AS " + name, (path,))
+        return db
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, db):
+        try:
+            db.reset()
+        except sqlite3.Error:
+            db.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(db)
+                return
+        db.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            db.close()
+
+
+_pool_lock = threading.Lock()
+
+
+def get_pool(app):
+    path = app.config['DB_PATH']
+    pool = app.extensions.get('sqlite_pool')
+    if pool is None or pool.path != path:
+        with _pool_lock:
+            pool = app.extensions.get('sqlite_pool')
+            if pool is None or pool.path != path:
+                pool = ConnectionPool(
+                    path,
+                    pragmas=app.config.get('SQLITE_PRAGMAS'),
+                    cached_statements=app.config.get('SQLITE_CACHED_STATEMENTS', 256),
+                    max_idle=app.config.get('SQLITE_POOL_SIZE', 16),
+                    # Timing every statement is opt-in; see metrics.init_metrics().
+                    factory=InstrumentedConnection if app.config.get('METRICS_ENABLED') else sqlite3.Connection,
+                )
+                app.extensions['sqlite_pool'] = pool
+    return pool
+
+
+def get_db():
+    db = getattr(g, '_db', None)
+    if db is None:
+        db = get_pool(current_app).acquire()
+        g._db = db
+    return db
+
+
+def close_db(exception=None):
+    db = g.pop('_db', None)
+    if db is not None:
+        get_pool(current_app).release(db)
+
+
+# -------------------------
+# Schema migrations
+# -------------------------
+# Each entry is (version, step). A step is either an SQL script or a callable
+# taking the connection. Applied versions are tracked in PRAGMA user_version,
+# so a migration runs exactly once per database file. Never edit an applied
+# migration: append a new one instead.
+MIGRATIONS = [
+    (1, """
+    CREATE TABLE IF NOT EXISTS users (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      username TEXT UNIQUE NOT NULL,
+      password_hash TEXT NOT NULL,
+      first_name TEXT,
+      last_name TEXT,
+      patronymic TEXT,
+      birth_date TEXT,
+      balance_cents INTEGER NOT NULL DEFAULT 0,
+      created_at TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS transactions (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      type TEXT CHECK(type IN ('debit','credit')) NOT NULL,
+      amount_cents INTEGER NOT NULL,
+      description TEXT,
+      counterparty_id INTEGER,
+      invoice_id INTEGER,
+      created_at TEXT NOT NULL,
+      FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS invoices (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      creator_id INTEGER NOT NULL,
+      amount_cents INTEGER NOT NULL,
+      description TEXT,
+      status TEXT CHECK(status IN ('pending','paid','cancelled')) NOT NULL DEFAULT 'pending',
+      created_at TEXT NOT NULL,
+      paid_by INTEGER,
+      paid_at TEXT,
+      FOREIGN KEY(creator_id) REFERENCES users(id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_trans_user ON transactions(user_id);
+    CREATE INDEX IF NOT EXISTS idx_inv_status ON invoices(status);
+    """),
+    # Keyset pagination of a user's history walks this index backwards.
+    # It also covers plain user_id lookups, so the old index goes.
+    (2, """
+    CREATE INDEX IF NOT EXISTS idx_trans_user_created ON transactions(user_id, created_at, id);
+    DROP INDEX IF EXISTS idx_trans_user;
+    """),
+    (3, lambda db: _create_search_index(db)),
+    # Per-user aggregates for /api/transactions/summary, kept current by triggers.
+    (4, lambda db: _create_summaries(db)),
+    # Admin listing filters, plus header counters kept current by triggers.
+    (5, """
+    CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance_cents);
+    CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at);
+
+    CREATE TABLE IF NOT EXISTS user_stats (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      users_count INTEGER NOT NULL,
+      total_balance_cents INTEGER NOT NULL
+    );
+    INSERT OR REPLACE INTO user_stats (id, users_count, total_balance_cents)
+    SELECT 1, COUNT(*), coalesce(SUM(balance_cents), 0) FROM users;
+
+    CREATE TRIGGER IF NOT EXISTS user_stats_ai AFTER INSERT ON users BEGIN
+      UPDATE user_stats SET users_count = users_count + 1,
+        total_balance_cents = total_balance_cents + new.balance_cents WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS user_stats_ad AFTER DELETE ON users BEGIN
+      UPDATE user_stats SET users_count = users_count - 1,
+        total_balance_cents = total_balance_cents - old.balance_cents WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS user_stats_au AFTER UPDATE OF balance_cents ON users
+    WHEN new.balance_cents != old.balance_cents BEGIN
+      UPDATE user_stats SET total_balance_cents = total_balance_cents + new.balance_cents - old.balance_cents
+      WHERE id = 1;
+    END;
+    """),
+    # Responses of Idempotency-Key requests, written with the ledger rows.
+    (6, lambda db: _run_script(db, IDEMPOTENCY_SCHEMA)),
+    # Per-user reconciliation checkpoints (reconcile.py).
+    (7, lambda db: _run_script(db, RECONCILE_SCHEMA)),
+    # Append-only ledger mode (snapshots.py): reversal links, balance
+    # snapshots, and the ledger position the mode started from.
+    (8, """
+    ALTER TABLE transactions ADD COLUMN reversal_of INTEGER;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_trans_reversal ON transactions(reversal_of) WHERE reversal_of IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+      user_id INTEGER NOT NULL,
+      through_id INTEGER NOT NULL,
+      balance_cents INTEGER NOT NULL,
+      taken_at TEXT NOT NULL,
+      PRIMARY KEY (user_id, through_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS ledger_mode (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      append_only_since INTEGER NOT NULL,
+      compacted_through INTEGER NOT NULL
+    );
+    """),
+    (9, lambda db: _run_script(db, SESSION_SCHEMA)),
+]
+
+IDEMPOTENCY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+      user_id INTEGER NOT NULL,
+      key TEXT NOT NULL,
+      endpoint TEXT NOT NULL,
+      request_hash TEXT NOT NULL,
+      status INTEGER NOT NULL,
+      response TEXT NOT NULL,
+      created_at TEXT NOT NULL,
+      PRIMARY KEY (user_id, key)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at);
+"""
+
+# Server-side sessions (sessions.py). token_hash is the SHA-256 of the
+# cookie; data is the session dict as JSON; expires_at is epoch seconds.
+SESSION_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+      token_hash TEXT PRIMARY KEY,
+      user_id INTEGER,
+      data TEXT NOT NULL,
+      expires_at REAL NOT NULL,
+      created_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id) WHERE user_id IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
+"""
+
+# ledger_cents is the net of the user's ledger rows up to verified_through;
+# opening_cents is the part of the balance the ledger never explained (seed
+# and welcome balances) when the user was first checked. Deleting a ledger
+# row adjusts ledger_cents and bumps revision, so a scan that raced with the
+# delete knows not to overwrite the checkpoint.
+RECONCILE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reconcile_checkpoints (
+      user_id INTEGER PRIMARY KEY,
+      verified_through INTEGER NOT NULL,
+      ledger_cents INTEGER NOT NULL,
+      opening_cents INTEGER NOT NULL,
+      balance_cents INTEGER NOT NULL,
+      drift_cents INTEGER NOT NULL,
+      revision INTEGER NOT NULL DEFAULT 0,
+      checked_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_reconcile_drift ON reconcile_checkpoints(user_id) WHERE drift_cents != 0;
+
+    CREATE TRIGGER IF NOT EXISTS reconcile_ad AFTER DELETE ON transactions BEGIN
+      UPDATE reconcile_checkpoints SET
+        revision = revision + 1,
+        ledger_cents = ledger_cents - (old.id <= verified_through)
+          * (CASE old.type WHEN 'credit' THEN old.amount_cents ELSE -old.amount_cents END)
+      WHERE user_id = old.user_id;
+    END;
+"""
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(db) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db, migrations=None) -> int:
+    """Apply pending migrations, each in its own write transaction."""
+    current = schema_version(db)
+    for version, step in migrations or MIGRATIONS:
+        if version <= current:
+            continue
+        if db.in_transaction:
+            db.commit()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if callable(step):
+                step(db)
+            else:
+                _run_script(db, step)
+            db.execute(f"PRAGMA user_version = {int(version)}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        current = version
+    return current
+
+
+# Summary tables are updated by triggers in the same transaction as every
+# ledger write, so the summary endpoint reads O(days) rows, not O(transactions).
+SUMMARIES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS daily_totals (
+      user_id INTEGER NOT NULL,
+      day TEXT NOT NULL,
+      in_cents INTEGER NOT NULL DEFAULT 0,
+      out_cents INTEGER NOT NULL DEFAULT 0,
+      in_count INTEGER NOT NULL DEFAULT 0,
+      out_count INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS counterparty_totals (
+      user_id INTEGER NOT NULL,
+      counterparty_id INTEGER NOT NULL,
+      in_cents INTEGER NOT NULL DEFAULT 0,
+      out_cents INTEGER NOT NULL DEFAULT 0,
+      tx_count INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (user_id, counterparty_id)
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS summaries_ai AFTER INSERT ON transactions BEGIN
+      INSERT INTO daily_totals (user_id, day, in_cents, out_cents, in_count, out_count)
+      VALUES (new.user_id, substr(new.created_at, 1, 10),
+              (new.type = 'credit') * new.amount_cents, (new.type = 'debit') * new.amount_cents,
+              new.type = 'credit', new.type = 'debit')
+      ON CONFLICT (user_id, day) DO UPDATE SET
+        in_cents = in_cents + excluded.in_cents, out_cents = out_cents + excluded.out_cents,
+        in_count = in_count + excluded.in_count, out_count = out_count + excluded.out_count;
+      INSERT INTO counterparty_totals (user_id, counterparty_id, in_cents, out_cents, tx_count)
+      SELECT new.user_id, new.counterparty_id,
+             (new.type = 'credit') * new.amount_cents, (new.type = 'debit') * new.amount_cents, 1
+      WHERE new.counterparty_id IS NOT NULL
+      ON CONFLICT (user_id, counterparty_id) DO UPDATE SET
+        in_cents = in_cents + excluded.in_cents, out_cents = out_cents + excluded.out_cents,
+        tx_count = tx_count + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS summaries_ad AFTER DELETE ON transactions BEGIN
+      UPDATE daily_totals SET
+        in_cents = in_cents - (old.type = 'credit') * old.amount_cents,
+        out_cents = out_cents - (old.type = 'debit') * old.amount_cents,
+        in_count = in_count - (old.type = 'credit'),
+        out_count = out_count - (old.type = 'debit')
+      WHERE user_id = old.user_id AND day = substr(old.created_at, 1, 10);
+      UPDATE counterparty_totals SET
+        in_cents = in_cents - (old.type = 'credit') * old.amount_cents,
+        out_cents = out_cents - (old.type = 'debit') * old.amount_cents,
+        tx_count = tx_count - 1
+      WHERE user_id = old.user_id AND counterparty_id = old.counterparty_id;
+    END;
+"""
+
+SUMMARIES_BACKFILL = """
+    INSERT INTO daily_totals (user_id, day, in_cents, out_cents, in_count, out_count)
+    SELECT user_id, substr(created_at, 1, 10),
+           SUM((type = 'credit') * amount_cents), SUM((type = 'debit') * amount_cents),
+           SUM(type = 'credit'), SUM(type = 'debit')
+    FROM transactions GROUP BY 1, 2;
+
+    INSERT INTO counterparty_totals (user_id, counterparty_id, in_cents, out_cents, tx_count)
+    SELECT user_id, counterparty_id,
+           SUM((type = 'credit') * amount_cents), SUM((type = 'debit') * amount_cents), COUNT(*)
+    FROM transactions WHERE counterparty_id IS NOT NULL GROUP BY 1, 2;
+"""
+
+
+def _create_summaries(db):
+    _run_script(db, SUMMARIES_SCHEMA + SUMMARIES_BACKFILL)
+
+
+def rebuild_summaries(db):
+    """Recompute the summary tables from the ledger, e.g. after a bulk fix-up."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM daily_totals")
+        db.execute("DELETE FROM counterparty_totals")
+        for statement in _split_script(SUMMARIES_BACKFILL):
+            db.execute(statement)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+# The same aggregates, added onto the existing totals, for ledger rows with
+# id > :after_id. Used after a bulk load that ran with the triggers dropped.
+SUMMARIES_BACKFILL_AFTER = """
+    INSERT INTO daily_totals (user_id, day, in_cents, out_cents, in_count, out_count)
+    SELECT user_id, substr(created_at, 1, 10),
+           SUM((type = 'credit') * amount_cents), SUM((type = 'debit') * amount_cents),
+           SUM(type = 'credit'), SUM(type = 'debit')
+    FROM transactions WHERE id > :after_id GROUP BY 1, 2
+    ON CONFLICT (user_id, day) DO UPDATE SET
+      in_cents = in_cents + excluded.in_cents, out_cents = out_cents + excluded.out_cents,
+      in_count = in_count + excluded.in_count, out_count = out_count + excluded.out_count;
+
+    INSERT INTO counterparty_totals (user_id, counterparty_id, in_cents, out_cents, tx_count)
+    SELECT user_id, counterparty_id,
+           SUM((type = 'credit') * amount_cents), SUM((type = 'debit') * amount_cents), COUNT(*)
+    FROM transactions WHERE id > :after_id AND counterparty_id IS NOT NULL GROUP BY 1, 2
+    ON CONFLICT (user_id, counterparty_id) DO UPDATE SET
+      in_cents = in_cents + excluded.in_cents, out_cents = out_cents + excluded.out_cents,
+      tx_count = tx_count + excluded.tx_count;
+"""
+
+
+def backfill_derived(db, after_id):
+    """Bring the summary tables and the FTS index up to date with ledger rows
+    past ``after_id`` that were inserted while their triggers were dropped."""
+    for statement in _split_script(SUMMARIES_BACKFILL_AFTER):
+        db.execute(statement, {"after_id": after_id})
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions_fts'").fetchone():
+        db.execute("""
+            INSERT INTO transactions_fts (rowid, owner, description, counterparty)
+            SELECT t.id, 'u' || t.user_id, coalesce(t.description, ''), coalesce(u.username, '')
+            FROM transactions t LEFT JOIN users u ON u.id = t.counterparty_id
+            WHERE t.id > ?
+        """, (after_id,))
+
+
+def fts5_supported(db) -> bool:
+    try:
+        db.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    db.execute("DROP TABLE temp._fts5_probe")
+    return True
+
+
+def _create_search_index(db):
+    # Full-text index over transaction descriptions and counterparty usernames.
+    # 'owner' holds a u<user_id> token so a MATCH can be restricted to one user.
+    # Triggers keep it in sync with every writer, app and admin alike. Without
+    # FTS5 the migration is a no-op and search falls back to LIKE.
+    if not fts5_supported(db):
+        return
+    for statement in _split_script("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+      owner, description, counterparty,
+      tokenize = 'unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_ai AFTER INSERT ON transactions BEGIN
+      INSERT INTO transactions_fts (rowid, owner, description, counterparty)
+      VALUES (new.id, 'u' || new.user_id, coalesce(new.description, ''),
+              coalesce((SELECT username FROM users WHERE id = new.counterparty_id), ''));
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_ad AFTER DELETE ON transactions BEGIN
+      DELETE FROM transactions_fts WHERE rowid = old.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_au
+    AFTER UPDATE OF user_id, description, counterparty_id ON transactions BEGIN
+      UPDATE transactions_fts SET
+        owner = 'u' || new.user_id,
+        description = coalesce(new.description, ''),
+        counterparty = coalesce((SELECT username FROM users WHERE id = new.counterparty_id), '')
+      WHERE rowid = new.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username ON users BEGIN
+      UPDATE transactions_fts SET counterparty = new.username
+      WHERE rowid IN (SELECT id FROM transactions WHERE counterparty_id = new.id);
+    END;
+
+    INSERT INTO transactions_fts (rowid, owner, description, counterparty)
+    SELECT t.id, 'u' || t.user_id, coalesce(t.description, ''), coalesce(u.username, '')
+    FROM transactions t LEFT JOIN users u ON u.id = t.counterparty_id;
+    """):
+        db.execute(statement)
+
+
+def _run_script(db, script):
+    for statement in _split_script(script):
+        db.execute(statement)
+
+
+def _split_script(script):
+    # executescript() would commit our transaction, so run statement by statement.
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            if statement.strip():
+                yield statement
+            statement = ''
+    if statement.strip():
+        yield statement
@@ -0,0 +1,125 @@
+import asyncio
+import itertools
+import json
+import threading
+from collections import deque
+
+from flask import current_app
+
+from response_cache import get_response_cache
+
+# Wire format shared by the WSGI route and the native ASGI handler.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+SSE_PROLOGUE = "retry: 3000\n\n"
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+
+def format_sse(event) -> str:
+    seq, name, data = event
+    return f"id: {seq}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """Pending events for one listener, bounded: a stalled client loses the
+    oldest events rather than growing memory. Events are state snapshots,
+    so the newest one is always enough to catch up."""
+
+    def __init__(self, hub, user_id, max_pending):
+        self.hub = hub
+        self.user_id = user_id
+        self._events = deque(maxlen=max_pending)
+        self._cond = threading.Condition()
+        self._loop = None
+        self.ready = None
+
+    def bind_loop(self, loop):
+        """Also wake an asyncio waiter (``self.ready``) on every push."""
+        ready = asyncio.Event()
+        # push() runs on writer threads; it reads both under the same lock.
+        with self._cond:
+            self.ready = ready
+            self._loop = loop
+
+    def push(self, event):
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify()
+            loop, ready = self._loop, self.ready
+        if loop is not None:
+            loop.call_soon_threadsafe(ready.set)
+
+    def drain(self):
+        with self._cond:
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+    def get(self, timeout):
+        """Block up to ``timeout`` seconds; return the pending events (maybe none)."""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+        return self.drain()
+
+    def close(self):
+        self.hub._unsubscribe(self)
+
+
+class EventHub:
+    """In-process pub/sub of per-user events.
+
+    Write paths publish ``balance`` ({balance_cents}, or {} when only the
+    fact of a change is known) and ``invoice`` ({id, status, paid_by,
+    paid_at}) events after their transaction commits. A short global history
+    lets a reconnecting client resume from its Last-Event-ID.
+    """
+
+    def __init__(self, history=1024, max_pending=100):
+        self.max_pending = max_pending
+        self._subscribers = {}
+        self._history = deque(maxlen=history)
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def publish(self, user_id, name, data):
+        with self._lock:
+            event = (next(self._seq), name, data)
+            self._history.append((user_id, event))
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for sub in subscribers:
+            sub.push(event)
+
+    def subscribe(self, user_id, last_event_id=None) -> Subscription:
+        sub = Subscription(self, user_id, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(sub)
+            if last_event_id is not None:
+                for owner, event in self._history:
+                    if owner == user_id and event[0] > last_event_id:
+                        sub.push(event)
+        return sub
+
+    def _unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.user_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.user_id]
+
+
+def get_event_hub(app) -> EventHub:
+    hub = app.extensions.get('event_hub')
+    if hub is None:
+        hub = app.extensions.setdefault('event_hub', EventHub(
+            history=app.config.get('EVENTS_HISTORY', 1024),
+        ))
+    return hub
+
+
+def publish(user_id, name, data):
+    cache = get_response_cache(current_app)
+    cache.bump(('user', user_id))
+    if name == 'invoice':
+        cache.bump(('invoice', data["id"]))
+    get_event_hub(current_app).publish(user_id, name, data)
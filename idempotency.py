@@ -0,0 +1,125 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+MAX_KEY_LENGTH = 255
+
+
+class KeyMismatch(Exception):
+    """The key was already used for a request with a different body."""
+
+
+class KeyRecorded(Exception):
+    """A concurrent request with the same key committed first."""
+
+
+class IdempotencyCache:
+    """Bounded LRU of committed responses keyed by (user_id, key).
+
+    Only filled after the ledger transaction is durable, so a hit is always
+    a response the client could have received.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is not None:
+                self._entries.move_to_end((user_id, key))
+            return entry
+
+    def put(self, user_id, key, entry):
+        with self._lock:
+            self._entries[(user_id, key)] = entry
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def get_idempotency_cache(app) -> IdempotencyCache:
+    cache = app.extensions.get('idempotency_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('idempotency_cache', IdempotencyCache(
+            max_entries=app.config.get('IDEMPOTENCY_CACHE_SIZE', 10000),
+        ))
+    return cache
+
+
+class IdempotentRequest:
+    """One keyed request. ``render`` turns the payer's new balance into the
+    success body; record() stores it inside the ledger transaction."""
+
+    def __init__(self, user_id, key, endpoint, request_hash, render):
+        self.user_id = user_id
+        self.key = key
+        self.endpoint = endpoint
+        self.request_hash = request_hash
+        self.render = render
+        self.response = None
+
+    def lookup(self, db):
+        """Return the stored (status, body) for a replay, or None for a new key.
+
+        Checks the in-memory cache, then the table; neither needs a write lock.
+        """
+        cache = get_idempotency_cache(current_app)
+        entry = cache.get(self.user_id, self.key)
+        if entry is None:
+            row = db.execute("""
+                SELECT endpoint, request_hash, status, response FROM idempotency_keys
+                WHERE user_id = ? AND key = ?
+            """, (self.user_id, self.key)).fetchone()
+            if row is None:
+                return None
+            entry = (row["endpoint"], row["request_hash"], row["status"], json.loads(row["response"]))
+            cache.put(self.user_id, self.key, entry)
+        endpoint, request_hash, status, body = entry
+        if (endpoint, request_hash) != (self.endpoint, self.request_hash):
+            raise KeyMismatch()
+        return status, body
+
+    def record(self, db, balance_cents, created_at):
+        self.response = self.render(balance_cents)
+        try:
+            db.execute("""
+                INSERT INTO idempotency_keys (user_id, key, endpoint, request_hash, status, response, created_at)
+                VALUES (?, ?, ?, ?, 200, ?, ?)
+            """, (self.user_id, self.key, self.endpoint, self.request_hash,
+                  json.dumps(self.response, ensure_ascii=False), created_at))
+        except sqlite3.IntegrityError:
+            raise KeyRecorded()
+
+    def remember(self):
+        """Publish the committed response to the front cache."""
+        get_idempotency_cache(current_app).put(
+            self.user_id, self.key, (self.endpoint, self.request_hash, 200, self.response))
+
+
+def from_request(user_id, data, render):
+    """Build an IdempotentRequest from the Idempotency-Key header, if any.
+
+    Raises ValueError for a malformed key.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError("Некорректный Idempotency-Key")
+    canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    request_hash = hashlib.sha256(f"{request.endpoint}\n{canonical}".encode()).hexdigest()
+    return IdempotentRequest(user_id, key, request.endpoint, request_hash, render)
+
+
+def prune(db, before_iso) -> int:
+    cur = db.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (before_iso,))
+    db.commit()
+    return cur.rowcount
@@ -0,0 +1,258 @@
+import csv
+from datetime import datetime
+from functools import partial
+from itertools import islice
+
+from flask import current_app
+
+from database import backfill_derived, get_db
+from events import publish
+from ledger import execute, now_iso
+from shards import get_shards
+from snapshots import append_only
+from user_cache import invalidate_users
+
+# The layout /api/transactions/export writes, plus an optional owner column
+# so that one file can carry the history of many accounts.
+IMPORT_COLUMNS = ('ID', 'Дата', 'Тип', 'Сумма (коп.)', 'Описание', 'Контрагент')
+OWNER_COLUMN = 'Владелец'
+IMPORT_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+# Accounts created on import cannot log in until an admin sets a password.
+UNUSABLE_PASSWORD = '!'
+
+_LOOKUP_BATCH = 900
+
+STAGING_SCHEMA = """
+    CREATE TEMP TABLE IF NOT EXISTS import_rows (
+      user_id INTEGER NOT NULL,
+      type TEXT NOT NULL,
+      amount_cents INTEGER NOT NULL,
+      description TEXT,
+      counterparty_id INTEGER,
+      created_at TEXT NOT NULL
+    )
+"""
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.users_created = 0
+        self.errors = []
+        self.error_count = 0
+        self.user_ids = set()
+
+    def reject(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "imported": self.imported,
+            "rejected": self.error_count,
+            "users_created": self.users_created,
+            "accounts": len(self.user_ids),
+            "errors": [{"line": line, "error": message} for line, message in self.errors],
+        }
+
+
+def _parse_header(header, default_owner):
+    header = tuple(name.strip() for name in header or ())
+    if header[:len(IMPORT_COLUMNS)] != IMPORT_COLUMNS or len(header) > len(IMPORT_COLUMNS) + 1:
+        raise ValueError(f"Ожидаются колонки: {', '.join(IMPORT_COLUMNS)}[, {OWNER_COLUMN}]")
+    if len(header) > len(IMPORT_COLUMNS) and header[-1] != OWNER_COLUMN:
+        raise ValueError(f"Неизвестная колонка: {header[-1]}")
+    has_owner = len(header) > len(IMPORT_COLUMNS)
+    if not has_owner and default_owner is None:
+        raise ValueError(f"Укажите владельца счёта или добавьте колонку {OWNER_COLUMN}")
+    return has_owner
+
+
+def _parse_row(fields, has_owner):
+    """Validate one CSV row; return (owner, type, amount, description, counterparty, created_at)."""
+    if len(fields) != len(IMPORT_COLUMNS) + has_owner:
+        raise ValueError("Неверное число колонок")
+    _, created_at, ttype, amount, description, counterparty = fields[:len(IMPORT_COLUMNS)]
+    owner = fields[-1].strip() if has_owner else ''
+    try:
+        created_at = datetime.fromisoformat(created_at.strip()).isoformat()
+    except ValueError:
+        raise ValueError("Некорректная дата")
+    ttype = ttype.strip()
+    if ttype not in ('debit', 'credit'):
+        raise ValueError("Неизвестный тип транзакции")
+    try:
+        amount_cents = int(amount.strip())
+    except ValueError:
+        raise ValueError("Некорректная сумма")
+    if amount_cents <= 0:
+        raise ValueError("Сумма должна быть положительной")
+    return owner, ttype, amount_cents, description or None, counterparty.strip(), created_at
+
+
+def _resolve(names, known):
+    """Look up usernames not yet in ``known`` (username -> id), in bounded IN lists."""
+    missing = [name for name in names if name not in known]
+    db = get_db()
+    for start in range(0, len(missing), _LOOKUP_BATCH):
+        batch = missing[start:start + _LOOKUP_BATCH]
+        marks = ','.join('?' * len(batch))
+        for r in db.execute(f"SELECT id, username FROM users WHERE username IN ({marks})", batch):
+            known[r["username"]] = r["id"]
+
+
+def _create_users(db, usernames):
+    ts = now_iso()
+    db.executemany(
+        "INSERT OR IGNORE INTO users (username, password_hash, balance_cents, created_at) VALUES (?, ?, 0, ?)",
+        [(name, UNUSABLE_PASSWORD, ts) for name in usernames])
+
+
+def _load_chunk(db, rows, table='users'):
+    """Insert staged rows and apply their net effect to balances, set-based.
+
+    ``table`` is 'balances' on a ledger shard, where accounts are adopted
+    from the directory first, as ledger writes do, and None in append-only
+    mode, where the rows themselves are the balance change.
+    """
+    db.execute(STAGING_SCHEMA)
+    db.execute("DELETE FROM temp.import_rows")
+    db.executemany("INSERT INTO temp.import_rows VALUES (?, ?, ?, ?, ?, ?)", rows)
+    if table == 'balances':
+        db.execute("""
+            INSERT OR IGNORE INTO balances (id, balance_cents)
+            SELECT id, balance_cents FROM directory.users WHERE id IN (SELECT user_id FROM temp.import_rows)
+        """)
+    db.execute("""
+        INSERT INTO transactions (user_id, type, amount_cents, description, counterparty_id, created_at)
+        SELECT user_id, type, amount_cents, description, counterparty_id, created_at
+        FROM temp.import_rows ORDER BY created_at
+    """)
+    # Imported history is taken as it was: a debit may leave the balance negative.
+    if table is not None:
+        db.execute(f"""
+            UPDATE {table} SET balance_cents = balance_cents + (
+              SELECT SUM(CASE type WHEN 'credit' THEN amount_cents ELSE -amount_cents END)
+              FROM temp.import_rows r WHERE r.user_id = {table}.id
+            )
+            WHERE id IN (SELECT user_id FROM temp.import_rows)
+        """)
+    db.execute("DELETE FROM temp.import_rows")
+    return len(rows)
+
+
+def _suspend_maintenance(db):
+    """Drop the indexes and triggers on transactions; return what restores them."""
+    objects = db.execute("""
+        SELECT type, name, sql FROM sqlite_master
+        WHERE tbl_name = 'transactions' AND type IN ('index', 'trigger') AND sql IS NOT NULL
+    """).fetchall()
+    for obj in objects:
+        db.execute(f"DROP {obj['type'].upper()} {obj['name']}")
+    last_id = db.execute("SELECT coalesce(MAX(id), 0) FROM transactions").fetchone()[0]
+    return [obj["sql"] for obj in objects], last_id
+
+
+def _restore_maintenance(db, suspended):
+    statements, last_id = suspended
+    for sql in statements:
+        db.execute(sql)
+    backfill_derived(db, last_id)
+
+
+def import_transactions(stream, owner=None, create_users=False, offline=False, dry_run=False,
+                        chunk_size=IMPORT_CHUNK_SIZE) -> ImportReport:
+    """Stream a CSV of ledger rows from ``stream`` (text) into the ledger.
+
+    Rows are validated and loaded ``chunk_size`` at a time, each chunk in
+    its own ledger transaction, so memory stays flat and the app keeps
+    serving in between. ``owner`` (a username) owns rows without an owner
+    column. Counterparties and owners must exist unless ``create_users``.
+    Invalid rows are skipped and reported; the import never writes the
+    mirrored row for the counterparty.
+
+    ``offline`` drops the indexes and triggers on transactions for the
+    duration and rebuilds them, with the summaries and FTS rows for the
+    new history, at the end: much faster for millions of rows, but only
+    safe while nothing else writes to the ledger.
+    """
+    report = ImportReport()
+    reader = csv.reader(stream)
+    has_owner = _parse_header(next(reader, None), owner)
+    shards = get_shards(current_app)
+    targets = [None] if shards is None else list(range(shards.count))
+    table = None if append_only(current_app) else 'users'
+    known = {}
+    # Physical line numbers, so quoted multi-line descriptions do not skew the report.
+    numbered = ((reader.line_num, fields) for fields in reader)
+
+    suspended = {}
+    try:
+        if offline and not dry_run:
+            for target in targets:
+                suspended[target] = execute(_suspend_maintenance, shard=target)
+        while True:
+            chunk = list(islice(numbered, chunk_size))
+            if not chunk:
+                break
+            report.rows += len(chunk)
+            parsed = []
+            for line, fields in chunk:
+                try:
+                    row = _parse_row(fields, has_owner)
+                except ValueError as e:
+                    report.reject(line, str(e))
+                    continue
+                if not row[0]:
+                    if owner is None:
+                        report.reject(line, "Не указан владелец")
+                        continue
+                    row = (owner,) + row[1:]
+                parsed.append((line, row))
+
+            names = {row[0] for _, row in parsed} | {row[4] for _, row in parsed if row[4]}
+            _resolve(names, known)
+            new_users = sorted(name for name in names if name not in known) if create_users else []
+            if new_users:
+                report.users_created += len(new_users)
+                if dry_run:
+                    known.update((name, 0) for name in new_users)
+                else:
+                    execute(partial(_create_users, usernames=new_users))
+                    _resolve(new_users, known)
+
+            by_target = {}
+            for line, (owner_name, ttype, amount_cents, description, counterparty, created_at) in parsed:
+                if owner_name not in known:
+                    report.reject(line, f"Пользователь не найден: {owner_name}")
+                    continue
+                if counterparty and counterparty not in known:
+                    report.reject(line, f"Контрагент не найден: {counterparty}")
+                    continue
+                user_id = known[owner_name]
+                target = None if shards is None else shards.shard_for(user_id)
+                by_target.setdefault(target, []).append(
+                    (user_id, ttype, amount_cents, description, known.get(counterparty), created_at))
+                report.user_ids.add(user_id)
+
+            for target, rows in by_target.items():
+                if dry_run:
+                    report.imported += len(rows)
+                    continue
+                report.imported += execute(
+                    partial(_load_chunk, rows=rows, table=table if target is None else 'balances'),
+                    shard=target)
+                if shards is not None:
+                    shards.mirror.mark(*{row[0] for row in rows})
+    finally:
+        for target, state in suspended.items():
+            execute(partial(_restore_maintenance, suspended=state), shard=target)
+        if report.user_ids and not dry_run:
+            invalidate_users(*report.user_ids)
+            for user_id in report.user_ids:
+                publish(user_id, 'balance', {})
+    return report
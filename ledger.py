@@ -0,0 +1,804 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+from functools import partial
+
+from flask import current_app
+
+from database import get_db, get_pool
+from events import publish
+from metrics import REGISTRY
+from response_cache import get_response_cache
+from shards import OUTBOX_COLUMNS, get_shards
+from snapshots import append_only, ledger_balance
+from user_cache import invalidate_users
+
+log = logging.getLogger(__name__)
+
+
+def now_iso():
+    return datetime.utcnow().isoformat()
+
+
+INSERT_TRANSACTION = """
+    INSERT INTO transactions (user_id, type, amount_cents, description, counterparty_id, invoice_id, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+class LedgerBusy(Exception):
+    """The ledger could not take the write lock in time; nothing was written."""
+
+
+# -------------------------
+# Group-commit writer
+# -------------------------
+class LedgerWriter:
+    """Single writer thread that applies ledger operations in groups.
+
+    Request handlers submit operations (callables taking a connection) and
+    wait on a future. The writer drains whatever is queued, runs each
+    operation inside its own savepoint of one shared transaction and
+    commits once, so one fsync covers the whole group. An operation that
+    raises is rolled back alone and its caller gets the exception.
+    """
+
+    def __init__(self, pool, max_batch=256):
+        self.pool = pool
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, future, time.perf_counter()))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        db = self.pool.acquire()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_group(db, batch)
+
+    def _commit_group(self, db, batch):
+        outcomes = []
+        try:
+            begin = time.perf_counter()
+            db.execute("BEGIN IMMEDIATE")
+            started = time.perf_counter()
+            REGISTRY.observe_lock_wait(started - begin)
+            for fn, future, queued in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                REGISTRY.observe_queue_wait(started - queued)
+                db.execute("SAVEPOINT ledger_op")
+                try:
+                    result = fn(db)
+                except Exception as e:
+                    db.execute("ROLLBACK TO ledger_op")
+                    db.execute("RELEASE ledger_op")
+                    outcomes.append((future, None, e))
+                else:
+                    db.execute("RELEASE ledger_op")
+                    outcomes.append((future, result, None))
+            db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            # Includes callers never reached, e.g. when BEGIN itself failed.
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # Callers only hear back once their writes are durable.
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_writer_lock = threading.Lock()
+
+
+def _pool_for(app, shard):
+    return get_pool(app) if shard is None else get_shards(app).pools[shard]
+
+
+def get_writer(app, shard=None):
+    """The group-commit writer of the main DB, or of one ledger shard."""
+    pool = _pool_for(app, shard)
+    writers = app.extensions.setdefault('ledger_writers', {})
+    writer = writers.get(shard)
+    if writer is None or writer.pool is not pool:
+        with _writer_lock:
+            writer = writers.get(shard)
+            if writer is None or writer.pool is not pool:
+                writer = LedgerWriter(pool, max_batch=app.config.get('LEDGER_MAX_BATCH', 256))
+                writers[shard] = writer
+    return writer
+
+
+def _is_locked(e):
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+
+def _run_inline(db, fn):
+    begin = time.perf_counter()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError as e:
+        if _is_locked(e):
+            raise LedgerBusy() from e
+        raise
+    REGISTRY.observe_lock_wait(time.perf_counter() - begin)
+    try:
+        result = fn(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
+
+def execute(fn, shard=None):
+    """Run a ledger operation in a write transaction and return its result.
+
+    ``shard`` selects a ledger shard instead of the main DB. Goes through
+    the group-commit writer unless LEDGER_GROUP_COMMIT is off, in which case
+    it runs on the request's own connection (or a pooled shard connection).
+    Raises LedgerBusy if the write lock could not be taken in time.
+    """
+    app = current_app._get_current_object()
+    if not app.config.get('LEDGER_GROUP_COMMIT', True):
+        if shard is None:
+            return _run_inline(get_db(), fn)
+        pool = _pool_for(app, shard)
+        db = pool.acquire()
+        try:
+            return _run_inline(db, fn)
+        finally:
+            pool.release(db)
+    future = get_writer(app, shard).submit(fn)
+    try:
+        return future.result(timeout=app.config.get('LEDGER_TIMEOUT', 30))
+    except FutureTimeout:
+        # Only a queued operation can be withdrawn; one already running
+        # will commit or fail, and its caller must hear which.
+        if future.cancel():
+            raise LedgerBusy()
+        return future.result()
+    except sqlite3.OperationalError as e:
+        if _is_locked(e):
+            raise LedgerBusy() from e
+        raise
+
+
+# -------------------------
+# Balance mutations
+# -------------------------
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def change_balance(db, user_id, delta, allow_overdraft=False, table='users') -> int:
+    """Add ``delta`` to a balance in one conditional UPDATE; return the new balance.
+
+    A debit only applies if it keeps the balance non-negative, so there is
+    no read-modify-write window. Raises ValueError if the user is missing
+    or funds are insufficient. ``table`` is 'balances' on a ledger shard.
+    """
+    sql = f"UPDATE {table} SET balance_cents = balance_cents + ? WHERE id = ?"
+    params = [delta, user_id]
+    if delta < 0 and not allow_overdraft:
+        sql += " AND balance_cents >= ?"
+        params.append(-delta)
+    if HAS_RETURNING:
+        rows = db.execute(sql + " RETURNING balance_cents", params).fetchall()
+        if rows:
+            return rows[0][0]
+    elif db.execute(sql, params).rowcount:
+        return db.execute(f"SELECT balance_cents FROM {table} WHERE id = ?", (user_id,)).fetchone()[0]
+
+    if db.execute(f"SELECT 1 FROM {table} WHERE id = ?", (user_id,)).fetchone() is None:
+        raise ValueError("Пользователь не найден")
+    raise ValueError("Недостаточно средств")
+
+
+def _append_change(db, user_id, delta, allow_overdraft=False) -> int:
+    """change_balance() for the append-only ledger: checks the derived
+    balance and returns it with ``delta`` applied, writing nothing. The
+    ledger row the caller inserts is the change."""
+    balance = ledger_balance(db, user_id)
+    if balance is None:
+        raise ValueError("Пользователь не найден")
+    if delta < 0 and not allow_overdraft and balance < -delta:
+        raise ValueError("Недостаточно средств")
+    return balance + delta
+
+
+# -------------------------
+# Operations
+# -------------------------
+def _transfer(db, payer_id, recipient_id, amount_cents, description, invoice_id=None, change=change_balance):
+    new_payer_balance = change(db, payer_id, -amount_cents)
+    new_recipient_balance = change(db, recipient_id, amount_cents)
+
+    ts = now_iso()
+    db.executemany(INSERT_TRANSACTION, [
+        (payer_id, 'debit', amount_cents, description, recipient_id, invoice_id, ts),
+        (recipient_id, 'credit', amount_cents, description, payer_id, invoice_id, ts),
+    ])
+    return new_payer_balance, new_recipient_balance
+
+
+def _pay_invoice(db, payer_id, invoice_id, change=change_balance):
+    # Claim the invoice first: of two concurrent payers only one matches 'pending'.
+    claim = """
+        UPDATE invoices SET status = 'paid', paid_by = ?, paid_at = ?
+        WHERE id = ? AND status = 'pending' AND creator_id != ?
+    """
+    paid_at = now_iso()
+    params = (payer_id, paid_at, invoice_id, payer_id)
+    inv = None
+    if HAS_RETURNING:
+        rows = db.execute(claim + " RETURNING creator_id, amount_cents, description", params).fetchall()
+        inv = rows[0] if rows else None
+    elif db.execute(claim, params).rowcount:
+        inv = db.execute("SELECT creator_id, amount_cents, description FROM invoices WHERE id = ?",
+                         (invoice_id,)).fetchone()
+
+    if inv is None:
+        row = db.execute("SELECT status FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
+        if row is None:
+            return None
+        if row["status"] != 'pending':
+            raise ValueError("Счёт уже оплачен или отменён")
+        raise ValueError("Нельзя оплатить собственный счёт")
+
+    # If the funds check fails, the savepoint undoes the claim as well.
+    description = inv["description"] or f"Оплата счёта #{invoice_id}"
+    balance, creator_balance = _transfer(db, payer_id, inv["creator_id"], inv["amount_cents"], description, invoice_id,
+                                         change=change)
+    return balance, creator_balance, inv["creator_id"], paid_at
+
+
+def _transfer_batch(db, payer_id, items, atomic, append=False):
+    errors = [None] * len(items)
+    if append:
+        payer = ledger_balance(db, payer_id)
+        payer = None if payer is None else {"balance_cents": payer}
+    else:
+        payer = db.execute("SELECT balance_cents FROM users WHERE id = ?", (payer_id,)).fetchone()
+    if not payer:
+        raise ValueError("Пользователь не найден")
+    recipient_ids = {recipient_id for recipient_id, _, _ in items}
+    marks = ','.join('?' * len(recipient_ids))
+    known = {r["id"] for r in db.execute(f"SELECT id FROM users WHERE id IN ({marks})", list(recipient_ids))}
+
+    available = payer["balance_cents"]
+    credits = []
+    rows = []
+    ts = now_iso()
+    for i, (recipient_id, amount_cents, description) in enumerate(items):
+        if recipient_id not in known:
+            errors[i] = "Получатель не найден"
+        elif amount_cents > available:
+            errors[i] = "Недостаточно средств"
+        else:
+            available -= amount_cents
+            credits.append((amount_cents, recipient_id))
+            rows.append((payer_id, 'debit', amount_cents, description, recipient_id, None, ts))
+            rows.append((recipient_id, 'credit', amount_cents, description, payer_id, None, ts))
+
+    # Nothing has been written yet, so an atomic rejection needs no undo.
+    if atomic and any(errors):
+        return errors, payer["balance_cents"]
+    if not credits:
+        return errors, payer["balance_cents"]
+
+    if append:
+        balance = available
+    else:
+        balance = change_balance(db, payer_id, -sum(amount for amount, _ in credits))
+        db.executemany("UPDATE users SET balance_cents = balance_cents + ? WHERE id = ?", credits)
+    db.executemany(INSERT_TRANSACTION, rows)
+    return errors, balance
+
+
+def _recorded(db, op, idempotency):
+    # Both keyed operations return a tuple led by the payer's new balance.
+    result = op(db)
+    if result is not None:
+        idempotency.record(db, result[0], now_iso())
+    return result
+
+
+def _adjust(db, user_id, ttype, amount_cents, description, change=change_balance):
+    new_balance = change(db, user_id, amount_cents if ttype == 'credit' else -amount_cents)
+    db.execute(INSERT_TRANSACTION, (user_id, ttype, amount_cents, description, None, None, now_iso()))
+    return new_balance
+
+
+def _delete_transaction(db, user_id, tx_id, change=change_balance):
+    tx = db.execute("SELECT type, amount_cents FROM transactions WHERE id = ? AND user_id = ?",
+                    (tx_id, user_id)).fetchone()
+    if not tx:
+        return None
+    # Undo the row's effect; removing a credit may leave the balance negative.
+    delta = -tx["amount_cents"] if tx["type"] == 'credit' else tx["amount_cents"]
+    new_balance = change(db, user_id, delta, allow_overdraft=True)
+    db.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (tx_id, user_id))
+    return new_balance
+
+
+def _set_balance(db, user_id, balance_cents):
+    if not db.execute("UPDATE users SET balance_cents = ? WHERE id = ?", (balance_cents, user_id)).rowcount:
+        raise ValueError("Пользователь не найден")
+    return balance_cents
+
+
+def _reverse_transaction(db, user_id, tx_id):
+    # The append-only counterpart of _delete_transaction: the row stays and
+    # an opposite one cancels it. The unique reversal_of index stops a
+    # concurrent second reversal.
+    tx = db.execute("SELECT type, amount_cents, reversal_of FROM transactions WHERE id = ? AND user_id = ?",
+                    (tx_id, user_id)).fetchone()
+    if not tx:
+        return None
+    if tx["reversal_of"] is not None:
+        raise ValueError("Нельзя отменить сторнирующую операцию")
+    ttype = 'debit' if tx["type"] == 'credit' else 'credit'
+    new_balance = _append_change(db, user_id, tx["amount_cents"] if ttype == 'credit' else -tx["amount_cents"],
+                                 allow_overdraft=True)
+    try:
+        db.execute("""
+            INSERT INTO transactions (user_id, type, amount_cents, description, reversal_of, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, ttype, tx["amount_cents"], f"Сторно операции #{tx_id}", tx_id, now_iso()))
+    except sqlite3.IntegrityError:
+        raise ValueError("Операция уже отменена")
+    return new_balance
+
+
+def _append_set_balance(db, user_id, balance_cents):
+    current = _append_change(db, user_id, 0)
+    if balance_cents != current:
+        diff = balance_cents - current
+        db.execute(INSERT_TRANSACTION, (user_id, 'credit' if diff > 0 else 'debit', abs(diff),
+                                        "Корректировка баланса", None, None, now_iso()))
+    return balance_cents
+
+
+# -------------------------
+# Sharded ledger
+# -------------------------
+# With LEDGER_SHARDS > 1 a transfer between shards commits in two steps.
+# The payer's shard debits and, in the same transaction, queues the credit
+# in transfer_outbox. The recipient's shard then applies it, deduplicated by
+# transfer_inbox, and the outbox row is cleared. Invoice payments claim the
+# invoice in the directory in between, and refund the payer if someone else
+# got there first. Every step is idempotent, so recover_transfers() can
+# replay whatever a crash or lock timeout left in an outbox.
+def _adopt(db, user_id):
+    # The first ledger write on a shard takes the balance over from the directory.
+    return db.execute("""
+        INSERT OR IGNORE INTO balances (id, balance_cents)
+        SELECT id, balance_cents FROM directory.users WHERE id = ?
+    """, (user_id,)).rowcount
+
+
+def _shard_change_balance(db, user_id, delta, allow_overdraft=False):
+    try:
+        return change_balance(db, user_id, delta, allow_overdraft, table='balances')
+    except ValueError:
+        if not _adopt(db, user_id):
+            raise
+    return change_balance(db, user_id, delta, allow_overdraft, table='balances')
+
+
+def _shard_balance(db, user_id):
+    row = db.execute("SELECT balance_cents FROM balances WHERE id = ?", (user_id,)).fetchone()
+    if row is None and _adopt(db, user_id):
+        row = db.execute("SELECT balance_cents FROM balances WHERE id = ?", (user_id,)).fetchone()
+    if row is None:
+        raise ValueError("Пользователь не найден")
+    return row[0]
+
+
+def _shard_send(db, shard_of, payer_id, items, atomic, kind='transfer', invoice_id=None, idempotency=None):
+    """Step one, on the payer's shard: validate like _transfer_batch, debit,
+    credit same-shard recipients directly and queue the rest.
+
+    Returns (errors, payer_balance, {recipient_id: balance}, outbox_entries).
+    """
+    errors = [None] * len(items)
+    available = balance = _shard_balance(db, payer_id)
+    recipient_ids = {recipient_id for recipient_id, _, _ in items}
+    marks = ','.join('?' * len(recipient_ids))
+    known = {r["id"] for r in db.execute(f"SELECT id FROM directory.users WHERE id IN ({marks})",
+                                         list(recipient_ids))}
+    accepted = []
+    for i, (recipient_id, amount_cents, description) in enumerate(items):
+        if recipient_id not in known:
+            errors[i] = "Получатель не найден"
+        elif amount_cents > available:
+            errors[i] = "Недостаточно средств"
+        else:
+            available -= amount_cents
+            accepted.append((recipient_id, amount_cents, description))
+    if (atomic and any(errors)) or not accepted:
+        return errors, balance, {}, []
+
+    home = shard_of(payer_id)
+    balance = _shard_change_balance(db, payer_id, -sum(amount for _, amount, _ in accepted))
+    ts = now_iso()
+    credited, outbox = {}, []
+    for recipient_id, amount_cents, description in accepted:
+        cur = db.execute(INSERT_TRANSACTION, (payer_id, 'debit', amount_cents, description, recipient_id, invoice_id, ts))
+        # An invoice credit waits for the claim in the directory, even on the same shard.
+        if kind == 'transfer' and shard_of(recipient_id) == home:
+            credited[recipient_id] = _shard_change_balance(db, recipient_id, amount_cents)
+            db.execute(INSERT_TRANSACTION, (recipient_id, 'credit', amount_cents, description, payer_id, invoice_id, ts))
+            continue
+        entry = (uuid.uuid4().hex, kind, payer_id, recipient_id, amount_cents, description, invoice_id,
+                 cur.lastrowid, idempotency.key if idempotency is not None else None, ts)
+        db.execute(f"INSERT INTO transfer_outbox ({', '.join(OUTBOX_COLUMNS)}) VALUES ({', '.join('?' * len(entry))})",
+                   entry)
+        outbox.append(dict(zip(OUTBOX_COLUMNS, entry)))
+    if idempotency is not None:
+        idempotency.record(db, balance, ts)
+    return errors, balance, credited, outbox
+
+
+def _shard_receive(db, entries):
+    """Step two, on the recipient's shard. Returns {recipient_id: balance}."""
+    balances = {}
+    for e in entries:
+        if not db.execute("INSERT OR IGNORE INTO transfer_inbox (xid, created_at) VALUES (?, ?)",
+                          (e["xid"], now_iso())).rowcount:
+            continue
+        balances[e["recipient_id"]] = _shard_change_balance(db, e["recipient_id"], e["amount_cents"])
+        db.execute(INSERT_TRANSACTION, (e["recipient_id"], 'credit', e["amount_cents"], e["description"],
+                                        e["payer_id"], e["invoice_id"], e["created_at"]))
+    return balances
+
+
+def _shard_forget(db, xids):
+    marks = ','.join('?' * len(xids))
+    db.execute(f"DELETE FROM transfer_outbox WHERE xid IN ({marks})", list(xids))
+
+
+def _shard_refund(db, entry):
+    """Undo step one for an invoice someone else paid. Returns the payer's balance, or None if already settled."""
+    if not db.execute("DELETE FROM transfer_outbox WHERE xid = ?", (entry["xid"],)).rowcount:
+        return None
+    db.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (entry["debit_tx_id"], entry["payer_id"]))
+    if entry["idempotency_key"]:
+        db.execute("DELETE FROM idempotency_keys WHERE user_id = ? AND key = ?",
+                   (entry["payer_id"], entry["idempotency_key"]))
+    return _shard_change_balance(db, entry["payer_id"], entry["amount_cents"])
+
+
+def _claim_invoice(db, payer_id, invoice_id, paid_at):
+    # paid_at doubles as the claim's identity, so a replayed claim recognises itself.
+    if db.execute("""
+        UPDATE invoices SET status = 'paid', paid_by = ?, paid_at = ?
+        WHERE id = ? AND status = 'pending' AND creator_id != ?
+    """, (payer_id, paid_at, invoice_id, payer_id)).rowcount:
+        return True
+    row = db.execute("SELECT paid_by, paid_at FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
+    return row is not None and row["paid_by"] == payer_id and row["paid_at"] == paid_at
+
+
+def _shard_set_balance(db, user_id, balance_cents):
+    if db.execute("SELECT 1 FROM directory.users WHERE id = ?", (user_id,)).fetchone() is None:
+        raise ValueError("Пользователь не найден")
+    db.execute("""
+        INSERT INTO balances (id, balance_cents) VALUES (?, ?)
+        ON CONFLICT (id) DO UPDATE SET balance_cents = excluded.balance_cents
+    """, (user_id, balance_cents))
+    return balance_cents
+
+
+def _settle(shards, entries):
+    """Drive outbox entries to completion (steps two and three, or a refund).
+
+    Returns ({recipient_id: balance}, {payer_id: balance after refund}).
+    """
+    deliver, refunds = [], []
+    for e in entries:
+        if e["kind"] == 'invoice' and not execute(partial(
+                _claim_invoice, payer_id=e["payer_id"], invoice_id=e["invoice_id"], paid_at=e["created_at"])):
+            refunds.append(e)
+        else:
+            deliver.append(e)
+
+    credited = {}
+    by_recipient = {}
+    for e in deliver:
+        by_recipient.setdefault(shards.shard_for(e["recipient_id"]), []).append(e)
+    for shard, group in by_recipient.items():
+        credited.update(execute(partial(_shard_receive, entries=group), shard=shard))
+    by_payer = {}
+    for e in deliver:
+        by_payer.setdefault(shards.shard_for(e["payer_id"]), []).append(e["xid"])
+    for shard, xids in by_payer.items():
+        execute(partial(_shard_forget, xids=xids), shard=shard)
+
+    refunded = {}
+    for e in refunds:
+        balance = execute(partial(_shard_refund, entry=e), shard=shards.shard_for(e["payer_id"]))
+        if balance is not None:
+            refunded[e["payer_id"]] = balance
+    shards.mirror.mark(*credited, *refunded)
+    # Recovery settles without the request that started the transfer, so nothing else announces it.
+    get_response_cache(current_app).bump(*(('user', user_id) for user_id in (*credited, *refunded)),
+                                         *(('invoice', e["invoice_id"]) for e in entries if e["kind"] == 'invoice'))
+    return credited, refunded
+
+
+def _settle_or_defer(shards, entries):
+    try:
+        return _settle(shards, entries)
+    except Exception:
+        # Step one is durable, so the money is not lost: recovery finishes it.
+        log.exception("Cross-shard settlement deferred to recovery")
+        app = current_app._get_current_object()
+        delay = app.config.get('LEDGER_RECOVERY_DELAY', 5)
+        timer = threading.Timer(delay, _recover_in_context, (app, delay))
+        timer.daemon = True
+        timer.start()
+        return {}, {}
+
+
+def _recover_in_context(app, min_age):
+    with app.app_context():
+        try:
+            recover_transfers(min_age=min_age)
+        except Exception:
+            log.exception("Cross-shard recovery failed")
+
+
+def recover_transfers(min_age=0):
+    """Finish cross-shard transfers left in any outbox; returns how many.
+
+    ``min_age`` (seconds) skips entries that a live request may still be
+    settling. Also forgets inbox rows old enough never to be redelivered.
+    """
+    shards = get_shards(current_app)
+    if shards is None:
+        return 0
+    cutoff = (datetime.utcnow() - timedelta(seconds=min_age)).isoformat()
+    entries = []
+    for pool in shards.pools:
+        db = pool.acquire()
+        try:
+            rows = db.execute(f"SELECT {', '.join(OUTBOX_COLUMNS)} FROM transfer_outbox WHERE created_at <= ?",
+                              (cutoff,)).fetchall()
+            entries.extend(dict(r) for r in rows)
+        finally:
+            pool.release(db)
+    if entries:
+        credited, refunded = _settle(shards, entries)
+        for user_id, balance in {**credited, **refunded}.items():
+            invalidate_users(user_id)
+            publish(user_id, 'balance', {"balance_cents": balance})
+    horizon = (datetime.utcnow() - timedelta(days=7)).isoformat()
+    for shard in range(shards.count):
+        execute(lambda db: db.execute("DELETE FROM transfer_inbox WHERE created_at < ?", (horizon,)), shard=shard)
+    return len(entries)
+
+
+def _sharded_send(shards, payer_id, items, atomic, kind='transfer', invoice_id=None, idempotency=None):
+    try:
+        errors, balance, credited, outbox = execute(partial(
+            _shard_send, shard_of=shards.shard_for, payer_id=payer_id, items=items, atomic=atomic,
+            kind=kind, invoice_id=invoice_id, idempotency=idempotency), shard=shards.shard_for(payer_id))
+    finally:
+        invalidate_users(payer_id, *{recipient_id for recipient_id, _, _ in items})
+    shards.mirror.mark(payer_id, *credited)
+    if idempotency is not None and not any(errors):
+        idempotency.remember()
+    delivered, refunded = _settle_or_defer(shards, outbox)
+    credited.update(delivered)
+    balance = refunded.get(payer_id, balance)
+    return errors, balance, credited, refunded
+
+
+# -------------------------
+# Public API
+# -------------------------
+def transfer_funds(payer_id: int, recipient_id: int, amount_cents: int, description: str,
+                   invoice_id: int = None, idempotency=None) -> int:
+    """Move money between two users. Returns the payer's new balance.
+
+    With an ``idempotency`` request its response is stored in the same
+    transaction; a key that committed concurrently raises KeyRecorded.
+    """
+    shards = get_shards(current_app)
+    if shards is not None:
+        errors, balance, credited, _ = _sharded_send(
+            shards, payer_id, [(recipient_id, amount_cents, description)], atomic=True,
+            invoice_id=invoice_id, idempotency=idempotency)
+        if errors[0]:
+            raise ValueError(errors[0])
+        publish(payer_id, 'balance', {"balance_cents": balance})
+        publish(recipient_id, 'balance', {"balance_cents": credited[recipient_id]} if recipient_id in credited else {})
+        return balance
+    op = partial(_transfer, payer_id=payer_id, recipient_id=recipient_id,
+                 amount_cents=amount_cents, description=description, invoice_id=invoice_id,
+                 change=_append_change if append_only(current_app) else change_balance)
+    if idempotency is not None:
+        op = partial(_recorded, op=op, idempotency=idempotency)
+    try:
+        balance, recipient_balance = execute(op)
+    finally:
+        invalidate_users(payer_id, recipient_id)
+    if idempotency is not None:
+        idempotency.remember()
+    publish(payer_id, 'balance', {"balance_cents": balance})
+    publish(recipient_id, 'balance', {"balance_cents": recipient_balance})
+    return balance
+
+
+def pay_invoice(payer_id: int, invoice_id: int, idempotency=None):
+    """Settle a pending invoice in one write transaction.
+
+    Returns the payer's new balance, or None if the invoice does not exist.
+    ``idempotency`` is handled as in transfer_funds().
+    """
+    shards = get_shards(current_app)
+    if shards is not None:
+        return _sharded_pay_invoice(shards, payer_id, invoice_id, idempotency)
+    op = partial(_pay_invoice, payer_id=payer_id, invoice_id=invoice_id,
+                 change=_append_change if append_only(current_app) else change_balance)
+    if idempotency is not None:
+        op = partial(_recorded, op=op, idempotency=idempotency)
+    try:
+        settled = execute(op)
+    finally:
+        invalidate_users(payer_id)
+    if settled is None:
+        return None
+    if idempotency is not None:
+        idempotency.remember()
+    balance, creator_balance, creator_id, paid_at = settled
+    invalidate_users(creator_id)
+    publish(payer_id, 'balance', {"balance_cents": balance})
+    publish(creator_id, 'balance', {"balance_cents": creator_balance})
+    publish(creator_id, 'invoice', {"id": invoice_id, "status": "paid", "paid_by": payer_id, "paid_at": paid_at})
+    return balance
+
+
+def _sharded_pay_invoice(shards, payer_id, invoice_id, idempotency):
+    inv = get_db().execute("SELECT creator_id, amount_cents, description, status FROM invoices WHERE id = ?",
+                           (invoice_id,)).fetchone()
+    if inv is None:
+        return None
+    if inv["status"] != 'pending':
+        raise ValueError("Счёт уже оплачен или отменён")
+    if inv["creator_id"] == payer_id:
+        raise ValueError("Нельзя оплатить собственный счёт")
+    description = inv["description"] or f"Оплата счёта #{invoice_id}"
+    errors, balance, credited, refunded = _sharded_send(
+        shards, payer_id, [(inv["creator_id"], inv["amount_cents"], description)], atomic=True,
+        kind='invoice', invoice_id=invoice_id, idempotency=idempotency)
+    if errors[0]:
+        raise ValueError(errors[0])
+    publish(payer_id, 'balance', {"balance_cents": balance})
+    if payer_id in refunded:
+        raise ValueError("Счёт уже оплачен или отменён")
+    creator_id = inv["creator_id"]
+    invalidate_users(creator_id)
+    if creator_id in credited:
+        publish(creator_id, 'balance', {"balance_cents": credited[creator_id]})
+        paid_at = get_db().execute("SELECT paid_at FROM invoices WHERE id = ?", (invoice_id,)).fetchone()[0]
+        publish(creator_id, 'invoice', {"id": invoice_id, "status": "paid", "paid_by": payer_id, "paid_at": paid_at})
+    return balance
+
+
+def transfer_batch(payer_id: int, items, atomic: bool = True):
+    """Apply many transfers from one payer in one transaction.
+
+    ``items`` is a list of (recipient_id, amount_cents, description). Returns
+    (errors, balance_cents) where errors[i] is None for an applied item or the
+    reason it was rejected. In atomic mode one rejection rejects the batch.
+    """
+    shards = get_shards(current_app)
+    if shards is not None:
+        errors, balance, credited, _ = _sharded_send(shards, payer_id, items, atomic)
+        if not (atomic and any(errors)) and not all(errors):
+            publish(payer_id, 'balance', {"balance_cents": balance})
+            for recipient_id in {recipient_id for (recipient_id, _, _), err in zip(items, errors) if err is None}:
+                publish(recipient_id, 'balance', {"balance_cents": credited[recipient_id]} if recipient_id in credited else {})
+        return errors, balance
+    try:
+        errors, balance = execute(partial(_transfer_batch, payer_id=payer_id, items=items, atomic=atomic,
+                                          append=append_only(current_app)))
+    finally:
+        invalidate_users(payer_id, *{recipient_id for recipient_id, _, _ in items})
+    credited = {recipient_id for (recipient_id, _, _), err in zip(items, errors) if err is None}
+    if credited and not (atomic and any(errors)):
+        publish(payer_id, 'balance', {"balance_cents": balance})
+        # Recipients are credited in one executemany, so only the change is known.
+        for recipient_id in credited:
+            publish(recipient_id, 'balance', {})
+    return errors, balance
+
+
+def adjust_balance(user_id: int, ttype: str, amount_cents: int, description: str) -> int:
+    """Admin credit/debit without a counterparty. Returns the new balance."""
+    if ttype not in ('credit', 'debit'):
+        raise ValueError("Неизвестный тип транзакции")
+    shards = get_shards(current_app)
+    op = partial(_adjust, user_id=user_id, ttype=ttype, amount_cents=amount_cents, description=description)
+    try:
+        if shards is None:
+            balance = execute(partial(op, change=_append_change) if append_only(current_app) else op)
+        else:
+            balance = execute(partial(op, change=_shard_change_balance), shard=shards.shard_for(user_id))
+            shards.mirror.mark(user_id)
+    finally:
+        invalidate_users(user_id)
+    publish(user_id, 'balance', {"balance_cents": balance})
+    return balance
+
+
+def delete_transaction(user_id: int, tx_id: int):
+    """Remove a ledger row and reverse its effect on the balance.
+
+    In append-only mode the row is kept and a reversal is appended instead.
+    Returns the new balance, or None if the row does not belong to the user.
+    """
+    shards = get_shards(current_app)
+    op = partial(_delete_transaction, user_id=user_id, tx_id=tx_id)
+    try:
+        if shards is None:
+            if append_only(current_app):
+                op = partial(_reverse_transaction, user_id=user_id, tx_id=tx_id)
+            balance = execute(op)
+        else:
+            balance = execute(partial(op, change=_shard_change_balance), shard=shards.shard_for(user_id))
+            shards.mirror.mark(user_id)
+    finally:
+        invalidate_users(user_id)
+    if balance is not None:
+        publish(user_id, 'balance', {"balance_cents": balance})
+    return balance
+
+
+def set_balance(user_id: int, balance_cents: int) -> int:
+    """Admin override of a balance, without a ledger row (in append-only
+    mode, with a correction row for the difference)."""
+    shards = get_shards(current_app)
+    try:
+        if shards is None:
+            op = _append_set_balance if append_only(current_app) else _set_balance
+            execute(partial(op, user_id=user_id, balance_cents=balance_cents))
+        else:
+            execute(partial(_shard_set_balance, user_id=user_id, balance_cents=balance_cents),
+                    shard=shards.shard_for(user_id))
+            shards.mirror.mark(user_id)
+    finally:
+        invalidate_users(user_id)
+    publish(user_id, 'balance', {"balance_cents": balance_cents})
+    return balance_cents
@@ -0,0 +1,337 @@
+import heapq
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, Response, current_app, g, jsonify, request, session
+
+metrics_bp = Blueprint('metrics', __name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_WHITESPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+\b')
+_IN_LIST = re.compile(r'\((?:\?\s*,\s*)+\?\)')
+
+
+def fingerprint(sql: str) -> str:
+    """Normalise a statement so that calls differing only in literals group together."""
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('(?, ...)', sql)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            yield f'{name}_bucket{_labels(labels, le=repr(bound))} {cumulative}'
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {self.count}'
+        yield f'{name}_sum{_labels(labels)} {self.sum}'
+        yield f'{name}_count{_labels(labels)} {self.count}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+class Registry:
+    """Process-wide counters. Disabled (every call a no-op) until init_metrics()."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.sql = {}
+            self.routes = {}
+            self.route_sql = {}
+            self.lock_wait = Histogram()
+            self.queue_wait = Histogram()
+
+    # Per-request SQL accounting for whichever request runs on this thread.
+    def begin_request(self):
+        self._local.stats = [0, 0.0]
+
+    def request_stats(self):
+        return list(getattr(self._local, 'stats', None) or [0, 0.0])
+
+    def end_request(self):
+        stats = getattr(self._local, 'stats', None)
+        self._local.stats = None
+        return stats or [0, 0.0]
+
+    def observe_sql(self, sql, seconds):
+        if not self.enabled:
+            return
+        key = fingerprint(sql)
+        with self._lock:
+            entry = self.sql.get(key)
+            if entry is None:
+                entry = self.sql[key] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += seconds
+
+    def observe_request(self, method, route, status, seconds, sql_count, sql_seconds):
+        with self._lock:
+            key = (method, route, str(status))
+            hist = self.routes.get(key)
+            if hist is None:
+                hist = self.routes[key] = Histogram()
+            hist.observe(seconds)
+            totals = self.route_sql.setdefault((method, route), [0, 0.0])
+            totals[0] += sql_count
+            totals[1] += sql_seconds
+
+    def observe_lock_wait(self, seconds):
+        if self.enabled:
+            with self._lock:
+                self.lock_wait.observe(seconds)
+
+    def observe_queue_wait(self, seconds):
+        if self.enabled:
+            with self._lock:
+                self.queue_wait.observe(seconds)
+
+    def render(self, extra_gauges=()):
+        out = []
+        with self._lock:
+            out.append('# HELP libank_request_duration_seconds Request latency by route.')
+            out.append('# TYPE libank_request_duration_seconds histogram')
+            for (method, route, status), hist in sorted(self.routes.items()):
+                out.extend(hist.lines('libank_request_duration_seconds',
+                                      {'method': method, 'route': route, 'status': status}))
+            out.append('# HELP libank_request_sql_statements_total SQL statements issued, by route.')
+            out.append('# TYPE libank_request_sql_statements_total counter')
+            for (method, route), (count, _) in sorted(self.route_sql.items()):
+                out.append(f'libank_request_sql_statements_total{_labels({"method": method, "route": route})} {count}')
+            out.append('# HELP libank_request_sql_seconds_total Time spent in SQL, by route.')
+            out.append('# TYPE libank_request_sql_seconds_total counter')
+            for (method, route), (_, seconds) in sorted(self.route_sql.items()):
+                out.append(f'libank_request_sql_seconds_total{_labels({"method": method, "route": route})} {seconds}')
+            out.append('# HELP libank_sql_statements_total Executions per statement fingerprint.')
+            out.append('# TYPE libank_sql_statements_total counter')
+            for sql, (count, _) in sorted(self.sql.items()):
+                out.append(f'libank_sql_statements_total{_labels({"fingerprint": sql})} {count}')
+            out.append('# HELP libank_sql_seconds_total Time per statement fingerprint, up to the first row.')
+            out.append('# TYPE libank_sql_seconds_total counter')
+            for sql, (_, seconds) in sorted(self.sql.items()):
+                out.append(f'libank_sql_seconds_total{_labels({"fingerprint": sql})} {seconds}')
+            out.append('# HELP libank_ledger_lock_wait_seconds Time waiting for BEGIN IMMEDIATE in ledger writes.')
+            out.append('# TYPE libank_ledger_lock_wait_seconds histogram')
+            out.extend(self.lock_wait.lines('libank_ledger_lock_wait_seconds', {}))
+            out.append('# HELP libank_ledger_queue_wait_seconds Time ledger operations wait for the writer thread.')
+            out.append('# TYPE libank_ledger_queue_wait_seconds histogram')
+            out.extend(self.queue_wait.lines('libank_ledger_queue_wait_seconds', {}))
+        for name, help_text, value in extra_gauges:
+            out.append(f'# HELP {name} {help_text}')
+            out.append(f'# TYPE {name} gauge')
+            out.append(f'{name} {value}')
+        return '\n'.join(out) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection factory that times every statement and commit into REGISTRY."""
+
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            REGISTRY.observe_sql(sql, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            REGISTRY.observe_sql(sql, time.perf_counter() - t0)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            REGISTRY.observe_sql('COMMIT', time.perf_counter() - t0)
+
+
+# -------------------------
+# Slow request sampler
+# -------------------------
+class SlowRequestSampler:
+    """Samples the stacks of in-flight requests and keeps the slowest ones.
+
+    A background thread snapshots sys._current_frames() every ``interval``
+    seconds for threads that are serving a request. Requests slower than
+    ``threshold`` keep their most frequent stacks in a bounded top-N list.
+    """
+
+    def __init__(self, threshold, interval=0.005, keep=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.keep = keep
+        self.slowest = []
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='slow-request-sampler', daemon=True)
+        self._thread.start()
+
+    def start(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def finish(self, method, path, seconds, logger=None):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if samples is None or seconds < self.threshold:
+            return
+        entry = (seconds, time.time(), method, path, samples.most_common(5))
+        with self._lock:
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+        if logger is not None:
+            top = entry[4][0][0] if entry[4] else 'no samples'
+            logger.warning("Slow request %s %s: %.1f ms; hottest stack: %s", method, path, seconds * 1000, top)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame, depth=30):
+        parts = []
+        while frame is not None and len(parts) < depth:
+            code = frame.f_code
+            parts.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+    def report(self):
+        with self._lock:
+            entries = sorted(self.slowest, reverse=True)
+        return [{
+            "duration_ms": round(seconds * 1000, 3),
+            "at": at,
+            "method": method,
+            "path": path,
+            "stacks": [{"stack": stack, "samples": n} for stack, n in stacks],
+        } for seconds, at, method, path, stacks in entries]
+
+
+# -------------------------
+# Flask wiring
+# -------------------------
+def init_metrics(app):
+    """Enable instrumentation for ``app``: must run before the first request."""
+    REGISTRY.enabled = True
+    threshold_ms = app.config.get('METRICS_SLOW_REQUEST_MS')
+    sampler = None
+    if threshold_ms:
+        sampler = SlowRequestSampler(threshold_ms / 1000.0, app.config.get('METRICS_SAMPLE_INTERVAL', 0.005))
+    app.extensions['slow_request_sampler'] = sampler
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_t0 = time.perf_counter()
+        REGISTRY.begin_request()
+        if sampler is not None:
+            sampler.start()
+
+    @app.after_request
+    def _metrics_header(response):
+        g._metrics_status = response.status_code
+        sql_count, sql_seconds = REGISTRY.request_stats()
+        response.headers['Server-Timing'] = f'sql;dur={sql_seconds * 1000:.2f};desc="{sql_count} queries"'
+        return response
+
+    # after_request is skipped when a view raises; teardown always runs,
+    # so failing requests are counted and leave nothing in the sampler.
+    @app.teardown_request
+    def _metrics_finish(exception):
+        t0 = g.pop('_metrics_t0', None)
+        if t0 is None:
+            return
+        seconds = time.perf_counter() - t0
+        sql_count, sql_seconds = REGISTRY.end_request()
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.pop('_metrics_status', 500)
+        REGISTRY.observe_request(request.method, route, status, seconds, sql_count, sql_seconds)
+        if sampler is not None:
+            sampler.finish(request.method, request.path, seconds, app.logger)
+
+    app.register_blueprint(metrics_bp)
+
+
+@metrics_bp.before_request
+def require_admin():
+    # Stacks of live requests stay admin-only; METRICS_PUBLIC opens /metrics to scrapers.
+    if session.get('is_admin'):
+        return None
+    if request.endpoint == 'metrics.metrics' and current_app.config.get('METRICS_PUBLIC'):
+        return None
+    return jsonify(ok=False, error="Доступ запрещён"), 403
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    gauges = []
+    cache = current_app.extensions.get('user_cache')
+    if cache is not None:
+        stats = cache.stats()
+        gauges += [
+            ('libank_user_cache_hits', 'User cache hits since start.', stats['hits']),
+            ('libank_user_cache_misses', 'User cache misses since start.', stats['misses']),
+            ('libank_user_cache_entries', 'Users currently cached.', stats['size']),
+        ]
+    return Response(REGISTRY.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@metrics_bp.route('/metrics/slow')
+def slow_requests():
+    sampler = current_app.extensions.get('slow_request_sampler')
+    return jsonify(ok=True, enabled=sampler is not None, requests=sampler.report() if sampler else [])
@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Raised instead of queueing when the hashing pool is saturated."""
+
+
+class PasswordHasher:
+    """Runs the password KDF on a bounded pool off the request thread.
+
+    At most ``workers + max_queue`` hashes may be in flight; beyond that
+    callers get HasherBusy straight away rather than piling up behind a
+    login burst. ``method`` is any werkzeug method string; hashes made
+    with other parameters are reported by needs_rehash().
+    """
+
+    def __init__(self, method='scrypt:32768:8:1', salt_length=16, workers=4,
+                 max_queue=32, timeout=10, processes=False):
+        self.method = method
+        self.salt_length = salt_length
+        self.timeout = timeout
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._executor = executor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._prefix = None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, stored_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        if self._prefix is None:
+            # werkzeug fills in default parameters, so learn the canonical form once.
+            self._prefix = generate_password_hash('', self.method, 1).split('$', 1)[0]
+        return stored_hash.split('$', 1)[0] != self._prefix
+
+
+_hasher_lock = threading.Lock()
+
+
+def get_hasher(app) -> PasswordHasher:
+    hasher = app.extensions.get('password_hasher')
+    if hasher is None:
+        with _hasher_lock:
+            hasher = app.extensions.get('password_hasher')
+            if hasher is None:
+                hasher = PasswordHasher(
+                    method=app.config.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+                    salt_length=app.config.get('PASSWORD_HASH_SALT_LENGTH', 16),
+                    workers=app.config.get('PASSWORD_HASH_WORKERS', 4),
+                    max_queue=app.config.get('PASSWORD_HASH_QUEUE', 32),
+                    timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10),
+                    processes=app.config.get('PASSWORD_HASH_PROCESSES', False),
+                )
+                app.extensions['password_hasher'] = hasher
+    return hasher
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import qrcode
+import qrcode.image.svg
+
+MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+def render_qr(payload: str, fmt: str) -> bytes:
+    buf = BytesIO()
+    if fmt == 'svg':
+        # Pure-Python path image: no Pillow involved.
+        img = qrcode.make(payload, image_factory=qrcode.image.svg.SvgPathImage)
+        img.save(buf)
+    else:
+        img = qrcode.make(payload)
+        img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class QRCache:
+    """Rendered QR images keyed by (format, payload).
+
+    An in-process LRU bounded by total bytes sits in front of an optional
+    content-addressed directory shared between processes. The directory is
+    bounded too: past ``disk_max_bytes`` the least recently used files
+    (by mtime, refreshed on every disk hit) are removed down to 90%. The
+    key hash doubles as the ETag, since the image depends only on the payload.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, disk_dir=None, disk_max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        # This process's estimate of the directory size; a prune rescans it.
+        self._disk_size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(payload: str, fmt: str) -> str:
+        return hashlib.sha256(f"{fmt}:{payload}".encode()).hexdigest()
+
+    def get(self, payload: str, fmt: str):
+        """Return (image bytes, etag), rendering on a miss."""
+        key = self.key(payload, fmt)
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                return data, key
+
+        data = self._read_disk(key, fmt)
+        if data is None:
+            data = render_qr(payload, fmt)
+            self._write_disk(key, fmt, data)
+        self._put(key, data)
+        return data, key
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _path(self, key, fmt):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.{fmt}")
+
+    def _read_disk(self, key, fmt):
+        if not self.disk_dir:
+            return None
+        path = self._path(key, fmt)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key, fmt, data):
+        if not self.disk_dir:
+            return
+        path = self._path(key, fmt)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so readers never see a partial file.
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(size for _, size, _ in self._scan_disk())
+            else:
+                self._disk_size += len(data)
+            over = self._disk_size > self.disk_max_bytes
+        if over:
+            self._prune_disk()
+
+    def _scan_disk(self):
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _prune_disk(self):
+        entries = sorted(self._scan_disk())
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_size = total
+
+
+def get_qr_cache(app):
+    cache = app.extensions.get('qr_cache')
+    if cache is None:
+        cache = QRCache(
+            max_bytes=app.config.get('QR_CACHE_BYTES', 8 * 1024 * 1024),
+            disk_dir=app.config.get('QR_CACHE_DIR'),
+            disk_max_bytes=app.config.get('QR_CACHE_DIR_BYTES', 256 * 1024 * 1024),
+        )
+        app.extensions['qr_cache'] = cache
+    return cache
@@ -0,0 +1,208 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from flask import current_app
+
+from database import get_db, get_pool
+from ledger import execute, now_iso
+from shards import get_shards
+from snapshots import append_only, balance_sql
+
+RANGE_SIZE = 5000
+
+SIGNED_AMOUNT = "CASE t.type WHEN 'credit' THEN t.amount_cents ELSE -t.amount_cents END"
+
+# Accounts in [:lo, :hi) with their current balance; on a shard, only the
+# users it owns, with the balance from whichever side holds it; in
+# append-only mode, the balance derived from the latest snapshot.
+ACCOUNTS = "SELECT id, balance_cents FROM users WHERE id >= :lo AND id < :hi"
+SNAPSHOT_ACCOUNTS = f"""
+    SELECT a.id, {balance_sql('a.id')} AS balance_cents
+    FROM users a WHERE a.id >= :lo AND a.id < :hi
+"""
+SHARD_ACCOUNTS = """
+    SELECT u.id, coalesce(b.balance_cents, u.balance_cents) AS balance_cents
+    FROM directory.users u LEFT JOIN balances b ON b.id = u.id
+    WHERE u.id >= :lo AND u.id < :hi AND u.id % :count = :index
+"""
+
+
+def _scan(db, accounts_sql, params):
+    """Read phase, in one snapshot: the new ledger rows of every checkpointed
+    account in the range. Returns (watermark, updates, new account count, rows scanned)."""
+    db.execute("BEGIN")
+    try:
+        watermark = db.execute("SELECT coalesce(MAX(id), 0) FROM transactions").fetchone()[0]
+        balances = {r["id"]: r["balance_cents"] for r in db.execute(accounts_sql, params)}
+        checkpoints = db.execute("""
+            SELECT user_id, verified_through, ledger_cents, opening_cents, revision
+            FROM reconcile_checkpoints WHERE user_id >= :lo AND user_id < :hi
+        """, params).fetchall()
+        low = min((c["verified_through"] for c in checkpoints), default=watermark)
+        # Driven by the rowid range of rows added since the oldest checkpoint,
+        # never by a user's whole history.
+        deltas = {r[0]: (r[1], r[2]) for r in db.execute(f"""
+            SELECT t.user_id, SUM({SIGNED_AMOUNT}), COUNT(*)
+            FROM transactions t CROSS JOIN reconcile_checkpoints c ON c.user_id = t.user_id
+            WHERE t.id > :low AND t.id <= :watermark AND +t.user_id >= :lo AND +t.user_id < :hi
+              AND t.id > c.verified_through
+            GROUP BY t.user_id
+        """, dict(params, low=low, watermark=watermark))}
+    finally:
+        db.rollback()
+
+    updates = []
+    for c in checkpoints:
+        balance = balances.get(c["user_id"])
+        if balance is None:
+            continue
+        net, _ = deltas.get(c["user_id"], (0, 0))
+        ledger = c["ledger_cents"] + net
+        drift = balance - c["opening_cents"] - ledger
+        updates.append((watermark, ledger, balance, drift, c["user_id"], c["verified_through"], c["revision"]))
+    new_accounts = len(balances.keys() - {c["user_id"] for c in checkpoints})
+    return watermark, updates, new_accounts, sum(count for _, count in deltas.values())
+
+
+def _commit(db, accounts_sql, params, updates, new_accounts, checked_at):
+    """Write phase. A checkpoint whose revision moved since the scan (a ledger
+    row was deleted meanwhile) is left for the next run. New accounts get
+    their baseline here, under the write lock, from their full history."""
+    db.executemany("""
+        UPDATE reconcile_checkpoints SET verified_through = ?, ledger_cents = ?, balance_cents = ?,
+          drift_cents = ?, checked_at = ?
+        WHERE user_id = ? AND verified_through = ? AND revision = ?
+    """, [(wm, ledger, balance, drift, checked_at, user_id, through, revision)
+          for wm, ledger, balance, drift, user_id, through, revision in updates])
+    if new_accounts:
+        db.execute(f"""
+            INSERT OR IGNORE INTO reconcile_checkpoints
+              (user_id, verified_through, ledger_cents, opening_cents, balance_cents, drift_cents, checked_at)
+            SELECT id, max_id, net, balance_cents - net, balance_cents, 0, :checked_at FROM (
+              SELECT a.id, a.balance_cents,
+                     (SELECT coalesce(MAX(id), 0) FROM transactions) AS max_id,
+                     (SELECT coalesce(SUM({SIGNED_AMOUNT}), 0) FROM transactions t WHERE t.user_id = a.id) AS net
+              FROM ({accounts_sql}) a
+              WHERE a.id NOT IN (SELECT user_id FROM reconcile_checkpoints WHERE user_id >= :lo AND user_id < :hi)
+            )
+        """, dict(params, checked_at=checked_at))
+
+
+def _reconcile_range(app, shard, pool, lo, hi):
+    shards = get_shards(app)
+    accounts_sql = SHARD_ACCOUNTS if shard is not None else \
+        SNAPSHOT_ACCOUNTS if append_only(app) else ACCOUNTS
+    params = {"lo": lo, "hi": hi}
+    if shard is not None:
+        params.update(count=shards.count, index=shard)
+    db = pool.acquire()
+    try:
+        watermark, updates, new_accounts, scanned = _scan(db, accounts_sql, params)
+    finally:
+        pool.release(db)
+    if updates or new_accounts:
+        with app.app_context():
+            execute(partial(_commit, accounts_sql=accounts_sql, params=params, updates=updates,
+                            new_accounts=new_accounts, checked_at=now_iso()), shard=shard)
+    return len(updates) + new_accounts, scanned, sum(1 for u in updates if u[3])
+
+
+def _targets(app):
+    shards = get_shards(app)
+    if shards is None:
+        return [(None, get_pool(app))]
+    return list(enumerate(shards.pools))
+
+
+def reconcile(workers=4, range_size=RANGE_SIZE):
+    """Check every balance against its ledger, scanning only rows added
+    since each account's checkpoint.
+
+    User-id ranges are scanned in parallel on pooled read connections (WAL
+    lets them run alongside writers); each range then commits its
+    checkpoints in one short ledger transaction. The first check of an
+    account takes its balance as the baseline, so drift is reported from
+    then on.
+    """
+    app = current_app._get_current_object()
+    t0 = time.perf_counter()
+    first, last = get_db().execute("SELECT MIN(id), MAX(id) FROM users").fetchone()
+    jobs = [(app, shard, pool, lo, lo + range_size)
+            for shard, pool in _targets(app)
+            for lo in range(first or 0, (last or 0) + 1, range_size)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile') as executor:
+        results = list(executor.map(lambda job: _reconcile_range(*job), jobs))
+    return {
+        "ranges": len(jobs),
+        "accounts": sum(r[0] for r in results),
+        "rows_scanned": sum(r[1] for r in results),
+        "drifted": sum(r[2] for r in results),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+
+
+def drifted_accounts(limit=100):
+    """Accounts whose balance disagreed with the ledger at their last check, worst first."""
+    app = current_app._get_current_object()
+    rows = []
+    for _, pool in _targets(app):
+        db = pool.acquire()
+        try:
+            rows += db.execute("""
+                SELECT user_id, balance_cents, opening_cents + ledger_cents AS expected_cents,
+                       drift_cents, verified_through, checked_at
+                FROM reconcile_checkpoints WHERE drift_cents != 0
+                ORDER BY abs(drift_cents) DESC LIMIT ?
+            """, (limit,)).fetchall()
+        finally:
+            pool.release(db)
+    rows = sorted((dict(r) for r in rows), key=lambda r: -abs(r["drift_cents"]))[:limit]
+    if rows:
+        marks = ','.join('?' * len(rows))
+        names = dict(get_db().execute(f"SELECT id, username FROM users WHERE id IN ({marks})",
+                                      [r["user_id"] for r in rows]).fetchall())
+        for r in rows:
+            r["username"] = names.get(r["user_id"])
+    return rows
+
+
+def checkpoint_stats():
+    app = current_app._get_current_object()
+    stats = {"accounts": 0, "drifted": 0, "oldest_check": None, "latest_check": None}
+    for _, pool in _targets(app):
+        db = pool.acquire()
+        try:
+            count, drifted, oldest, latest = db.execute("""
+                SELECT COUNT(*), coalesce(SUM(drift_cents != 0), 0), MIN(checked_at), MAX(checked_at)
+                FROM reconcile_checkpoints
+            """).fetchone()
+        finally:
+            pool.release(db)
+        stats["accounts"] += count
+        stats["drifted"] += drifted
+        if oldest and (stats["oldest_check"] is None or oldest < stats["oldest_check"]):
+            stats["oldest_check"] = oldest
+        if latest and (stats["latest_check"] is None or latest > stats["latest_check"]):
+            stats["latest_check"] = latest
+    return stats
+
+
+def _accept(db, user_ids):
+    marks = ','.join('?' * len(user_ids))
+    return db.execute(f"""
+        UPDATE reconcile_checkpoints SET opening_cents = opening_cents + drift_cents, drift_cents = 0
+        WHERE user_id IN ({marks}) AND drift_cents != 0
+    """, list(user_ids)).rowcount
+
+
+def accept_drift(user_ids):
+    """Take the current balances of ``user_ids`` as correct, e.g. after an
+    admin override was reviewed. Returns how many accounts were accepted."""
+    shards = get_shards(current_app)
+    if shards is None:
+        return execute(partial(_accept, user_ids=list(user_ids)))
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shards.shard_for(user_id), []).append(user_id)
+    return sum(execute(partial(_accept, user_ids=ids), shard=shard) for shard, ids in by_shard.items())
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+
+class ResponseCache:
+    """Serialized JSON bodies of hot read endpoints, validated by version counters.
+
+    A scope is ('user', id) or ('invoice', id); write paths bump the scopes
+    they touched (through invalidate_users() and publish()), and bump_all()
+    covers changes that reach into other users' responses, such as a
+    rename. An entry is served while the versions it was built under are
+    unchanged and it is younger than ``ttl`` seconds, which bounds how long
+    a write made by another process can go unnoticed. ETags hash the body,
+    so a rebuilt but identical response still validates.
+
+    Versions are stamps from one counter, kept for at most ``max_entries``
+    recently used scopes. A scope without a stamp reads as the newest stamp
+    ever evicted, so forgetting a scope can only turn its entries into
+    misses, never revive a stale one.
+    """
+
+    def __init__(self, ttl=10.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _stamp(self, scope):
+        stamp = self._versions.get(scope)
+        if stamp is None:
+            return self._floor
+        self._versions.move_to_end(scope)
+        return stamp
+
+    def version(self, *scopes):
+        with self._lock:
+            return (self._generation,) + tuple(self._stamp(scope) for scope in scopes)
+
+    def bump(self, *scopes):
+        with self._lock:
+            for scope in scopes:
+                self._clock += 1
+                self._versions[scope] = self._clock
+                self._versions.move_to_end(scope)
+            while len(self._versions) > self.max_entries:
+                _, stamp = self._versions.popitem(last=False)
+                self._floor = max(self._floor, stamp)
+
+    def bump_all(self):
+        with self._lock:
+            self._generation += 1
+            self._versions.clear()
+            self._entries.clear()
+
+    def get(self, key, version):
+        """(etag, body) cached for ``key`` under ``version``, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                etag, body, built_under, expires = entry
+                if built_under == version and expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return etag, body
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, body):
+        etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        with self._lock:
+            self._entries[key] = (etag, body, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag, body
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+def get_response_cache(app) -> ResponseCache:
+    cache = app.extensions.get('response_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('response_cache', ResponseCache(
+            ttl=app.config.get('RESPONSE_CACHE_TTL', 10.0),
+            max_entries=app.config.get('RESPONSE_CACHE_SIZE', 10000),
+        ))
+    return cache
+
+
+def bump_users(*user_ids):
+    get_response_cache(current_app).bump(*(('user', user_id) for user_id in user_ids))
+
+
+def conditional(authenticate, scopes):
+    """Serve a JSON view through the response cache, with ETag/If-None-Match.
+
+    ``authenticate()`` returns the user id (or aborts); ``scopes(uid,
+    **view_args)`` names the versions the response depends on. A
+    revalidation with a current ETag gets 304 without running the view.
+    Only 200 responses are cached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(**view_args):
+            uid = authenticate()
+            cache = get_response_cache(current_app)
+            key = (request.endpoint, uid) + tuple(sorted(view_args.items()))
+            version = cache.version(*scopes(uid, **view_args))
+            entry = cache.get(key, version)
+            if entry is None:
+                rv = current_app.make_response(view(**view_args))
+                if rv.status_code != 200:
+                    return rv
+                entry = cache.put(key, version, rv.get_data())
+            etag, body = entry
+            # The browser revalidates every time; fetch() turns a 304 back into the cached body.
+            headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+            # A plain substring test is enough for a strong tag, in a list or with a W/ prefix.
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match and (etag in if_none_match or if_none_match.strip() == '*'):
+                return current_app.response_class(status=304, headers=headers)
+            return current_app.response_class(body, mimetype='application/json', headers=headers)
+        return wrapped
+    return decorator
@@ -0,0 +1,34 @@
+import re
+
+from flask import current_app
+
+_WORD = re.compile(r'\w+')
+
+
+def fts_available(db) -> bool:
+    """Whether migration 3 created the FTS index for the current DB_PATH.
+
+    Ledger shards carry no FTS index, so sharded search falls back to LIKE.
+    """
+    if current_app.config.get('LEDGER_SHARDS', 1) > 1:
+        return False
+    path = current_app.config['DB_PATH']
+    cached = current_app.extensions.get('transactions_fts')
+    if cached is None or cached[0] != path:
+        row = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions_fts'"
+        ).fetchone()
+        cached = (path, row is not None)
+        current_app.extensions['transactions_fts'] = cached
+    return cached[1]
+
+
+def match_expression(user_id: int, q: str):
+    """FTS5 query for a search box string: every word is a prefix match
+    against description or counterparty, restricted to the user's rows.
+    Returns None when the string has no searchable words."""
+    terms = _WORD.findall(q)
+    if not terms:
+        return None
+    words = ' '.join(f'"{t}"*' for t in terms)
+    return f'owner:u{int(user_id)} AND {{description counterparty}} : ({words})'
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from flask.sessions import SecureCookieSession, SessionInterface
+
+from database import get_db
+from ledger import LedgerBusy, execute
+
+
+def _digest(token):
+    # Only a hash of the cookie is stored, so a copy of the table logs no one in.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SessionStore:
+    """Server-side sessions: an LRU in front of the ``sessions`` table.
+
+    Entries carry their absolute expiry, checked on lookup, so expiring
+    costs nothing until the row is touched; expired rows are deleted in
+    one indexed range at most every ``prune_interval`` seconds. A cached
+    entry is trusted for ``ttl`` seconds, which bounds how long another
+    process keeps honouring a session revoked elsewhere; revocations made
+    in this process drop the entries at once.
+
+    Writes go through the ledger writer (ledger.execute): BEGIN IMMEDIATE
+    on its own connection, never a request's half-used one, and a lock it
+    cannot take in time surfaces as LedgerBusy.
+    """
+
+    def __init__(self, ttl=5.0, max_entries=10000, prune_interval=60.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._epoch = 0
+        self._next_prune = 0.0
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            keys = self._by_user.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[entry[1]]
+
+    def _cache(self, key, data, user_id, expires_at):
+        self._drop(key)
+        self._entries[key] = (data, user_id, expires_at, time.monotonic() + self.ttl)
+        if user_id is not None:
+            self._by_user.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def get(self, token, connect=get_db):
+        """Session data for the cookie ``token``, or None if unknown or expired.
+        ``connect`` is only called on a miss, so a hit never takes a connection."""
+        key = _digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                data, _, expires_at, fresh_until = entry
+                if expires_at > time.time() and fresh_until > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(data)
+                self._drop(key)
+            self.misses += 1
+            epoch = self._epoch
+        row = connect().execute("SELECT user_id, data, expires_at FROM sessions WHERE token_hash = ? AND expires_at > ?",
+                                (key, time.time())).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row["data"])
+        with self._lock:
+            if epoch == self._epoch:
+                self._cache(key, data, row["user_id"], row["expires_at"])
+        return dict(data)
+
+    def put(self, token, data, expires_at):
+        key = _digest(token)
+        user_id = data.get('user_id')
+        now = time.monotonic()
+        prune = now >= self._next_prune
+        if prune:
+            self._next_prune = now + self.prune_interval
+
+        def write(db):
+            db.execute("""
+                INSERT OR REPLACE INTO sessions (token_hash, user_id, data, expires_at, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, user_id, json.dumps(data, ensure_ascii=False), expires_at, time.time()))
+            if prune:
+                db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+
+        execute(write)
+        with self._lock:
+            self._cache(key, dict(data), user_id, expires_at)
+
+    def delete(self, token):
+        key = _digest(token)
+        execute(lambda db: db.execute("DELETE FROM sessions WHERE token_hash = ?", (key,)))
+        with self._lock:
+            self._epoch += 1
+            self._drop(key)
+
+    def revoke_user(self, user_id, keep=None):
+        """End every session of ``user_id`` except the one with cookie ``keep``."""
+        keep = _digest(keep) if keep else ''
+        revoked = execute(lambda db: db.execute("DELETE FROM sessions WHERE user_id = ? AND token_hash != ?",
+                                                (user_id, keep)).rowcount)
+        with self._lock:
+            self._epoch += 1
+            for key in list(self._by_user.get(user_id, ())):
+                if key != keep:
+                    self._drop(key)
+        return revoked
+
+    def update_user(self, user_id, **fields):
+        """Rewrite cached ``fields`` (e.g. a new username) in every session of ``user_id``."""
+        def write(db):
+            for field, value in fields.items():
+                db.execute("UPDATE sessions SET data = json_set(data, ?, ?) WHERE user_id = ?",
+                           (f'$.{field}', value, user_id))
+
+        execute(write)
+        with self._lock:
+            self._epoch += 1
+            for key in list(self._by_user.get(user_id, ())):
+                self._drop(key)
+
+    def prune(self, db) -> int:
+        removed = db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+        db.commit()
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+def get_session_store(app) -> SessionStore:
+    store = app.extensions.get('session_store')
+    if store is None:
+        store = app.extensions.setdefault('session_store', SessionStore(
+            ttl=app.config.get('SESSION_CACHE_TTL', 5.0),
+            max_entries=app.config.get('SESSION_CACHE_SIZE', 10000),
+        ))
+    return store
+
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None, stale=False):
+        super().__init__(initial)
+        self.sid = sid
+        # The request carried a cookie for a session that has ended.
+        self.stale = stale
+        self.identity = self._identity()
+
+    def _identity(self):
+        return self.get('user_id'), self.get('is_admin')
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps session data server-side; the cookie only holds a random token.
+
+    ``prepare`` runs before the first lookup of a request, so the schema
+    exists when the sessions table is read. The token is replaced whenever
+    the logged-in user or the admin flag changes.
+    """
+
+    session_class = ServerSession
+
+    def __init__(self, prepare=None):
+        self.prepare = prepare
+
+    def open_session(self, app, request):
+        token = request.cookies.get(self.get_cookie_name(app))
+        if token:
+            if self.prepare is not None:
+                self.prepare()
+            data = get_session_store(app).get(token)
+            if data is not None:
+                return self.session_class(data, sid=token)
+            return self.session_class(stale=True)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        try:
+            self._save(app, session, response)
+        except LedgerBusy as e:
+            # Flask calls save_session after the errorhandlers have run, so an
+            # exception here would be a 500: answer with LedgerBusy's own 503.
+            busy = app.make_response(app.handle_user_exception(e))
+            response.status = busy.status
+            response.headers = busy.headers
+            response.response = busy.response
+            response.direct_passthrough = False
+
+    def _save(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        store = get_session_store(app)
+
+        if not session:
+            if session.sid is not None:
+                store.delete(session.sid)
+            if session.sid is not None or session.stale:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        if session.sid is not None and session._identity() != session.identity:
+            store.delete(session.sid)
+            session.sid = None
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        store.put(session.sid, dict(session),
+                  time.time() + app.permanent_session_lifetime.total_seconds())
+        response.vary.add('Cookie')
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def revoke_sessions(user_id, keep=None) -> int:
+    """End the sessions of ``user_id`` (all but ``keep``, a session object).
+    A no-op with the default cookie sessions, which cannot be revoked."""
+    if not isinstance(current_app.session_interface, ServerSessionInterface):
+        return 0
+    return get_session_store(current_app).revoke_user(user_id, keep=getattr(keep, 'sid', None))
+
+
+def update_sessions(user_id, **fields):
+    if isinstance(current_app.session_interface, ServerSessionInterface):
+        get_session_store(current_app).update_user(user_id, **fields)
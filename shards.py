@@ -0,0 +1,298 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+from database import (
+    ConnectionPool, IDEMPOTENCY_SCHEMA, RECONCILE_SCHEMA, SUMMARIES_SCHEMA, _run_script, get_db, get_pool,
+    migrate,
+)
+from metrics import InstrumentedConnection
+
+log = logging.getLogger(__name__)
+
+# -------------------------
+# Shard schema
+# -------------------------
+# A shard owns the balances and ledger rows of the users hashed to it. The
+# main database stays the directory (profiles, credentials, invoices) and is
+# attached to every shard connection as 'directory', so unqualified joins on
+# users in the existing read queries resolve there unchanged.
+SHARD_MIGRATIONS = [
+    (1, lambda db: _run_script(db, """
+    CREATE TABLE IF NOT EXISTS shard_meta (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      shard_index INTEGER NOT NULL,
+      shard_count INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS balances (
+      id INTEGER PRIMARY KEY,
+      balance_cents INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS transactions (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      type TEXT CHECK(type IN ('debit','credit')) NOT NULL,
+      amount_cents INTEGER NOT NULL,
+      description TEXT,
+      counterparty_id INTEGER,
+      invoice_id INTEGER,
+      created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_trans_user_created ON transactions(user_id, created_at, id);
+
+    -- Credits owed to users on other shards, written with the payer's debit.
+    CREATE TABLE IF NOT EXISTS transfer_outbox (
+      xid TEXT PRIMARY KEY,
+      kind TEXT NOT NULL CHECK(kind IN ('transfer','invoice')),
+      payer_id INTEGER NOT NULL,
+      recipient_id INTEGER NOT NULL,
+      amount_cents INTEGER NOT NULL,
+      description TEXT,
+      invoice_id INTEGER,
+      debit_tx_id INTEGER NOT NULL,
+      idempotency_key TEXT,
+      created_at TEXT NOT NULL
+    ) WITHOUT ROWID;
+
+    -- Credits already applied here, so redelivery is a no-op.
+    CREATE TABLE IF NOT EXISTS transfer_inbox (
+      xid TEXT PRIMARY KEY,
+      created_at TEXT NOT NULL
+    ) WITHOUT ROWID;
+    """ + SUMMARIES_SCHEMA + IDEMPOTENCY_SCHEMA)),
+    (2, lambda db: _run_script(db, RECONCILE_SCHEMA)),
+]
+
+OUTBOX_COLUMNS = ('xid', 'kind', 'payer_id', 'recipient_id', 'amount_cents', 'description',
+                  'invoice_id', 'debit_tx_id', 'idempotency_key', 'created_at')
+
+
+def shard_path(main_path, index):
+    root, ext = os.path.splitext(main_path)
+    return f"{root}.shard{index}{ext or '.sqlite3'}"
+
+
+class ShardSet:
+    """N ledger files; user ``u`` lives on shard ``u % N``.
+
+    Every shard has its own connection pool (and, in ledger.py, its own
+    group-commit writer), so writes for users on different shards take
+    different locks and proceed in parallel.
+    """
+
+    def __init__(self, main_pool, count, pragmas=None, cached_statements=256, max_idle=16,
+                 factory=sqlite3.Connection, mirror_interval=0.05):
+        main_path = main_pool.path
+        self.main_pool = main_pool
+        self.main_path = main_path
+        self.count = count
+        self.paths = [shard_path(main_path, i) for i in range(count)]
+        self.pools = [
+            ConnectionPool(path, pragmas=pragmas, cached_statements=cached_statements, max_idle=max_idle,
+                           factory=factory, attach={'directory': main_path})
+            for path in self.paths
+        ]
+        self.mirror = BalanceMirror(self, mirror_interval)
+
+    def run_on_each(self, fn):
+        """``fn(db)`` on a connection to every shard, in shard order; returns the results."""
+        results = []
+        for pool in self.pools:
+            db = pool.acquire()
+            try:
+                results.append(fn(db))
+            finally:
+                pool.release(db)
+        return results
+
+    def shard_for(self, user_id) -> int:
+        return int(user_id) % self.count
+
+    def balance(self, db, user_id):
+        """The shard-owned balance, or None while the directory still owns it."""
+        row = db.execute("SELECT balance_cents FROM balances WHERE id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+
+class BalanceMirror:
+    """Copies shard balances back into users.balance_cents in the background.
+
+    Admin listings, balance filters and the user_stats counters keep reading
+    the directory; they lag the shards by about ``interval`` seconds, and the
+    directory takes one write lock per flush instead of one per transfer.
+    """
+
+    def __init__(self, shards, interval):
+        self.shards = shards
+        self.interval = interval
+        self._dirty = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def mark(self, *user_ids):
+        with self._cond:
+            self._dirty.update(user_ids)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='balance-mirror', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+            # Let a burst of writes coalesce into one directory transaction.
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Balance mirror flush failed; will retry")
+
+    def flush(self):
+        with self._cond:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        by_shard = {}
+        for user_id in dirty:
+            by_shard.setdefault(self.shards.shard_for(user_id), []).append(user_id)
+        updates = []
+        try:
+            for index, user_ids in by_shard.items():
+                pool = self.shards.pools[index]
+                db = pool.acquire()
+                try:
+                    marks = ','.join('?' * len(user_ids))
+                    rows = db.execute(f"SELECT id, balance_cents FROM balances WHERE id IN ({marks})", user_ids)
+                    updates.extend((r["balance_cents"], r["id"], r["balance_cents"]) for r in rows)
+                finally:
+                    pool.release(db)
+            main = self.shards.main_pool
+            db = main.acquire()
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                db.executemany("UPDATE users SET balance_cents = ? WHERE id = ? AND balance_cents != ?", updates)
+                db.commit()
+            finally:
+                main.release(db)
+        except Exception:
+            with self._cond:
+                self._dirty |= dirty
+            raise
+
+
+_shards_lock = threading.Lock()
+
+
+def get_shards(app):
+    """The app's ShardSet, or None when LEDGER_SHARDS is 1 (single-file mode)."""
+    count = app.config.get('LEDGER_SHARDS', 1)
+    if count <= 1:
+        return None
+    path = app.config['DB_PATH']
+    shards = app.extensions.get('ledger_shards')
+    if shards is None or shards.main_path != path or shards.count != count:
+        with _shards_lock:
+            shards = app.extensions.get('ledger_shards')
+            if shards is None or shards.main_path != path or shards.count != count:
+                shards = ShardSet(
+                    get_pool(app), count,
+                    pragmas=app.config.get('SQLITE_PRAGMAS'),
+                    cached_statements=app.config.get('SQLITE_CACHED_STATEMENTS', 256),
+                    max_idle=app.config.get('SQLITE_POOL_SIZE', 16),
+                    factory=InstrumentedConnection if app.config.get('METRICS_ENABLED') else sqlite3.Connection,
+                    mirror_interval=app.config.get('LEDGER_MIRROR_INTERVAL', 0.05),
+                )
+                app.extensions['ledger_shards'] = shards
+    return shards
+
+
+def get_ledger_pool(app, user_id) -> ConnectionPool:
+    """Pool of ``user_id``'s ledger, for work that outlives the request's connections."""
+    shards = get_shards(app)
+    if shards is None:
+        return get_pool(app)
+    return shards.pools[shards.shard_for(user_id)]
+
+
+def get_ledger_db(user_id):
+    """Connection holding ``user_id``'s ledger: their shard, or the main DB."""
+    shards = get_shards(current_app)
+    if shards is None:
+        return get_db()
+    index = shards.shard_for(user_id)
+    dbs = g.setdefault('_shard_dbs', {})
+    db = dbs.get(index)
+    if db is None:
+        db = dbs[index] = shards.pools[index].acquire()
+    return db
+
+
+def close_ledger_dbs(exception=None):
+    dbs = g.pop('_shard_dbs', None)
+    if dbs:
+        shards = get_shards(current_app)
+        for index, db in dbs.items():
+            shards.pools[index].release(db)
+
+
+def prepare_shards(app):
+    """Migrate every shard and move any ledger rows still in the main DB.
+
+    The split copies balances and history with INSERT OR IGNORE before the
+    main copy is deleted, so an interrupted run can simply be repeated.
+    """
+    shards = get_shards(app)
+    if shards is None:
+        return
+    for index, pool in enumerate(shards.pools):
+        db = pool.acquire()
+        try:
+            migrate(db, SHARD_MIGRATIONS)
+            db.execute("INSERT OR IGNORE INTO shard_meta (id, shard_index, shard_count) VALUES (1, ?, ?)",
+                       (index, shards.count))
+            meta = db.execute("SELECT shard_index, shard_count FROM shard_meta").fetchone()
+            db.commit()
+            if tuple(meta) != (index, shards.count):
+                raise RuntimeError(f"{shards.paths[index]} belongs to shard {meta[0]} of {meta[1]}, "
+                                   f"not {index} of {shards.count}; LEDGER_SHARDS cannot change")
+            if db.execute("SELECT 1 FROM directory.transactions LIMIT 1").fetchone() is None:
+                continue
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("""
+                    INSERT OR IGNORE INTO balances (id, balance_cents)
+                    SELECT id, balance_cents FROM directory.users WHERE id % ? = ?
+                """, (shards.count, index))
+                db.execute("""
+                    INSERT OR IGNORE INTO transactions
+                      (id, user_id, type, amount_cents, description, counterparty_id, invoice_id, created_at)
+                    SELECT id, user_id, type, amount_cents, description, counterparty_id, invoice_id, created_at
+                    FROM directory.transactions WHERE user_id % ? = ?
+                """, (shards.count, index))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        finally:
+            pool.release(db)
+
+    main = get_db()
+    if main.execute("SELECT 1 FROM transactions LIMIT 1").fetchone() is not None:
+        main.execute("BEGIN IMMEDIATE")
+        try:
+            main.execute("DELETE FROM reconcile_checkpoints")
+            main.execute("DELETE FROM transactions")
+            main.execute("DELETE FROM daily_totals")
+            main.execute("DELETE FROM counterparty_totals")
+            main.commit()
+        except Exception:
+            main.rollback()
+            raise
@@ -0,0 +1,220 @@
+import logging
+import threading
+from datetime import datetime
+
+from database import _run_script, get_db, get_pool
+from shards import get_shards
+
+log = logging.getLogger(__name__)
+
+# -------------------------
+# Append-only ledger
+# -------------------------
+# With LEDGER_APPEND_ONLY on, ledger rows are never updated or deleted
+# (triggers enforce it; a "delete" appends a reversal) and balances are
+# not written on the hot path. A balance is the user's latest snapshot
+# plus the ledger rows after it. A user with no snapshot yet takes
+# users.balance_cents as the opening amount, which already covers
+# everything up to ledger_mode.append_only_since. The compactor keeps the
+# tail short and copies balances back to users.balance_cents in batches
+# for the admin listings.
+SIGNED_AMOUNT = "CASE t.type WHEN 'credit' THEN t.amount_cents ELSE -t.amount_cents END"
+
+
+def balance_sql(user_id):
+    """SQL expression for the current balance of ``user_id`` (a column or parameter)."""
+    return f"""coalesce(
+      (SELECT s.balance_cents + coalesce((SELECT SUM({SIGNED_AMOUNT}) FROM transactions t
+                                          WHERE t.user_id = s.user_id AND t.id > s.through_id), 0)
+       FROM balance_snapshots s WHERE s.user_id = {user_id} ORDER BY s.through_id DESC LIMIT 1),
+      (SELECT u.balance_cents + coalesce((SELECT SUM({SIGNED_AMOUNT}) FROM transactions t
+                                          WHERE t.user_id = u.id AND t.id > m.append_only_since), 0)
+       FROM users u CROSS JOIN ledger_mode m WHERE u.id = {user_id}))"""
+
+
+LEDGER_BALANCE = f"SELECT {balance_sql(':user_id')}"
+
+APPEND_ONLY_GUARDS = """
+    CREATE INDEX IF NOT EXISTS idx_trans_user_tail ON transactions(user_id, id, type, amount_cents);
+
+    CREATE TRIGGER IF NOT EXISTS ledger_append_only_ud BEFORE UPDATE ON transactions BEGIN
+      SELECT RAISE(ABORT, 'ledger is append-only');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS ledger_append_only_dd BEFORE DELETE ON transactions BEGIN
+      SELECT RAISE(ABORT, 'ledger is append-only');
+    END;
+"""
+
+DROP_APPEND_ONLY_GUARDS = """
+    DROP TRIGGER IF EXISTS ledger_append_only_ud;
+    DROP TRIGGER IF EXISTS ledger_append_only_dd;
+    DROP INDEX IF EXISTS idx_trans_user_tail;
+"""
+
+
+def append_only(app) -> bool:
+    return bool(app.config.get('LEDGER_APPEND_ONLY', False))
+
+
+def ledger_balance(db, user_id):
+    """The user's balance in append-only mode, or None if there is no such user."""
+    return db.execute(LEDGER_BALANCE, {"user_id": user_id}).fetchone()[0]
+
+
+def balance_at(db, user_id, at, current, snapshots=False):
+    """Balance of ``user_id`` at ISO time ``at``, given its ``current`` balance.
+
+    With ``snapshots`` (append-only mode) it starts from the snapshots
+    around ``at``, so only one compaction interval of rows is read;
+    otherwise it walks back from the current balance over the rows created
+    after ``at``.
+    """
+    if snapshots:
+        before = db.execute("""
+            SELECT through_id, balance_cents FROM balance_snapshots
+            WHERE user_id = ? AND taken_at <= ? ORDER BY through_id DESC LIMIT 1
+        """, (user_id, at)).fetchone()
+        after = db.execute("""
+            SELECT through_id, balance_cents FROM balance_snapshots
+            WHERE user_id = ? AND taken_at > ? ORDER BY through_id LIMIT 1
+        """, (user_id, at)).fetchone()
+        if before is not None:
+            upper = after["through_id"] if after is not None else None
+            net = db.execute(f"""
+                SELECT coalesce(SUM({SIGNED_AMOUNT}), 0) FROM transactions t
+                WHERE t.user_id = ? AND t.id > ? AND (? IS NULL OR t.id <= ?) AND t.created_at <= ?
+            """, (user_id, before["through_id"], upper, upper, at)).fetchone()[0]
+            return before["balance_cents"] + net
+        if after is not None:
+            current = after["balance_cents"]
+            later = db.execute(f"""
+                SELECT coalesce(SUM({SIGNED_AMOUNT}), 0) FROM transactions t
+                WHERE t.user_id = ? AND t.id <= ? AND t.created_at > ?
+            """, (user_id, after["through_id"], at)).fetchone()[0]
+            return current - later
+    later = db.execute(f"""
+        SELECT coalesce(SUM({SIGNED_AMOUNT}), 0) FROM transactions t
+        WHERE t.user_id = ? AND t.created_at > ?
+    """, (user_id, at)).fetchone()[0]
+    return current - later
+
+
+class SnapshotCompactor:
+    """Background thread that snapshots balances whose tail grew past
+    ``max_tail`` rows, every ``interval`` seconds.
+
+    Each pass looks only at rows appended since the previous one (a rowid
+    range), and in the same transaction copies the balances of the users it
+    saw into users.balance_cents: one batched write per pass instead of one
+    per transfer.
+    """
+
+    def __init__(self, pool, interval=5.0, max_tail=64):
+        self.pool = pool
+        self.interval = interval
+        self.max_tail = max_tail
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='snapshot-compactor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.compact()
+            except Exception:
+                log.exception("Snapshot compaction failed; will retry")
+
+    def compact(self):
+        """Run one pass; returns how many snapshots were taken."""
+        db = self.pool.acquire()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                taken = compact(db, self.max_tail)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            return taken
+        finally:
+            self.pool.release(db)
+
+
+def compact(db, max_tail=64):
+    mode = db.execute("SELECT append_only_since, compacted_through FROM ledger_mode").fetchone()
+    if mode is None:
+        return 0
+    watermark = db.execute("SELECT coalesce(MAX(id), 0) FROM transactions").fetchone()[0]
+    if watermark <= mode["compacted_through"]:
+        return 0
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS compact_users (user_id INTEGER PRIMARY KEY)")
+    db.execute("DELETE FROM temp.compact_users")
+    db.execute("""
+        INSERT INTO temp.compact_users SELECT DISTINCT user_id FROM transactions
+        WHERE id > ? AND id <= ?
+    """, (mode["compacted_through"], watermark))
+    # Every active user gets a first snapshot, so the mirror below never
+    # overwrites an opening balance that is still in use.
+    taken = db.execute(f"""
+        INSERT INTO balance_snapshots (user_id, through_id, balance_cents, taken_at)
+        SELECT c.user_id, :watermark, {balance_sql('c.user_id')}, :now
+        FROM temp.compact_users c
+        WHERE NOT EXISTS (SELECT 1 FROM balance_snapshots s WHERE s.user_id = c.user_id)
+           OR (SELECT COUNT(*) FROM transactions t
+               WHERE t.user_id = c.user_id
+                 AND t.id > (SELECT MAX(s.through_id) FROM balance_snapshots s WHERE s.user_id = c.user_id)
+              ) >= :max_tail
+    """, {"watermark": watermark, "now": datetime.utcnow().isoformat(), "max_tail": max_tail}).rowcount
+    db.execute(f"""
+        UPDATE users SET balance_cents = {balance_sql('users.id')}
+        WHERE id IN (SELECT user_id FROM temp.compact_users)
+    """)
+    db.execute("UPDATE ledger_mode SET compacted_through = ?", (watermark,))
+    db.execute("DELETE FROM temp.compact_users")
+    return taken
+
+
+def prepare_ledger_mode(app):
+    """Switch the main DB into or out of append-only mode to match the config.
+
+    Entering records the current ledger position as the opening point and
+    installs the guards; leaving writes the derived balances back into
+    users.balance_cents, so the mutable mode resumes where this one stopped.
+    """
+    db = get_db()
+    state = db.execute("SELECT append_only_since FROM ledger_mode").fetchone()
+    if append_only(app):
+        if get_shards(app) is not None:
+            raise RuntimeError("LEDGER_APPEND_ONLY does not support LEDGER_SHARDS > 1")
+        if state is None:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                since = db.execute("SELECT coalesce(MAX(id), 0) FROM transactions").fetchone()[0]
+                db.execute("INSERT INTO ledger_mode (id, append_only_since, compacted_through) VALUES (1, ?, ?)",
+                           (since, since))
+                _run_script(db, APPEND_ONLY_GUARDS)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        if app.extensions.get('snapshot_compactor') is None:
+            app.extensions['snapshot_compactor'] = SnapshotCompactor(
+                get_pool(app),
+                interval=app.config.get('LEDGER_COMPACT_INTERVAL', 5.0),
+                max_tail=app.config.get('LEDGER_SNAPSHOT_TAIL', 64),
+            )
+    elif state is not None:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(f"UPDATE users SET balance_cents = {balance_sql('users.id')}")
+            db.execute("DELETE FROM balance_snapshots")
+            db.execute("DELETE FROM ledger_mode")
+            _run_script(db, DROP_APPEND_ONLY_GUARDS)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
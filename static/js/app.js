@@ -170,6 +170,7 @@ async function initProfilePage() {
 // ----------------- Account page -----------------
 let currentFilter = 'all';
 let searchQuery = '';
+let nextCursor = null;
 let scanning = false;
 let stream = null;
 let scanRaf = null;
@@ -194,14 +195,40 @@ async function loadMe() {
     document.getElementById('usernameLabel').textContent = '@' + user.username;
 }
 
-async function loadTransactions() {
+// ---- Live updates (SSE) ----
+let shownInvoiceId = null;
+
+function subscribeEvents() {
+    if (!window.EventSource) return;
+    const events = new EventSource('/api/events');
+    events.addEventListener('balance', (e) => {
+        const data = JSON.parse(e.data);
+        if (data.balance_cents != null) {
+            document.getElementById('balanceValue').textContent = fmtMoney(data.balance_cents);
+        } else {
+            loadMe().catch(() => {});
+        }
+        loadTransactions().catch(() => {});
+    });
+    events.addEventListener('invoice', (e) => {
+        const invoice = JSON.parse(e.data);
+        if (invoice.id === shownInvoiceId && invoice.status === 'paid') {
+            toast(`Счёт #${invoice.id} оплачен`, 'success');
+        }
+    });
+}
+
+async function loadTransactions(append = false) {
     const params = new URLSearchParams();
     if (currentFilter === 'debit' || currentFilter === 'credit') params.set('type', currentFilter);
     if (searchQuery) params.set('q', searchQuery);
+    if (append && nextCursor) params.set('before', nextCursor);
     const data = await api('/api/transactions?' + params.toString());
     const list = document.getElementById('txList');
-    list.innerHTML = '';
-    document.getElementById('emptyState').hidden = data.items.length > 0;
+    if (!append) list.innerHTML = '';
+    nextCursor = data.next_cursor;
+    document.getElementById('loadMoreBtn').hidden = !nextCursor;
+    document.getElementById('emptyState').hidden = list.children.length + data.items.length > 0;
 
     for (const t of data.items) {
         const li = document.createElement('li');
@@ -225,12 +252,9 @@ async function loadTransactions() {
         amount.textContent = (t.type === 'debit' ? '−' : '+') + fmtMoney(t.amount_cents);
 
         li.appendChild(left); li.appendChild(amount);
+        li.addEventListener('click', () => showTransactionDetails(li.dataset.txId));
         list.appendChild(li);
     }
-
-    document.querySelectorAll('.tx-item').forEach(item => {
-        item.addEventListener('click', () => showTransactionDetails(item.dataset.txId));
-    });
 }
 
 async function showTransactionDetails(txId) {
@@ -371,6 +395,7 @@ function bindForms() {
                 method: 'POST',
                 body: JSON.stringify(Object.fromEntries(fd.entries()))
             });
+            shownInvoiceId = invoice.id;
             document.getElementById('qrImage').src = invoice.qr_url;
             document.getElementById('payloadText').textContent = invoice.payload;
             document.getElementById('invoiceResult').hidden = false;
@@ -421,7 +446,11 @@ async function initAccountPage() {
 
     await Promise.all([loadMe(), loadTransactions()]);
     bindFilters();
+    document.getElementById('loadMoreBtn').addEventListener('click', () => {
+        loadTransactions(true).catch(err => toast(err.message, 'error'));
+    });
     bindForms();
+    subscribeEvents();
 
     document.getElementById('scanBtn').addEventListener('click', () => { openModal('scanModal'); startScanner(); });
     document.getElementById('createInvoiceBtn').addEventListener('click', () => {
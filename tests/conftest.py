@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as libank  # noqa: E402
+from database import get_db  # noqa: E402
+
+# Demo users seeded by init_db().
+ALICE = ('alice', 'Pass1234')
+BOB = ('bob', 'Qwerty987')
+
+
+@pytest.fixture
+def config():
+    """app.config overrides applied before the schema is set up; override per module."""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, config):
+    """The LiBank app on a fresh database file, with per-test caches and pools."""
+    flask_app = libank.app
+    monkeypatch.setitem(flask_app.config, 'DB_PATH', str(tmp_path / 'bank.sqlite3'))
+    monkeypatch.setitem(flask_app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    for key, value in config.items():
+        monkeypatch.setitem(flask_app.config, key, value)
+    monkeypatch.setattr(libank, '_schema_ready', False)
+    extensions = dict(flask_app.extensions)
+    flask_app.extensions.clear()
+    with flask_app.app_context():
+        libank.ensure_db()
+    yield flask_app
+    pools = [flask_app.extensions.get('sqlite_pool')]
+    shards = flask_app.extensions.get('ledger_shards')
+    if shards is not None:
+        pools += shards.pools
+    for pool in filter(None, pools):
+        pool.close_all()
+    flask_app.extensions.clear()
+    flask_app.extensions.update(extensions)
+
+
+@pytest.fixture
+def login(app):
+    """login(username, password) -> a test client with a session for that user."""
+    def login(username, password):
+        client = app.test_client()
+        resp = client.post('/api/login', json={'username': username, 'password': password})
+        assert resp.status_code == 200, resp.get_json()
+        return client
+    return login
+
+
+@pytest.fixture
+def db(app):
+    with app.app_context():
+        yield get_db()
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from asgi import ASGIApp
+
+
+def http_scope(method, path, headers=()):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+            'headers': [(b'content-type', b'application/json'), *headers]}
+
+
+async def call(asgi_app, scope, chunks):
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    received = []
+
+    async def receive():
+        received.append(None)
+        return messages.pop(0)
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return sent[0]['status'], body, len(received)
+
+
+@pytest.fixture
+def asgi_app(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 4096)
+    monkeypatch.setitem(app.config, 'ASGI_BODY_SPOOL', 100)
+    asgi_app = ASGIApp(app, workers=2)
+    yield asgi_app
+    asgi_app.executor.shutdown()
+
+
+def test_declared_oversize_body_is_rejected_before_reading(asgi_app):
+    scope = http_scope('POST', '/api/login', [(b'content-length', b'1000000')])
+    status, body, reads = asyncio.run(call(asgi_app, scope, [b'x' * 10]))
+    assert status == 413
+    assert json.loads(body)['ok'] is False
+    assert reads == 0
+
+
+def test_streamed_oversize_body_stops_at_the_limit(asgi_app):
+    status, _, reads = asyncio.run(call(asgi_app, http_scope('POST', '/api/login'), [b'x' * 1000] * 50))
+    assert status == 413
+    assert reads == 5
+
+
+def test_spooled_body_reaches_the_app(asgi_app):
+    payload = json.dumps({'username': 'alice', 'password': 'Pass1234', 'pad': 'x' * 500}).encode()
+    chunks = [payload[:200], payload[200:]]
+    status, body, _ = asyncio.run(call(asgi_app, http_scope('POST', '/api/login'), chunks))
+    assert status == 200
+    assert json.loads(body)['ok'] is True
+
+
+def test_lifespan_shutdown_does_not_block_the_loop(asgi_app):
+    release = threading.Event()
+    # Stands in for a long request still running on the executor.
+    in_flight = asgi_app.executor.submit(release.wait, 5)
+
+    async def main():
+        lifespan = asyncio.Queue()
+        sent = []
+
+        async def lifespan_send(message):
+            sent.append(message['type'])
+
+        await lifespan.put({'type': 'lifespan.shutdown'})
+        shutdown = asyncio.ensure_future(asgi_app({'type': 'lifespan'}, lifespan.get, lifespan_send))
+        started = time.monotonic()
+        await asyncio.sleep(0.05)
+        # The loop kept running while shutdown waits for the executor.
+        assert time.monotonic() - started < 1
+        assert not shutdown.done()
+        release.set()
+        await shutdown
+        return sent
+
+    assert asyncio.run(main()) == ['lifespan.shutdown.complete']
+    assert in_flight.result() is True
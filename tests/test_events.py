@@ -0,0 +1,48 @@
+import asyncio
+import threading
+
+from events import EventHub
+
+
+def test_push_from_writer_thread_wakes_the_loop():
+    hub = EventHub()
+    sub = hub.subscribe(1)
+
+    async def main():
+        sub.bind_loop(asyncio.get_running_loop())
+        threading.Thread(target=hub.publish, args=(1, 'balance', {'balance_cents': 5})).start()
+        await asyncio.wait_for(sub.ready.wait(), 5)
+        return sub.drain()
+
+    [(_, name, data)] = asyncio.run(main())
+    assert (name, data) == ('balance', {'balance_cents': 5})
+
+
+def test_push_while_binding_a_loop(monkeypatch):
+    hub = EventHub()
+    sub = hub.subscribe(1)
+    real_event = asyncio.Event
+
+    def event_created_mid_push():
+        # A writer thread publishes while bind_loop() is still setting up.
+        hub.publish(1, 'balance', {})
+        return real_event()
+
+    monkeypatch.setattr(asyncio, 'Event', event_created_mid_push)
+    loop = asyncio.new_event_loop()
+    try:
+        sub.bind_loop(loop)
+    finally:
+        loop.close()
+    assert [name for _, name, _ in sub.drain()] == ['balance']
+
+
+def test_resume_after_last_event_id():
+    hub = EventHub(history=10)
+    live = hub.subscribe(1)
+    for n in range(3):
+        hub.publish(1, 'balance', {'n': n})
+        hub.publish(2, 'balance', {'n': n})
+    first_id = live.drain()[0][0]
+    resumed = hub.subscribe(1, last_event_id=first_id).drain()
+    assert [data['n'] for _, _, data in resumed] == [1, 2]
@@ -0,0 +1,71 @@
+import csv
+import io
+import json
+import threading
+
+import pytest
+
+from app import EXPORT_CHUNK_SIZE
+from conftest import ALICE, BOB
+
+
+def seed_transactions(db, username, count):
+    """``count`` credits for ``username``, two per timestamp so paging has to break ties on id."""
+    uid = db.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+    db.executemany(
+        "INSERT INTO transactions (user_id, type, amount_cents, description, created_at) VALUES (?, 'credit', ?, ?, ?)",
+        ((uid, n + 1, f"row {n}", f"2024-01-01T00:00:00.{n // 2:06d}") for n in range(count)))
+    db.commit()
+    return [r[0] for r in db.execute(
+        "SELECT id FROM transactions WHERE user_id = ? ORDER BY created_at DESC, id DESC", (uid,))]
+
+
+def exported_ids(body, fmt):
+    if fmt == 'csv':
+        return [int(row[0]) for row in list(csv.reader(io.StringIO(body)))[1:]]
+    return [json.loads(line)['id'] for line in body.splitlines()]
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl'])
+@pytest.mark.parametrize('count', [EXPORT_CHUNK_SIZE - 1, EXPORT_CHUNK_SIZE, EXPORT_CHUNK_SIZE + 1,
+                                   2 * EXPORT_CHUNK_SIZE + 3])
+def test_export_pages_across_chunk_boundary(db, login, fmt, count):
+    expected = seed_transactions(db, ALICE[0], count)
+    resp = login(*ALICE).get(f'/api/transactions/export?format={fmt}')
+    assert resp.status_code == 200
+    assert exported_ids(resp.get_data(as_text=True), fmt) == expected
+
+
+def test_export_concurrent_with_logins(app, db, login):
+    # The streamed body outlives the view; its connection must not go back
+    # to the pool while other requests check connections out and write.
+    expected = seed_transactions(db, ALICE[0], 3 * EXPORT_CHUNK_SIZE + 1)
+    exporters = [login(*ALICE) for _ in range(4)]
+    failures = []
+
+    def export(client):
+        for _ in range(3):
+            resp = client.get('/api/transactions/export?format=csv', buffered=False)
+            body = b''.join(resp.response).decode()
+            resp.close()
+            if resp.status_code != 200 or exported_ids(body, 'csv') != expected:
+                failures.append(('export', resp.status_code))
+
+    def sign_in():
+        for _ in range(15):
+            client = app.test_client()
+            resp = client.post('/api/login', json={'username': BOB[0], 'password': BOB[1]})
+            if resp.status_code != 200:
+                failures.append(('login', resp.status_code, resp.get_json()))
+                continue
+            resp = client.get('/api/me')
+            if resp.status_code != 200:
+                failures.append(('me', resp.status_code))
+
+    threads = [threading.Thread(target=export, args=(client,)) for client in exporters]
+    threads += [threading.Thread(target=sign_in) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert failures == []
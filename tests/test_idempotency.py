@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from conftest import ALICE, BOB
+
+
+@pytest.fixture(params=[1, 2], ids=['single', 'sharded'])
+def config(request):
+    return {'LEDGER_SHARDS': request.param}
+
+
+def transfer(client, key, amount='10'):
+    return client.post('/api/transfer', json={'recipient_username': BOB[0], 'amount': amount},
+                       headers={'Idempotency-Key': key})
+
+
+def balance(client):
+    return client.get('/api/me').get_json()['user']['balance_cents']
+
+
+def test_repeated_transfer_is_replayed(app, login):
+    alice = login(*ALICE)
+    first = transfer(alice, 'k-1')
+    assert first.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+
+    again = transfer(alice, 'k-1')
+    assert again.status_code == 200
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert again.get_json() == first.get_json()
+
+    # After a restart the stored response comes from the table.
+    app.extensions.pop('idempotency_cache')
+    assert transfer(alice, 'k-1').get_json() == first.get_json()
+    assert balance(alice) == 500000 - 1000
+
+
+def test_key_reused_for_another_request_is_422(login):
+    alice = login(*ALICE)
+    assert transfer(alice, 'k-1').status_code == 200
+    assert transfer(alice, 'k-1', amount='11').status_code == 422
+    assert balance(alice) == 500000 - 1000
+
+
+def test_keys_are_per_user(login):
+    alice, bob = login(*ALICE), login(*BOB)
+    assert transfer(alice, 'shared').status_code == 200
+    resp = bob.post('/api/transfer', json={'recipient_username': ALICE[0], 'amount': '10'},
+                    headers={'Idempotency-Key': 'shared'})
+    assert resp.status_code == 200
+    assert 'Idempotent-Replayed' not in resp.headers
+
+
+def test_repeated_payment_is_replayed(login):
+    alice, bob = login(*ALICE), login(*BOB)
+    invoice_id = bob.post('/api/invoices', json={'amount': '25'}).get_json()['invoice']['id']
+    pay = lambda: alice.post('/api/pay', json={'invoice_id': invoice_id}, headers={'Idempotency-Key': 'pay-1'})
+    first = pay()
+    assert first.status_code == 200, first.get_json()
+    again = pay()
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert again.get_json() == first.get_json()
+    assert balance(alice) == 500000 - 2500
+    assert balance(bob) == 250000 + 2500
+
+
+def test_concurrent_retries_debit_once(login):
+    clients = [login(*ALICE) for _ in range(6)]
+    responses = []
+
+    def send(client):
+        responses.append(transfer(client, 'burst'))
+
+    threads = [threading.Thread(target=send, args=(client,)) for client in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [r.status_code for r in responses] == [200] * 6
+    assert len({r.get_data() for r in responses}) == 1
+    assert balance(clients[0]) == 500000 - 1000
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from conftest import ALICE
+
+
+@pytest.fixture
+def qr_dir(app, tmp_path, monkeypatch):
+    path = tmp_path / 'qr'
+    monkeypatch.setitem(app.config, 'QR_CACHE_DIR', str(path))
+    return path
+
+
+def create_invoice(client, amount='10'):
+    resp = client.post('/api/invoices', json={'amount': amount})
+    assert resp.status_code == 200
+    return resp.get_json()['invoice']
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def test_missing_invoice_is_404_and_not_cached(app, qr_dir):
+    client = app.test_client()
+    assert client.get('/api/qr/424242.png').status_code == 404
+    assert client.get('/api/qr/424242.svg').status_code == 404
+    assert not qr_dir.exists()
+    assert 'qr_cache' not in app.extensions
+
+
+def test_unknown_format_is_404(app, login):
+    invoice = create_invoice(login(*ALICE))
+    assert app.test_client().get(f"/api/qr/{invoice['id']}.gif").status_code == 404
+
+
+@pytest.mark.parametrize('fmt', ['png', 'svg'])
+def test_qr_is_public_and_immutable(app, login, fmt):
+    invoice = create_invoice(login(*ALICE))
+    anonymous = app.test_client()
+    resp = anonymous.get(f"/api/qr/{invoice['id']}.{fmt}")
+    assert resp.status_code == 200
+    assert resp.mimetype == {'png': 'image/png', 'svg': 'image/svg+xml'}[fmt]
+    assert resp.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    etag = resp.headers['ETag']
+
+    again = anonymous.get(f"/api/qr/{invoice['id']}.{fmt}", headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.headers['ETag'] == etag
+    assert again.get_data() == b''
+    assert anonymous.get(f"/api/qr/{invoice['id']}.{fmt}",
+                         headers={'If-None-Match': '"stale"'}).status_code == 200
+
+
+def test_qr_url_of_new_invoice_serves_the_image(app, login):
+    invoice = create_invoice(login(*ALICE))
+    assert app.test_client().get(invoice['qr_url']).status_code == 200
+
+
+def test_disk_cache_is_pruned_below_its_cap(app, login, qr_dir, monkeypatch):
+    monkeypatch.setitem(app.config, 'QR_CACHE_DIR_BYTES', 4000)
+    client = login(*ALICE)
+    for _ in range(20):
+        invoice = create_invoice(client)
+        assert client.get(f"/api/qr/{invoice['id']}.png").status_code == 200
+    assert 0 < disk_usage(qr_dir) <= 4000
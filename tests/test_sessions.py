@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+from conftest import ALICE, BOB
+
+
+@pytest.fixture
+def config():
+    # Lets the lock test give up quickly; normal requests never wait.
+    return {'SQLITE_PRAGMAS': {'busy_timeout': 100}}
+
+
+def session_rows(db, username):
+    return db.execute("SELECT s.token_hash FROM sessions s JOIN users u ON u.id = s.user_id WHERE u.username = ?",
+                      (username,)).fetchall()
+
+
+def test_cookie_holds_only_a_token(app, db, login):
+    client = login(*ALICE)
+    token = client.get_cookie(app.config.get('SESSION_COOKIE_NAME', 'session')).value
+    assert 'alice' not in token
+    assert len(session_rows(db, 'alice')) == 1
+    assert client.get('/api/me').status_code == 200
+
+
+def test_logout_deletes_the_session(db, login):
+    client = login(*ALICE)
+    assert client.post('/api/logout').status_code == 200
+    assert session_rows(db, 'alice') == []
+    assert client.get('/api/me').status_code == 401
+
+
+def test_password_change_revokes_other_sessions(db, login):
+    phone, laptop, other_user = login(*ALICE), login(*ALICE), login(*BOB)
+    resp = laptop.put('/api/me/password', json={'current_password': ALICE[1], 'new_password': 'Changed123',
+                                                'new_password_confirm': 'Changed123'})
+    assert resp.status_code == 200
+    assert phone.get('/api/me').status_code == 401
+    assert laptop.get('/api/me').status_code == 200
+    assert other_user.get('/api/me').status_code == 200
+    assert len(session_rows(db, 'alice')) == 1
+
+
+def test_admin_logs_a_user_out_everywhere(app, db, login, monkeypatch):
+    for n, secret in enumerate(('a', 'b', 'c'), 1):
+        monkeypatch.setenv(f'ADMIN_PASS{n}', secret)
+    admin = app.test_client()
+    admin.post('/admin/login', data={'username': 'root', 'pass1': 'a', 'pass2': 'b', 'pass3': 'c'})
+    sessions = [login(*ALICE) for _ in range(3)]
+    alice_id = db.execute("SELECT id FROM users WHERE username = 'alice'").fetchone()[0]
+
+    assert admin.post(f'/admin/user/{alice_id}/sessions/revoke').status_code == 302
+    assert [client.get('/api/me').status_code for client in sessions] == [401, 401, 401]
+    assert session_rows(db, 'alice') == []
+
+
+def test_login_while_the_database_is_locked_is_503(app, db):
+    holder = sqlite3.connect(app.config['DB_PATH'], isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+    try:
+        client = app.test_client()
+        resp = client.post('/api/login', json={'username': ALICE[0], 'password': ALICE[1]})
+    finally:
+        holder.rollback()
+        holder.close()
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '1'
+    assert resp.get_json()['ok'] is False
+    assert 'Set-Cookie' not in resp.headers
+    assert session_rows(db, 'alice') == []
+
+    resp = client.post('/api/login', json={'username': ALICE[0], 'password': ALICE[1]})
+    assert resp.status_code == 200
+    assert client.get('/api/me').status_code == 200
@@ -0,0 +1,79 @@
+import pytest
+
+import ledger
+from conftest import ALICE, BOB
+
+
+@pytest.fixture
+def config():
+    # alice (id 1) lives on shard 1, bob (id 2) on shard 0.
+    return {'LEDGER_SHARDS': 2, 'LEDGER_RECOVERY_DELAY': 3600}
+
+
+@pytest.fixture
+def shards(app):
+    return app.extensions['ledger_shards']
+
+
+def on_shards(shards, sql, params=()):
+    return shards.run_on_each(lambda db: [tuple(r) for r in db.execute(sql, params)])
+
+
+def balance(client):
+    return client.get('/api/me').get_json()['user']['balance_cents']
+
+
+def test_cross_shard_transfer_settles_in_two_steps(login, shards):
+    alice, bob = login(*ALICE), login(*BOB)
+    resp = alice.post('/api/transfer', json={'recipient_username': BOB[0], 'amount': '10'})
+    assert resp.status_code == 200, resp.get_json()
+    assert balance(alice) == 500000 - 1000
+    assert balance(bob) == 250000 + 1000
+    assert on_shards(shards, "SELECT user_id, type, amount_cents FROM transactions") == [
+        [(2, 'credit', 1000)], [(1, 'debit', 1000)]]
+    assert on_shards(shards, "SELECT xid FROM transfer_outbox") == [[], []]
+    assert [len(rows) for rows in on_shards(shards, "SELECT xid FROM transfer_inbox")] == [1, 0]
+
+
+def test_interrupted_transfer_is_finished_by_recovery(app, login, shards, monkeypatch):
+    def crash(shards, entries):
+        raise RuntimeError("process died between steps")
+
+    alice, bob = login(*ALICE), login(*BOB)
+    with monkeypatch.context() as patch:
+        patch.setattr(ledger, '_settle', crash)
+        resp = alice.post('/api/transfer', json={'recipient_username': BOB[0], 'amount': '10'})
+    assert resp.status_code == 200
+    # Step one is durable: the payer is debited and the credit is queued.
+    assert [len(rows) for rows in on_shards(shards, "SELECT xid FROM transfer_outbox")] == [0, 1]
+    assert balance(bob) == 250000
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['recover-transfers']).output.strip() == "Завершено переводов: 1"
+    assert runner.invoke(args=['recover-transfers']).output.strip() == "Завершено переводов: 0"
+    assert balance(bob) == 250000 + 1000
+    assert balance(alice) == 500000 - 1000
+    assert on_shards(shards, "SELECT xid FROM transfer_outbox") == [[], []]
+
+
+def test_prune_idempotency_keys_reaches_every_shard(app, login, shards):
+    alice = login(*ALICE)
+    resp = alice.post('/api/transfer', json={'recipient_username': BOB[0], 'amount': '1'},
+                      headers={'Idempotency-Key': 'k-1'})
+    assert resp.status_code == 200
+    assert on_shards(shards, "SELECT key FROM idempotency_keys") == [[], [('k-1',)]]
+
+    result = app.test_cli_runner().invoke(args=['prune-idempotency-keys', '--hours', '0'])
+    assert result.output.strip() == "Удалено ключей: 1"
+    assert on_shards(shards, "SELECT key FROM idempotency_keys") == [[], []]
+
+
+def test_rebuild_summaries_covers_every_shard(app, login, shards):
+    login(*ALICE).post('/api/transfer', json={'recipient_username': BOB[0], 'amount': '10'})
+    before = on_shards(shards, "SELECT * FROM counterparty_totals ORDER BY 1, 2")
+    shards.run_on_each(lambda db: (db.execute("DELETE FROM counterparty_totals"), db.commit()))
+
+    result = app.test_cli_runner().invoke(args=['rebuild-summaries'])
+    assert result.exit_code == 0, result.output
+    assert on_shards(shards, "SELECT * FROM counterparty_totals ORDER BY 1, 2") == before
+    assert all(before)
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from response_cache import bump_users
+
+
+class UserCache:
+    """Users rows keyed by id, with a username -> id index.
+
+    Entries expire after ``ttl`` seconds; every write path invalidates the
+    users it touched. A lookup that raced with an invalidation does not
+    store its (possibly stale) result.
+    """
+
+    def __init__(self, ttl=5.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._by_id = OrderedDict()
+        self._ids = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, user_id):
+        entry = self._by_id.get(user_id)
+        if entry is None:
+            return None
+        user, expires = entry
+        if expires < time.monotonic():
+            self._drop(user_id)
+            return None
+        self._by_id.move_to_end(user_id)
+        return user
+
+    def _drop(self, user_id):
+        entry = self._by_id.pop(user_id, None)
+        if entry is not None:
+            self._ids.pop(entry[0]["username"], None)
+
+    def _load(self, db, column, value):
+        with self._lock:
+            self.misses += 1
+            epoch = self._epoch
+        row = db.execute(f"SELECT * FROM users WHERE {column} = ?", (value,)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        with self._lock:
+            if epoch == self._epoch:
+                self._drop(user["id"])
+                self._by_id[user["id"]] = (user, time.monotonic() + self.ttl)
+                self._ids[user["username"]] = user["id"]
+                while len(self._by_id) > self.max_entries:
+                    self._drop(next(iter(self._by_id)))
+        return user
+
+    def get_by_id(self, db, user_id):
+        with self._lock:
+            user = self._lookup(user_id)
+            if user is not None:
+                self.hits += 1
+                return user
+        return self._load(db, 'id', user_id)
+
+    def get_by_username(self, db, username):
+        with self._lock:
+            user_id = self._ids.get(username)
+            user = self._lookup(user_id) if user_id is not None else None
+            if user is not None and user["username"] == username:
+                self.hits += 1
+                return user
+        return self._load(db, 'username', username)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._epoch += 1
+            for user_id in user_ids:
+                self._drop(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._by_id)}
+
+
+def get_user_cache(app) -> UserCache:
+    cache = app.extensions.get('user_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('user_cache', UserCache(
+            ttl=app.config.get('USER_CACHE_TTL', 5.0),
+            max_entries=app.config.get('USER_CACHE_SIZE', 10000),
+        ))
+    return cache
+
+
+def invalidate_users(*user_ids):
+    get_user_cache(current_app).invalidate(*user_ids)
+    # Every users write comes through here, so cached responses follow too.
+    bump_users(*user_ids)